@@ -9,13 +9,10 @@ import torch
 
 try:
     from fairseq import libbleu
-except ImportError as e:
-    import sys
-    sys.stderr.write('ERROR: missing libbleu.so. run `pip install --editable .`\n')
-    raise e
-
-
-C = ctypes.cdll.LoadLibrary(libbleu.__file__)
+    C = ctypes.cdll.LoadLibrary(libbleu.__file__)
+except ImportError:
+    # only Scorer needs it, BatchScorer computes the same scores in torch
+    C = None
 
 
 class BleuStat(ctypes.Structure):
@@ -60,6 +57,8 @@ class SacrebleuScorer(object):
 
 class Scorer(object):
     def __init__(self, pad, eos, unk):
+        if C is None:
+            raise ImportError('missing libbleu.so. run `pip install --editable .` or use BatchScorer')
         self.stat = BleuStat()
         self.pad = pad
         self.eos = eos
@@ -127,3 +126,107 @@ class Scorer(object):
         return fmt.format(order, self.score(order=order), *bleup,
                           self.brevity(), self.stat.predlen/self.stat.reflen,
                           self.stat.predlen, self.stat.reflen)
+
+
+class BatchScorer(Scorer):
+    """Computes the same scores as :class:`Scorer` without libbleu, counting
+    the n-grams of a whole batch of sentences at once with tensor ops on
+    their device (see :func:`add_batch`). The statistics stay on that device
+    until a score is read.
+
+    Single sentences given to :func:`add` are buffered and counted in
+    batches of *buffer_size*.
+    """
+
+    def __init__(self, pad, eos, unk, buffer_size=256):
+        self.pad = pad
+        self.eos = eos
+        self.unk = unk
+        self.buffer_size = buffer_size
+        self.reset()
+
+    def reset(self, one_init=False):
+        # reflen, predlen, match1, count1, ..., match4, count4, as in BleuStat
+        self._stat = torch.zeros(10, dtype=torch.long)
+        if one_init:
+            self._stat[4:] = 1
+        self._buffer = []
+
+    @property
+    def stat(self):
+        self._flush()
+        return BleuStat(*self._stat.tolist())
+
+    def add(self, ref, pred):
+        self._buffer.append((ref.view(-1), pred.view(-1)))
+        if len(self._buffer) >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self._buffer) > 0:
+            refs, preds = zip(*self._buffer)
+            self._buffer = []
+            self.add_batch(refs, preds)
+
+    def add_batch(self, ref, pred):
+        """Add the statistics of a batch of references and hypotheses, given
+        as ``(bsz, len)`` tensors or as lists of 1D tensors, padded with
+        *pad*. As in :func:`Scorer.add`, leading padding and trailing
+        padding and eos are ignored, and unknown words never match."""
+        ref, ref_len = self._trim(ref)
+        pred, pred_len = self._trim(pred)
+        # don't match unknown words
+        ref = ref.masked_fill(ref.eq(self.unk), -1)
+        bsz = ref.size(0)
+
+        width = max(ref.size(1), pred.size(1))
+        tokens = torch.cat([
+            torch.nn.functional.pad(pred, (0, width - pred.size(1)), value=self.pad),
+            torch.nn.functional.pad(ref, (0, width - ref.size(1)), value=self.pad),
+        ]) + 1
+        lengths = torch.cat([pred_len, ref_len])
+        is_pred = torch.arange(2 * bsz, device=tokens.device).lt(bsz).unsqueeze(1)
+        positions = torch.arange(width, device=tokens.device)
+        vocab = tokens.max() + 1
+
+        # number the distinct n-grams of each sentence pair: an n-gram is
+        # an (n-1)-gram followed by a token
+        sentence = torch.arange(bsz, device=tokens.device).repeat(2).unsqueeze(1)
+        ngrams = sentence * vocab + tokens
+        stat = [ref_len.sum(), pred_len.sum()]
+        for n in range(1, 5):
+            if n > 1:
+                ngrams = ngrams[:, :-1] * vocab + tokens[:, n - 1:]
+            distinct, ngrams = torch.unique(ngrams, return_inverse=True)
+            num_distinct = distinct.numel()
+            valid = positions[:width - n + 1].unsqueeze(0) < (lengths - n + 1).unsqueeze(1)
+
+            def count(mask):
+                # invalid n-grams are counted in an extra bin
+                return torch.bincount(
+                    ngrams.masked_fill(~mask, num_distinct).view(-1), minlength=num_distinct + 1,
+                )[:num_distinct]
+
+            matches = torch.min(count(valid & is_pred), count(valid & ~is_pred)).sum()
+            stat += [matches, valid[:bsz].sum()]
+        self._stat = self._stat.to(tokens.device) + torch.stack(stat)
+
+    def _trim(self, x):
+        """Return the tokens of each sentence in *x* left-aligned, without
+        leading padding and trailing padding and eos, and their number."""
+        if isinstance(x, (list, tuple)):
+            x = torch.nn.utils.rnn.pad_sequence(list(x), batch_first=True, padding_value=self.pad)
+        x = x.long()
+        width = x.size(1)
+        is_pad = x.eq(self.pad)
+        start = is_pad.long().cumprod(dim=1).sum(dim=1)
+        kept = ~is_pad & x.ne(self.eos)
+        # as libbleu, keep the first token after the leading padding even if
+        # it is an eos
+        end = torch.where(
+            kept.any(dim=1), width - kept.flip(1).long().argmax(dim=1), (start + 1).clamp(max=width),
+        )
+        lengths = (end - start).clamp(min=0)
+        positions = torch.arange(width, device=x.device)
+        index = (start.unsqueeze(1) + positions).clamp(max=width - 1)
+        return x.gather(1, index), lengths
@@ -201,6 +201,7 @@ def load_model_ensemble_and_task(filenames, arg_overrides=None, task=None):
 
         # build model for ensemble
         model = task.build_model(args)
+        remove_modules(model, getattr(args, "slimmed_modules", None) or [])
         model.load_state_dict(state["model"], strict=True, args=args)
         ensemble.append(model)
     return ensemble, args, task
@@ -446,6 +447,94 @@ def prune_state_dict(state_dict, args):
     return new_state_dict
 
 
+def unused_modules(model, param_names):
+    """Return the names of the largest submodules of *model* whose parameters
+    are all in *param_names*, e.g. the parameters that received no gradient
+    over the first updates (see --slim-after-updates)."""
+    param_names = set(param_names)
+    modules = []
+    for name, module in model.named_modules():
+        if not name or any(name.startswith(m + ".") for m in modules):
+            continue
+        names = ["{}.{}".format(name, n) for n, _ in module.named_parameters()]
+        if len(names) > 0 and all(n in param_names for n in names):
+            modules.append(name)
+    return modules
+
+
+def _get_module(model, name):
+    for part in name.split("."):
+        model = getattr(model, part)
+    return model
+
+
+def remove_modules(model, module_names):
+    """Remove the submodules *module_names* of *model* (see
+    :func:`unused_modules`), which must not be used in its forward. Checkpoints
+    list them in *args.slimmed_modules*, so that they are removed from the
+    models built to load them."""
+    for name in module_names:
+        parent, _, child = name.rpartition(".")
+        parent = _get_module(model, parent) if parent else model
+        if getattr(parent, child, None) is not None:
+            setattr(parent, child, None)
+
+
+def prune_optimizer_state(optimizer_state, keep, numels):
+    """Drop the state of some parameters from an optimizer state dict, for an
+    optimizer of the remaining parameters.
+
+    Args:
+        optimizer_state (dict): state dict of the optimizer of all the
+            parameters, either one per parameter or a flat copy of all of them
+            (see :class:`~fairseq.optim.FP16Optimizer`)
+        keep (List[bool]): whether to keep each parameter, in the order
+            they are optimized
+        numels (List[int]): number of elements of each parameter
+
+    Returns:
+        the pruned state dict, or ``None`` if its parameters do not match
+        *numels*
+    """
+    groups = optimizer_state["param_groups"]
+    ids = [i for group in groups for i in group["params"]]
+    state = optimizer_state["state"]
+
+    def numels_match(param_state, numel):
+        return all(
+            v.numel() == numel for v in param_state.values() if torch.is_tensor(v) and v.dim() > 0
+        )
+
+    if len(ids) == len(keep):
+        if not all(numels_match(state[i], n) for i, n in zip(ids, numels) if i in state):
+            return None
+        new_ids = {}
+        for i, k in zip(ids, keep):
+            if k:
+                new_ids[i] = len(new_ids)
+        new_state = {new_ids[i]: s for i, s in state.items() if i in new_ids}
+        new_groups = [
+            dict(group, params=[new_ids[i] for i in group["params"] if i in new_ids])
+            for group in groups
+        ]
+    elif len(ids) == 1:
+        # a flat copy of all the parameters
+        if not all(numels_match(s, sum(numels)) for s in state.values()):
+            return None
+        mask = torch.cat([torch.full((n,), k, dtype=torch.bool) for n, k in zip(numels, keep)])
+        new_state = {
+            i: {
+                k: v[mask.to(v.device)] if torch.is_tensor(v) and v.dim() > 0 else v
+                for k, v in s.items()
+            }
+            for i, s in state.items()
+        }
+        new_groups = groups
+    else:
+        return None
+    return dict(optimizer_state, state=new_state, param_groups=new_groups)
+
+
 def load_pretrained_component_from_model(
     component: Union[FairseqEncoder, FairseqDecoder], checkpoint: str
 ):
@@ -4,6 +4,10 @@
 # LICENSE file in the root directory of this source tree.
 
 import math
+import time
+
+import torch
+import torch.nn.functional as F
 
 from fairseq import metrics, utils
 from fairseq.criterions import FairseqCriterion, register_criterion
@@ -30,12 +34,28 @@ def label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=None, reduce=T
     return loss, nll_loss
 
 
+def multimodal_consis_loss(txt_out, img_out):
+    """KL divergence of the image summaries from the text summaries (both
+    B x C, softmax over the features), for the whole batch at once.
+
+    Sentences without an image (an all-zero image summary) are left out.
+    Returns the sum of the divergences, averaged over the features, and the
+    number of sentences with an image.
+    """
+    has_image = img_out.ne(0).any(dim=-1)
+    log_p_txt = F.log_softmax(txt_out.float(), dim=-1)
+    log_p_img = F.log_softmax(img_out.float(), dim=-1)
+    kl = (log_p_txt.exp() * (log_p_txt - log_p_img)).mean(dim=-1)
+    return kl.masked_fill(~has_image, 0.).sum(), has_image.sum()
+
+
 @register_criterion('label_smoothed_cross_entropy_with_mmconsis')
 class LabelSmoothedCrossEntropyCriterionWithMMConsis(FairseqCriterion):
 
     def __init__(self, args, task):
         super().__init__(args, task)
         self.eps = args.label_smoothing
+        self.log_consis_cost = getattr(args, 'log_consis_cost', False)
 
     @staticmethod
     def add_args(parser):
@@ -43,6 +63,9 @@ class LabelSmoothedCrossEntropyCriterionWithMMConsis(FairseqCriterion):
         # fmt: off
         parser.add_argument('--label-smoothing', default=0., type=float, metavar='D',
                             help='epsilon for label smoothing, 0 means no label smoothing')
+        parser.add_argument('--log-consis-cost', action='store_true',
+                            help='log the time (consis_ms) and the memory saved for backward '
+                                 '(consis_kb) of the consistency loss; synchronizes CUDA')
         # fmt: on
 
     def forward(self, model, sample, reduce=True):
@@ -56,13 +79,19 @@ class LabelSmoothedCrossEntropyCriterionWithMMConsis(FairseqCriterion):
         net_output = model(**sample['net_input'])
         loss, nll_loss = self.compute_loss(model, net_output, sample, reduce=reduce)
         sample_size = sample['target'].size(0) if self.args.sentence_avg else sample['ntokens']
-        logging_output = {
+        logging_output = {}
+        consis_loss, nimages = self.compute_consis_loss(net_output, logging_output)
+        # averaged as F.kl_div(reduction='mean'), over the sentences with an image
+        loss = loss + consis_loss / nimages.clamp(min=1)
+        logging_output.update({
             'loss': utils.item(loss.data) if reduce else loss.data,
             'nll_loss': utils.item(nll_loss.data) if reduce else nll_loss.data,
+            'consis_loss': utils.item(consis_loss.data),
+            'nimages': utils.item(nimages),
             'ntokens': sample['ntokens'],
             'nsentences': sample['target'].size(0),
             'sample_size': sample_size,
-        }
+        })
         return loss, sample_size, logging_output
 
     def compute_loss(self, model, net_output, sample, reduce=True):
@@ -72,21 +101,35 @@ class LabelSmoothedCrossEntropyCriterionWithMMConsis(FairseqCriterion):
         loss, nll_loss = label_smoothed_nll_loss(
             lprobs, target, self.eps, ignore_index=self.padding_idx, reduce=reduce,
         )
-        # txt_img_out = net_output[1]['txt_img_out']
-        # src_batch_len = net_output[1]['src_batch_len']
-        # txt_out = [i[:src_batch_len] for i in txt_img_out]
-        # img_out = [i[src_batch_len: src_batch_len+49]for i in txt_img_out]
+        return loss, nll_loss
+
+    def compute_consis_loss(self, net_output, logging_output):
+        """Consistency loss between the pooled text and image states of the
+        encoder (see :class:`~fairseq.models.transformer.EncoderOut`)."""
         txt_out = net_output[1]['txt_out']
         img_out = net_output[1]['img_out']
+        if not self.log_consis_cost:
+            return multimodal_consis_loss(txt_out, img_out)
+
+        use_cuda = txt_out.is_cuda
+        saved = {}
 
-        txt_out = utils.meanpooling_tensor(txt_out)
-        img_out = utils.meanpooling_tensor(img_out)
-        consis_loss = utils.multimodel_consis_loss(img_out, txt_out)
-        # if isinstance(consis_loss, list):
-        #     consis_loss = sum([i.item() for i in consis_loss[4:]])
-        # else:
-        #     consis_loss = consis_loss
-        return loss + consis_loss, nll_loss
+        def pack(t):
+            # tensors saved for backward, but not those already kept by the model
+            if t is not txt_out and t is not img_out:
+                saved[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+            return t
+
+        if use_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            consis_loss, nimages = multimodal_consis_loss(txt_out, img_out)
+        if use_cuda:
+            torch.cuda.synchronize()
+        logging_output['consis_ms'] = 1000 * (time.perf_counter() - start)
+        logging_output['consis_kb'] = sum(saved.values()) / 1024
+        return consis_loss, nimages
 
     @staticmethod
     def reduce_metrics(logging_outputs) -> None:
@@ -100,6 +143,15 @@ class LabelSmoothedCrossEntropyCriterionWithMMConsis(FairseqCriterion):
         metrics.log_scalar('nll_loss', nll_loss_sum / ntokens / math.log(2), ntokens, round=3)
         metrics.log_derived('ppl', lambda meters: round(2**meters['nll_loss'].avg, 3))
 
+        consis_loss_sum = sum(log.get('consis_loss', 0) for log in logging_outputs)
+        nimages = sum(log.get('nimages', 0) for log in logging_outputs)
+        if nimages > 0:
+            metrics.log_scalar('consis_loss', consis_loss_sum / nimages, nimages, round=6)
+        if any('consis_ms' in log for log in logging_outputs):
+            # summed over the workers
+            metrics.log_scalar('consis_ms', sum(log.get('consis_ms', 0) for log in logging_outputs), round=3)
+            metrics.log_scalar('consis_kb', sum(log.get('consis_kb', 0) for log in logging_outputs), round=1)
+
     @staticmethod
     def logging_outputs_can_be_summed() -> bool:
         """
@@ -17,6 +17,12 @@ from .concat_dataset import ConcatDataset
 from .concat_sentences_dataset import ConcatSentencesDataset
 from .denoising_dataset import DenoisingDataset
 from .id_dataset import IdDataset
+from .image_feature_dataset import (
+    ImageFeatureStore,
+    ListImageFeatureDataset,
+    MMapImageFeatureDataset,
+    NumpyImageFeatureDataset,
+)
 from .indexed_dataset import IndexedCachedDataset, IndexedDataset, IndexedRawTextDataset, MMapIndexedDataset
 from .language_pair_dataset import LanguagePairDataset
 from .list_dataset import ListDataset
@@ -69,15 +75,18 @@ __all__ = [
     'FairseqIterableDataset',
     'GroupedIterator',
     'IdDataset',
+    'ImageFeatureStore',
     'IndexedCachedDataset',
     'IndexedDataset',
     'IndexedRawTextDataset',
     'LanguagePairDataset',
     'LeftPadDataset',
     'ListDataset',
+    'ListImageFeatureDataset',
     'LMContextWindowDataset',
     'LRUCacheDataset',
     'MaskTokensDataset',
+    'MMapImageFeatureDataset',
     'MMapIndexedDataset',
     'MonolingualDataset',
     'MultiCorpusSampledDataset',
@@ -85,6 +94,7 @@ __all__ = [
     'NoisingDataset',
     'NumelDataset',
     'NumSamplesDataset',
+    'NumpyImageFeatureDataset',
     'OffsetTokensDataset',
     'PadDataset',
     'PrependDataset',
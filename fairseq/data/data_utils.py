@@ -48,6 +48,21 @@ def collate_tokens(values, pad_idx, eos_idx=None, left_pad=False, move_eos_to_be
         copy_tensor(v, res[i][size - len(v):] if left_pad else res[i][:len(v)])
     return res
 
+def new_batch_buffer(size, dtype, pin_memory=False):
+    """Allocate an uninitialized tensor to collate a batch into.
+
+    In a DataLoader worker the tensor lives in shared memory (as in
+    :func:`torch.utils.data.default_collate`), so that it is not copied again
+    when sent to the main process. Otherwise it is optionally pinned.
+    """
+    if torch.utils.data.get_worker_info() is not None:
+        numel = int(np.prod(size))
+        elem = torch.empty(0, dtype=dtype)
+        storage = getattr(elem, '_typed_storage', elem.storage)()._new_shared(numel)
+        return elem.new(storage).view(size)
+    return torch.empty(size, dtype=dtype, pin_memory=pin_memory and torch.cuda.is_available())
+
+
 def collate_multimodel_graphs(txt_graphs, img_txt_graphs, src_lengths):
     max_txt_len = max(src_lengths).item()
     max_img_len = max([i.shape[0] for i in img_txt_graphs])
@@ -271,7 +286,7 @@ def filter_by_size(indices, dataset, max_positions, raise_exception=False):
 
 def batch_by_size(
     indices, num_tokens_fn, max_tokens=None, max_sentences=None,
-    required_batch_size_multiple=1,
+    required_batch_size_multiple=1, num_tokens_vec=None,
 ):
     """
     Yield mini-batches of indices bucketed by size. Batches may contain
@@ -287,6 +302,9 @@ def batch_by_size(
             batch (default: None).
         required_batch_size_multiple (int, optional): require batch size to
             be a multiple of N (default: 1).
+        num_tokens_vec (np.ndarray, optional): the number of tokens at each
+            of *indices*, used instead of calling *num_tokens_fn* for every
+            index (default: None).
     """
     try:
         from fairseq.data.data_utils_fast import batch_by_size_fast
@@ -295,6 +313,11 @@ def batch_by_size(
             'Please build Cython components with: `pip install --editable .` '
             'or `python setup.py build_ext --inplace`'
         )
+    try:
+        from fairseq.data.data_utils_fast import batch_by_size_vec
+    except ImportError:
+        # Cython components built before batch_by_size_vec was added
+        batch_by_size_vec = None
 
     max_tokens = max_tokens if max_tokens is not None else -1
     max_sentences = max_sentences if max_sentences is not None else -1
@@ -303,6 +326,11 @@ def batch_by_size(
     if isinstance(indices, types.GeneratorType):
         indices = np.fromiter(indices, dtype=np.int64, count=-1)
 
+    if num_tokens_vec is not None and batch_by_size_vec is not None:
+        return batch_by_size_vec(
+            np.asarray(indices, dtype=np.int64), np.asarray(num_tokens_vec, dtype=np.int64),
+            max_tokens, max_sentences, bsz_mult,
+        )
     return batch_by_size_fast(indices, num_tokens_fn, max_tokens, max_sentences, bsz_mult)
 
 
@@ -321,10 +349,49 @@ def load_sp_graph(graph_npy_path):
     return graph_tensor
 
 def load_img_features(imag_npy_path):
-    img_npy = np.load(imag_npy_path + '.npy', allow_pickle=True)
-    img_tensor = torch.tensor(img_npy)
-    img_tensor = img_tensor.view(img_tensor.size(0),img_tensor.size(1)*img_tensor.size(2),-1)
-    return img_tensor
+    """Load the image features belonging to the text dataset at
+    *imag_npy_path* (e.g., 'data-bin/train.en-de.en').
+
+    A binarized ``<path>.img.{idx,bin}`` store is preferred, followed by
+    sharded stores ``<path>.img.0``, ``<path>.img.1``, ... which are combined
+    into a single ConcatDataset. The legacy ``<path>.npy`` array is
+    memory-mapped as a fallback. Either way items are
+    ``(num_regions, feature_dim)`` views into the page cache, not copies.
+    """
+    from fairseq.data.concat_dataset import ConcatDataset
+    from fairseq.data import image_feature_dataset
+
+    img_path = image_feature_dataset.image_feature_prefix(imag_npy_path)
+    if image_feature_dataset.MMapImageFeatureDataset.exists(img_path):
+        dataset = image_feature_dataset.MMapImageFeatureDataset(img_path)
+    elif image_feature_dataset.MMapImageFeatureDataset.exists(img_path + '.0'):
+        shards = []
+        for k in itertools.count():
+            path_k = '{}.{}'.format(img_path, k)
+            if not image_feature_dataset.MMapImageFeatureDataset.exists(path_k):
+                break
+            shards.append(image_feature_dataset.MMapImageFeatureDataset(path_k))
+        image_feature_dataset.check_compatible(shards)
+        logger.info('loaded {} image feature shards from: {}'.format(len(shards), img_path))
+        dataset = shards[0] if len(shards) == 1 else ConcatDataset(shards)
+    elif image_feature_dataset.NumpyImageFeatureDataset.exists(imag_npy_path + '.npy'):
+        dataset = image_feature_dataset.NumpyImageFeatureDataset(imag_npy_path + '.npy')
+    else:
+        raise FileNotFoundError('Image features not found: {}'.format(img_path))
+    logger.info('loaded {} image features from: {}'.format(len(dataset), img_path))
+    return dataset
+
+def load_img_index(imag_npy_path):
+    """Load the sentence-to-image index of a deduplicated image feature
+    store, or return ``None`` if features are stored once per sentence."""
+    from fairseq.data import image_feature_dataset
+
+    index_path = image_feature_dataset.image_index_path(
+        image_feature_dataset.image_feature_prefix(imag_npy_path)
+    )
+    if not os.path.exists(index_path):
+        return None
+    return np.load(index_path, mmap_mode='r')
 
 def load_multimodel_graph(multimodel_graph_path):
     multimodel_graph = np.load(multimodel_graph_path + 'npy', allow_pickle=True)
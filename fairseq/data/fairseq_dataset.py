@@ -40,6 +40,11 @@ class FairseqDataset(torch.utils.data.Dataset, EpochListening):
         enforce ``--max-tokens`` during batching."""
         raise NotImplementedError
 
+    def num_tokens_vec(self, indices):
+        """Return the number of tokens of the samples at *indices*, as with
+        :func:`num_tokens`, in one vectorized call."""
+        raise NotImplementedError
+
     def size(self, index):
         """Return an example's size as a float or tuple. This value is used when
         filtering a dataset with ``--max-positions``."""
@@ -0,0 +1,769 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import hashlib
+import os
+import shutil
+import struct
+
+import numpy as np
+import torch
+
+from fairseq.data.indexed_dataset import data_file_path, index_file_path
+
+
+feature_formats = {
+    1: 'float32',
+    2: 'float16',
+    3: 'bfloat16',
+    4: 'int8',
+}
+
+# numpy has no bfloat16, so it is stored as the upper 16 bits of a float32
+# and reinterpreted by torch on read
+storage_dtypes = {
+    'float32': np.float32,
+    'float16': np.float16,
+    'bfloat16': np.int16,
+    'int8': np.int8,
+}
+
+
+# entry of the sentence-to-image index (see image_index_path) of a sentence
+# without an image, which is read as all-zero features
+MISSING_IMAGE = -1
+
+
+def get_available_feature_formats():
+    return list(storage_dtypes.keys())
+
+
+def feature_code(feature_format):
+    for k in feature_formats.keys():
+        if feature_formats[k] == feature_format:
+            return k
+    raise ValueError(feature_format)
+
+
+def compute_feature_range(features, feature_dim, indices=None):
+    """Return the per-channel ``(min, max)`` over a sequence of
+    ``(num_regions, feature_dim)`` arrays (or the items at *indices* of it)."""
+    lo = np.full(feature_dim, np.inf, dtype=np.float32)
+    hi = np.full(feature_dim, -np.inf, dtype=np.float32)
+    for i in (indices if indices is not None else range(len(features))):
+        feats = np.asarray(features[i], dtype=np.float32).reshape(-1, feature_dim)
+        np.minimum(lo, feats.min(axis=0), out=lo)
+        np.maximum(hi, feats.max(axis=0), out=hi)
+    return lo, hi
+
+
+def compute_quantization_params(features, feature_dim, indices=None):
+    """Compute per-channel asymmetric int8 ``(scale, zero_point)`` tables
+    over a sequence of ``(num_regions, feature_dim)`` arrays (or the items
+    at *indices* of it)."""
+    return quantization_params_from_range(*compute_feature_range(features, feature_dim, indices))
+
+
+def quantization_params_from_range(lo, hi):
+    """Compute int8 ``(scale, zero_point)`` tables from per-channel bounds,
+    e.g. the elementwise min/max of several :func:`compute_feature_range`
+    results."""
+    lo = np.minimum(lo, 0.)
+    hi = np.maximum(hi, 0.)
+    scale = np.maximum((hi - lo) / 255., np.finfo(np.float32).tiny).astype(np.float32)
+    zero_point = (-128. - np.round(lo / scale)).astype(np.float32)
+    return scale, zero_point
+
+
+def encode_features(features, feature_format, scale=None, zero_point=None):
+    """Convert float features to their on-disk representation."""
+    features = np.asarray(features, dtype=np.float32)
+    if feature_format == 'float32':
+        return features
+    elif feature_format == 'float16':
+        return features.astype(np.float16)
+    elif feature_format == 'bfloat16':
+        # round to nearest even before truncating the mantissa
+        bits = np.ascontiguousarray(features).view(np.uint32)
+        bits = bits + (np.uint32(0x7FFF) + ((bits >> 16) & np.uint32(1)))
+        return (bits >> 16).astype(np.uint16).view(np.int16)
+    elif feature_format == 'int8':
+        assert scale is not None and zero_point is not None
+        q = np.round(features / scale) + zero_point
+        return np.clip(q, -128, 127).astype(np.int8)
+    raise ValueError(feature_format)
+
+
+def image_feature_prefix(prefix_path):
+    """Return the prefix of the image feature store belonging to the text
+    dataset at *prefix_path* (e.g., 'data-bin/train.en-de.en')."""
+    return prefix_path + '.img'
+
+
+def image_projection_prefix(prefix_path, key):
+    """Return the prefix of the cache of projected image features for the
+    store at *prefix_path*, see :func:`binarize_image_projections`."""
+    return '{}.proj.{}'.format(prefix_path, key)
+
+
+def projection_key(projections):
+    """Fingerprint the parameters of a list of ``nn.Linear`` projections, so
+    that cached projections are invalidated when the checkpoint changes."""
+    h = hashlib.sha1()
+    # invalidates caches written before blank images were cached as zeros
+    h.update(b'blank-images-v2')
+    for proj in projections:
+        h.update(str(tuple(proj.weight.shape)).encode())
+        for p in (proj.weight, proj.bias):
+            h.update(p.detach().float().cpu().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+def image_index_path(prefix_path):
+    """Return the path of the sentence-to-image index of a deduplicated
+    image feature store at *prefix_path*, or of one with sentences without
+    an image (:data:`MISSING_IMAGE`)."""
+    return prefix_path + '.ids.npy'
+
+
+def deduplicate_image_features(features):
+    """Find identical feature blocks in a sequence of arrays.
+
+    Features are a deterministic function of the image, so equal blocks
+    identify the same image (e.g., the five Multi30K captions of one photo,
+    or back-translated copies of a sentence pair).
+
+    Returns:
+        tuple: the indices of the first occurrence of each distinct image and
+        an int64 array mapping every item to its position among those
+    """
+    return deduplicate_digests([feature_digest(features[i]) for i in range(len(features))])
+
+
+def feature_digest(features):
+    """Return a content hash of one item's feature block."""
+    return hashlib.sha1(np.ascontiguousarray(features).tobytes()).digest()
+
+
+def deduplicate_digests(digests):
+    """Like :func:`deduplicate_image_features`, given the
+    :func:`feature_digest` of every item."""
+    first_index = {}
+    unique_indices = []
+    image_ids = np.empty(len(digests), dtype=np.int64)
+    for i, key in enumerate(digests):
+        if key not in first_index:
+            first_index[key] = len(unique_indices)
+            unique_indices.append(i)
+        image_ids[i] = first_index[key]
+    return unique_indices, image_ids
+
+
+def unwrap_image_feature_dataset(dataset):
+    """Return the first underlying feature store of a (possibly
+    concatenated) image feature dataset."""
+    from fairseq.data.concat_dataset import ConcatDataset
+
+    while isinstance(dataset, ConcatDataset):
+        dataset = dataset.datasets[0]
+    return dataset
+
+
+def check_compatible(datasets):
+    """Make sure *datasets* can be collated together and dequantized with the
+    tables of the first one."""
+    datasets = [unwrap_image_feature_dataset(d) for d in datasets]
+    first = datasets[0]
+    for other in datasets[1:]:
+        assert other.feature_dim == first.feature_dim, \
+            'image feature dims differ: {} vs {}'.format(other.feature_dim, first.feature_dim)
+        assert other.feature_format == first.feature_format, \
+            'image feature formats differ: {} vs {}'.format(other.feature_format, first.feature_format)
+        if first.feature_format == 'int8':
+            assert torch.equal(other._scale, first._scale) and torch.equal(other._zero_point, first._zero_point), \
+                'int8 image feature shards must share their quantization tables'
+
+
+def pad_regions(features, sizes, value):
+    """Fill the regions of a ``(batch, num_regions, feature_dim)`` array
+    past the number of regions of each item (*sizes*) with *value*."""
+    padded = np.arange(features.shape[1]) >= np.asarray(sizes).reshape(-1, 1)
+    if padded.any():
+        features[padded] = value
+
+
+def take(dataset, indices, out=None):
+    """Gather the items at *indices* of a (possibly concatenated) image
+    feature dataset as with :func:`MMapImageFeatureDataset.take`. The items
+    of a concatenated dataset are gathered with one ``take`` per underlying
+    dataset, and those of a dataset without a vectorized ``take`` one item
+    at a time."""
+    if hasattr(dataset, 'take'):
+        return dataset.take(indices, out=out)
+    store = unwrap_image_feature_dataset(dataset)
+    # int8 features encode zero as their zero-point
+    pad = store._zero_point.numpy() if getattr(store, 'feature_format', None) == 'int8' else 0
+    if hasattr(dataset, 'datasets') and hasattr(dataset, 'cumulative_sizes'):
+        return _take_concat(dataset, indices, out, pad)
+    return _take_items(dataset, indices, out, pad)
+
+
+def _take_concat(dataset, indices, out, pad):
+    indices = np.asarray(indices, dtype=np.int64)
+    missing = indices == MISSING_IMAGE
+    if missing.all():
+        return take(dataset.datasets[0], indices, out=out)
+    # as ConcatDataset._get_dataset_and_sample_index
+    cumulative_sizes = np.asarray(dataset.cumulative_sizes, dtype=np.int64)
+    dataset_idx = np.searchsorted(cumulative_sizes, indices, side='right')
+    sample_idx = indices - np.concatenate([[0], cumulative_sizes[:-1]])[dataset_idx]
+    real_sizes = getattr(dataset, 'real_sizes', None)
+    if real_sizes is not None:
+        sample_idx = sample_idx % np.asarray(real_sizes, dtype=np.int64)[dataset_idx]
+
+    parts = []
+    for d in np.unique(dataset_idx[~missing]):
+        positions = np.flatnonzero((dataset_idx == d) & ~missing)
+        parts.append((positions, take(dataset.datasets[d], sample_idx[positions])))
+    if out is None:
+        elem = parts[0][1]
+        num_regions = max(part.size(1) for _, part in parts)
+        out = elem.new_empty((len(indices), num_regions, elem.size(-1)))
+    sizes = np.zeros(len(indices), dtype=np.int64)
+    for positions, part in parts:
+        out[torch.from_numpy(positions), :part.size(1)] = part
+        sizes[positions] = part.size(1)
+    np_out = (out.view(torch.int16) if out.dtype == torch.bfloat16 else out).numpy()
+    pad_regions(np_out, sizes, pad)
+    return out
+
+
+def _take_items(dataset, indices, out, pad):
+    indices = np.asarray(indices, dtype=np.int64)
+    items = [None if j == MISSING_IMAGE else dataset[j] for j in indices]
+    sizes = [0 if item is None else len(item) for item in items]
+    if out is None:
+        elem = next(item for item in items if item is not None)
+        out = elem.new_empty((len(items), max(sizes), elem.size(-1)))
+    for i, item in enumerate(items):
+        if item is not None:
+            out[i, :len(item)] = item
+    np_out = (out.view(torch.int16) if out.dtype == torch.bfloat16 else out).numpy()
+    pad_regions(np_out, sizes, pad)
+    return out
+
+
+class MMapImageFeatureDataset(torch.utils.data.Dataset):
+    """Memory-mapped store of per-example image region features.
+
+    Each example is a ``(num_regions, feature_dim)`` matrix. The data file is
+    mapped copy-on-write, so ``__getitem__`` returns zero-copy views backed by
+    the OS page cache that are shared by all DataLoader workers and processes
+    reading the same file.
+
+    Features may be stored as float32, float16, bfloat16 or per-channel int8.
+    Items are returned in their storage precision; use :func:`dequantize` to
+    convert (a batch of) them back to floating point.
+    """
+
+    class Index(object):
+        _HDR_MAGIC = b'MMIMGIDX\x00'
+
+        @classmethod
+        def writer(cls, path, feature_format, feature_dim):
+            class _Writer(object):
+                def __enter__(self):
+                    self._file = open(path, 'wb')
+
+                    self._file.write(cls._HDR_MAGIC)
+                    self._file.write(struct.pack('<Q', 1))
+                    self._file.write(struct.pack('<B', feature_code(feature_format)))
+                    self._file.write(struct.pack('<Q', feature_dim))
+
+                    return self
+
+                @staticmethod
+                def _get_pointers(sizes):
+                    row_size = storage_dtypes[feature_format]().itemsize * feature_dim
+                    address = 0
+                    pointers = []
+
+                    for size in sizes:
+                        pointers.append(address)
+                        address += size * row_size
+
+                    return pointers
+
+                def write(self, sizes):
+                    pointers = self._get_pointers(sizes)
+
+                    self._file.write(struct.pack('<Q', len(sizes)))
+
+                    sizes = np.array(sizes, dtype=np.int32)
+                    self._file.write(sizes.tobytes(order='C'))
+                    del sizes
+
+                    pointers = np.array(pointers, dtype=np.int64)
+                    self._file.write(pointers.tobytes(order='C'))
+                    del pointers
+
+                def write_quantization_params(self, scale, zero_point):
+                    self._file.write(np.asarray(scale, dtype=np.float32).tobytes(order='C'))
+                    self._file.write(np.asarray(zero_point, dtype=np.float32).tobytes(order='C'))
+
+                def __exit__(self, exc_type, exc_val, exc_tb):
+                    self._file.close()
+
+            return _Writer()
+
+        def __init__(self, path):
+            with open(path, 'rb') as stream:
+                magic_test = stream.read(9)
+                assert self._HDR_MAGIC == magic_test, (
+                    'Index file doesn\'t match expected image feature format.'
+                )
+                version = struct.unpack('<Q', stream.read(8))
+                assert (1,) == version
+
+                format_code, = struct.unpack('<B', stream.read(1))
+                self._feature_format = feature_formats[format_code]
+                self._dtype = storage_dtypes[self._feature_format]
+                self._feature_dim, = struct.unpack('<Q', stream.read(8))
+
+                self._len = struct.unpack('<Q', stream.read(8))[0]
+                offset = stream.tell()
+
+            self._bin_buffer_mmap = np.memmap(path, mode='r', order='C')
+            self._bin_buffer = memoryview(self._bin_buffer_mmap)
+            self._sizes = np.frombuffer(self._bin_buffer, dtype=np.int32, count=self._len, offset=offset)
+            self._pointers = np.frombuffer(self._bin_buffer, dtype=np.int64, count=self._len,
+                                           offset=offset + self._sizes.nbytes)
+            self._scale, self._zero_point = None, None
+            if self._feature_format == 'int8':
+                offset += self._sizes.nbytes + self._pointers.nbytes
+                self._scale = np.frombuffer(self._bin_buffer, dtype=np.float32,
+                                            count=self._feature_dim, offset=offset)
+                self._zero_point = np.frombuffer(self._bin_buffer, dtype=np.float32,
+                                                 count=self._feature_dim,
+                                                 offset=offset + self._scale.nbytes)
+
+        @property
+        def dtype(self):
+            return self._dtype
+
+        @property
+        def feature_format(self):
+            return self._feature_format
+
+        @property
+        def scale(self):
+            return self._scale
+
+        @property
+        def zero_point(self):
+            return self._zero_point
+
+        @property
+        def feature_dim(self):
+            return self._feature_dim
+
+        @property
+        def sizes(self):
+            return self._sizes
+
+        @property
+        def pointers(self):
+            return self._pointers
+
+        def __getitem__(self, i):
+            return self._pointers[i], self._sizes[i]
+
+        def __len__(self):
+            return self._len
+
+    def __init__(self, path):
+        super().__init__()
+
+        self._path = None
+        self._index = None
+        self._bin_buffer = None
+
+        self._do_init(path)
+
+    def __getstate__(self):
+        return self._path
+
+    def __setstate__(self, state):
+        self._do_init(state)
+
+    def _do_init(self, path):
+        self._path = path
+        self._index = self.Index(index_file_path(self._path))
+
+        # copy-on-write keeps the returned views writable (as torch expects)
+        # without ever writing back to, or eagerly reading, the data file
+        self._bin_buffer_mmap = np.memmap(data_file_path(self._path), mode='c', order='C')
+        self._bin_buffer = memoryview(self._bin_buffer_mmap)
+
+        if self._index.feature_format == 'int8':
+            self._scale = torch.from_numpy(self._index.scale.copy())
+            self._zero_point = torch.from_numpy(self._index.zero_point.copy())
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, i):
+        ptr, size = self._index[i]
+        np_array = np.frombuffer(
+            self._bin_buffer, dtype=self._index.dtype,
+            count=size * self._index.feature_dim, offset=ptr,
+        )
+        item = torch.from_numpy(np_array).view(size, self._index.feature_dim)
+        if self._index.feature_format == 'bfloat16':
+            item = item.view(torch.bfloat16)
+        return item
+
+    def take(self, indices, out=None):
+        """Gather the items at *indices* into one ``(len(indices),
+        num_regions, feature_dim)`` tensor (or into *out*), where
+        *num_regions* is the largest number of regions among them. Shorter
+        items are padded, and indices equal to :data:`MISSING_IMAGE` filled,
+        with the encoding of all-zero features.
+
+        If the items have the same number of regions, the store is viewed as
+        an array of equally sized items, so the gather is a single vectorized
+        fancy-index into the mapping.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        missing = indices == MISSING_IMAGE
+        indices = np.where(missing, 0, indices)
+        sizes = np.where(missing, 0, self._index.sizes[indices])
+        num_regions = int(sizes.max()) if len(indices) > 0 else 0
+        shape = (len(indices), num_regions, self._index.feature_dim)
+        if out is None:
+            out = torch.from_numpy(np.empty(shape, dtype=self._index.dtype))
+            if self._index.feature_format == 'bfloat16':
+                out = out.view(torch.bfloat16)
+        assert out.size() == shape and out.is_contiguous()
+        if num_regions == 0:
+            # no items, or only missing images and images without regions
+            return out
+
+        item_len = num_regions * self._index.feature_dim
+        item_bytes = item_len * np.dtype(self._index.dtype).itemsize
+        pointers = self._index.pointers[indices]
+        np_out = (out.view(torch.int16) if out.dtype == torch.bfloat16 else out).numpy()
+        if (sizes[~missing] == num_regions).all() and (pointers % item_bytes == 0).all():
+            table = np.frombuffer(
+                self._bin_buffer, dtype=self._index.dtype,
+                count=(len(self._bin_buffer) // item_bytes) * item_len,
+            ).reshape(-1, num_regions, self._index.feature_dim)
+            # mode='clip' writes straight into out instead of buffering
+            np.take(table, pointers // item_bytes, axis=0, out=np_out, mode='clip')
+        else:
+            for i in np.flatnonzero(~missing):
+                np_out[i, :sizes[i]] = np.frombuffer(
+                    self._bin_buffer, dtype=self._index.dtype,
+                    count=sizes[i] * self._index.feature_dim, offset=pointers[i],
+                ).reshape(sizes[i], self._index.feature_dim)
+        # int8 features encode zero as their zero-point
+        pad_regions(np_out, sizes, self._index.zero_point if self._index.feature_format == 'int8' else 0)
+        return out
+
+    def dequantize(self, features, dtype=torch.float32):
+        """Convert features read from this store (or a batch of them, with
+        channels in the last dimension) to *dtype*, on their own device."""
+        if self._index.feature_format != 'int8':
+            return features.to(dtype)
+        scale = self._scale.to(device=features.device, dtype=dtype)
+        zero_point = self._zero_point.to(device=features.device, dtype=dtype)
+        return (features.to(dtype) - zero_point) * scale
+
+    @property
+    def sizes(self):
+        return self._index.sizes
+
+    @property
+    def feature_dim(self):
+        return self._index.feature_dim
+
+    @property
+    def feature_format(self):
+        return self._index.feature_format
+
+    @property
+    def supports_prefetch(self):
+        return False
+
+    @staticmethod
+    def exists(path):
+        return (
+            os.path.exists(index_file_path(path)) and os.path.exists(data_file_path(path))
+        )
+
+
+class MMapImageFeatureDatasetBuilder(object):
+    def __init__(self, out_file, feature_dim, feature_format='float32', scale=None, zero_point=None):
+        assert feature_format != 'int8' or (scale is not None and zero_point is not None), \
+            'int8 features require per-channel scale and zero_point tables'
+        self._data_file = open(out_file, 'wb')
+        self._feature_format = feature_format
+        self._feature_dim = feature_dim
+        self._scale = scale
+        self._zero_point = zero_point
+        self._sizes = []
+
+    def add_item(self, tensor):
+        np_array = encode_features(
+            np.asarray(tensor, dtype=np.float32).reshape(-1, self._feature_dim),
+            self._feature_format, self._scale, self._zero_point,
+        )
+        self._data_file.write(np_array.tobytes(order='C'))
+        self._sizes.append(np_array.shape[0])
+
+    def merge_file_(self, another_file):
+        # Concatenate index
+        index = MMapImageFeatureDataset.Index(index_file_path(another_file))
+        assert index.feature_format == self._feature_format
+        assert index.feature_dim == self._feature_dim
+        if self._feature_format == 'int8':
+            assert np.array_equal(index.scale, self._scale)
+            assert np.array_equal(index.zero_point, self._zero_point)
+
+        for size in index.sizes:
+            self._sizes.append(size)
+
+        # Concatenate data
+        with open(data_file_path(another_file), 'rb') as f:
+            shutil.copyfileobj(f, self._data_file)
+
+    def finalize(self, index_file):
+        self._data_file.close()
+
+        with MMapImageFeatureDataset.Index.writer(
+            index_file, self._feature_format, self._feature_dim,
+        ) as index:
+            index.write(self._sizes)
+            if self._feature_format == 'int8':
+                index.write_quantization_params(self._scale, self._zero_point)
+
+
+def binarize_image_features(features, output_prefix, feature_dim, feature_format='float32', indices=None):
+    """Write a sequence of ``(num_regions, feature_dim)`` float arrays (e.g.,
+    a :class:`NumpyImageFeatureDataset`), or only the items at *indices* of
+    it, to the store at *output_prefix*, one item at a time."""
+    if indices is None:
+        indices = range(len(features))
+    scale, zero_point = None, None
+    if feature_format == 'int8':
+        scale, zero_point = compute_quantization_params(features, feature_dim, indices)
+    builder = MMapImageFeatureDatasetBuilder(
+        data_file_path(output_prefix), feature_dim, feature_format, scale, zero_point,
+    )
+    for i in indices:
+        builder.add_item(features[i])
+    builder.finalize(index_file_path(output_prefix))
+    return len(indices)
+
+
+@torch.no_grad()
+def binarize_image_projections(features, output_prefix, projections, batch_size=256):
+    """Project every item of an image feature dataset by each of
+    *projections* and write the results, concatenated along the feature
+    dimension, to a float32 store at *output_prefix*.
+
+    The store is written under a temporary name and moved into place once
+    complete, so an interrupted run never leaves a partial cache behind.
+
+    Blank (all-zero) images are cached as zeros rather than projected, so
+    that the encoder still skips the image stream for them.
+    """
+    store = unwrap_image_feature_dataset(features)
+    device = projections[0].weight.device
+    feature_dim = sum(proj.out_features for proj in projections)
+    tmp_prefix = output_prefix + '.tmp'
+    builder = MMapImageFeatureDatasetBuilder(data_file_path(tmp_prefix), feature_dim)
+    for start in range(0, len(features), batch_size):
+        items = [features[i] for i in range(start, min(start + batch_size, len(features)))]
+        x = store.dequantize(torch.cat(items)).to(device)
+        y = torch.cat([proj(x.type_as(proj.weight)).float() for proj in projections], dim=-1)
+        sizes = [len(item) for item in items]
+        for item, projected in zip(x.split(sizes), y.cpu().split(sizes)):
+            if not item.ne(0).any():
+                projected = projected.new_zeros(projected.size())
+            builder.add_item(projected)
+    builder.finalize(index_file_path(tmp_prefix))
+    os.replace(data_file_path(tmp_prefix), data_file_path(output_prefix))
+    os.replace(index_file_path(tmp_prefix), index_file_path(output_prefix))
+
+
+class NumpyImageFeatureDataset(torch.utils.data.Dataset):
+    """Legacy ``<prefix>.npy`` image features of shape ``(N, H, W, C)`` (or
+    ``(N, R, C)``), memory-mapped instead of being loaded eagerly.
+
+    Pickled object arrays cannot be mapped and are loaded into memory. Their
+    items may have different numbers of regions, e.g. ``(R_i, C)`` arrays of
+    object detector regions.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self._path = None
+        self._do_init(path)
+
+    def __getstate__(self):
+        return self._path
+
+    def __setstate__(self, state):
+        self._do_init(state)
+
+    def _do_init(self, path):
+        self._path = path
+        try:
+            self._array = np.load(path, mmap_mode='c')
+        except ValueError:
+            # object arrays can only be unpickled
+            items = list(np.load(path, allow_pickle=True))
+            if len(set(np.shape(item) for item in items)) <= 1:
+                self._array = np.stack(items)
+            else:
+                self._array = [np.asarray(item, dtype=np.float32) for item in items]
+        if isinstance(self._array, np.ndarray):
+            self._feature_dim = self._array.shape[-1]
+            num_regions = int(np.prod(self._array.shape[1:-1]))
+            self._sizes = np.full(len(self._array), num_regions, dtype=np.int32)
+        else:
+            self._feature_dim = self._array[0].shape[-1]
+            self._sizes = np.array([item.size // self._feature_dim for item in self._array], dtype=np.int32)
+
+    def __len__(self):
+        return len(self._array)
+
+    def __getitem__(self, i):
+        return torch.from_numpy(self._array[i]).reshape(-1, self._feature_dim)
+
+    def take(self, indices, out=None):
+        """Gather the items at *indices* into one ``(len(indices),
+        num_regions, feature_dim)`` tensor (or into *out*) with a single
+        vectorized fancy-index. Indices equal to :data:`MISSING_IMAGE` give
+        all-zero features, as do the padded regions of items with fewer
+        regions than others."""
+        if not isinstance(self._array, np.ndarray):
+            return _take_items(self, indices, out, 0)
+        indices = np.asarray(indices, dtype=np.int64)
+        missing = indices == MISSING_IMAGE
+        table = self._array.reshape(len(self._array), -1, self._feature_dim)
+        if out is None:
+            out = torch.from_numpy(table[np.where(missing, 0, indices)])
+        else:
+            np.take(table, np.where(missing, 0, indices), axis=0, out=out.numpy(), mode='clip')
+        out[torch.from_numpy(missing)] = 0
+        return out
+
+    def dequantize(self, features, dtype=torch.float32):
+        return features.to(dtype)
+
+    @property
+    def sizes(self):
+        return self._sizes
+
+    @property
+    def feature_dim(self):
+        return self._feature_dim
+
+    @property
+    def feature_format(self):
+        return 'float32'
+
+    @property
+    def memory_mapped(self):
+        """Whether the features are mapped from the file rather than loaded
+        (pickled object arrays are loaded)."""
+        return isinstance(self._array, np.memmap)
+
+    @property
+    def supports_prefetch(self):
+        return False
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path)
+
+
+class ListImageFeatureDataset(torch.utils.data.Dataset):
+    """Image features held in memory as a list of ``(num_regions,
+    feature_dim)`` tensors, e.g. the images of live translation requests
+    (see :class:`ImageFeatureStore`)."""
+
+    def __init__(self, features):
+        super().__init__()
+        self._features = list(features)
+        self._feature_dim = self._features[0].size(-1)
+        self._sizes = np.array([len(item) for item in self._features], dtype=np.int32)
+
+    def __len__(self):
+        return len(self._features)
+
+    def __getitem__(self, i):
+        return self._features[i]
+
+    def dequantize(self, features, dtype=torch.float32):
+        return features.to(dtype)
+
+    @property
+    def sizes(self):
+        return self._sizes
+
+    @property
+    def feature_dim(self):
+        return self._feature_dim
+
+    @property
+    def feature_format(self):
+        return 'float32'
+
+    @property
+    def supports_prefetch(self):
+        return False
+
+
+class ImageFeatureStore(object):
+    """Resolve the image of a translation request to its ``(num_regions,
+    feature_dim)`` float32 features.
+
+    An integer id (or a string of digits) is a row of the image features of
+    the text dataset at *path* (e.g., 'data-bin/test.en-de.en', see
+    :func:`~fairseq.data.data_utils.load_img_features`); any other string is
+    the path of a ``.npy`` file with the features of one image. An empty id
+    or ``None`` is a sentence without an image. Raises ``ValueError`` for
+    an image that cannot be resolved.
+    """
+
+    def __init__(self, path=None):
+        from fairseq.data import data_utils
+
+        self.dataset = data_utils.load_img_features(path) if path is not None else None
+
+    def __call__(self, image):
+        if image is None or image == '':
+            return None
+        if isinstance(image, int) or image.isdigit():
+            if self.dataset is None:
+                raise ValueError('image id {} given without an image feature store'.format(image))
+            if int(image) >= len(self.dataset):
+                raise ValueError('image id {} is out of range, the store has {} images'.format(
+                    image, len(self.dataset),
+                ))
+            store = unwrap_image_feature_dataset(self.dataset)
+            return store.dequantize(self.dataset[int(image)])
+        try:
+            features = torch.from_numpy(np.load(image)).float()
+        except (OSError, ValueError) as e:
+            raise ValueError('cannot load image features from {}: {}'.format(image, e))
+        if self.dataset is not None and features.size(-1) != self.dataset.feature_dim:
+            raise ValueError('image features of {} have dimension {}, expected {}'.format(
+                image, features.size(-1), self.dataset.feature_dim,
+            ))
+        return features.reshape(-1, features.size(-1))
@@ -10,6 +10,8 @@ import os
 import numpy as np
 import torch
 
+from fairseq import utils
+
 from . import data_utils
 
 
@@ -166,11 +168,15 @@ class EpochBatchIterator(EpochBatchIterating):
             (default: 0).
         epoch (int, optional): the epoch to start the iterator from
             (default: 0).
+        prefetch_to_device (bool, optional): collate batches into pinned
+            memory and copy each one to the current GPU while the previous
+            one is being consumed, see :class:`DevicePrefetchIterator`
+            (default: False).
     """
 
     def __init__(
         self, dataset, collate_fn, batch_sampler, seed=1, num_shards=1, shard_id=0,
-        num_workers=0, epoch=0,
+        num_workers=0, epoch=0, prefetch_to_device=False,
     ):
         assert isinstance(dataset, torch.utils.data.Dataset)
         self.dataset = dataset
@@ -180,6 +186,7 @@ class EpochBatchIterator(EpochBatchIterating):
         self.num_shards = num_shards
         self.shard_id = shard_id
         self.num_workers = num_workers
+        self.prefetch_to_device = prefetch_to_device
 
         self.epoch = epoch
         self.shuffle = True
@@ -280,15 +287,69 @@ class EpochBatchIterator(EpochBatchIterating):
         if self.num_workers > 0:
             os.environ['PYTHONWARNINGS'] = 'ignore:semaphore_tracker:UserWarning'
 
-        return CountingIterator(
-            torch.utils.data.DataLoader(
-                self.dataset,
-                collate_fn=self.collate_fn,
-                batch_sampler=batches[offset:],
-                num_workers=self.num_workers,
-            ),
-            start=offset,
+        itr = torch.utils.data.DataLoader(
+            self.dataset,
+            collate_fn=self.collate_fn,
+            batch_sampler=batches[offset:],
+            num_workers=self.num_workers,
+            pin_memory=self.prefetch_to_device,
         )
+        if self.prefetch_to_device:
+            itr = DevicePrefetchIterator(itr)
+        return CountingIterator(itr, start=offset)
+
+
+class DevicePrefetchIterator(object):
+    """Wrapper around an iterable of (pinned) CPU batches that copies the
+    next batch to the current GPU on a side stream, so that the copy overlaps
+    with the computation on the current one.
+
+    One extra batch is kept on the GPU.
+
+    Args:
+        iterable (iterable): iterable to wrap
+    """
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.itr = None
+        self.stream = None
+        self._next = None
+
+    def __len__(self):
+        return len(self.iterable)
+
+    def __iter__(self):
+        self.itr = iter(self.iterable)
+        self.stream = torch.cuda.Stream()
+        self._preload()
+        return self
+
+    def _preload(self):
+        try:
+            sample = next(self.itr)
+        except StopIteration:
+            self._next = None
+            return
+        with torch.cuda.stream(self.stream):
+            self._next = (utils.move_to_cuda(sample, non_blocking=True), )
+
+    def __next__(self):
+        if self.itr is None:
+            iter(self)
+        if self._next is None:
+            raise StopIteration
+        torch.cuda.current_stream().wait_stream(self.stream)
+        sample = self._next[0]
+
+        # the memory was allocated on the side stream, but is used on this one
+        def record_stream(t):
+            t.record_stream(torch.cuda.current_stream())
+            return t
+
+        utils.apply_to_sample(record_stream, sample)
+        self._preload()
+        return sample
 
 
 class GroupedIterator(object):
@@ -8,7 +8,7 @@ import logging
 import numpy as np
 import torch
 
-from . import data_utils, FairseqDataset
+from . import data_utils, FairseqDataset, image_feature_dataset
 
 
 logger = logging.getLogger(__name__)
@@ -16,7 +16,7 @@ logger = logging.getLogger(__name__)
 
 def collate(
     samples, pad_idx, eos_idx, left_pad_source=True, left_pad_target=False,
-    input_feeding=True,
+    input_feeding=True, take_img_features=None, pin_memory=False,
 ):
     if len(samples) == 0:
         return {}
@@ -39,6 +39,28 @@ def collate(
             [s[key] for s in samples], src_len
         )
 
+    def merge_img_features(sort_order, sorted_id):
+        img_lengths = torch.LongTensor([
+            0 if s['src_img_features'] is None else s['src_img_features'].size(0) for s in samples
+        ]).index_select(0, sort_order)
+        elem = next((s['src_img_features'] for s in samples if s['src_img_features'] is not None), None)
+        if elem is None:
+            # no example of the batch has an image
+            return None, None
+        # gather straight into the batch, already in sorted order and padded
+        # to the most regions in it; examples without an image get all-zero
+        # features
+        out = data_utils.new_batch_buffer(
+            (len(samples), img_lengths.max().item(), elem.size(-1)), elem.dtype, pin_memory,
+        )
+        if take_img_features is not None:
+            return take_img_features(sorted_id.numpy(), out), img_lengths
+        out.zero_()
+        for i, j in enumerate(sort_order.tolist()):
+            if samples[j]['src_img_features'] is not None:
+                out[i, :img_lengths[i]].copy_(samples[j]['src_img_features'])
+        return out, img_lengths
+
     def check_alignment(alignment, src_len, tgt_len):
         if alignment is None or len(alignment) == 0:
             return False
@@ -70,7 +92,6 @@ def collate(
     # print('samples3:', samples[3]['src_img_features'].size())
     # print('src_tokens:', src_tokens.size())
 
-    src_img_features = torch.cat([s['src_img_features'].unsqueeze(0) for s in samples], dim=0)
     # multimodel_graph = multigraph_merge('bpe_txt_relations', 'img_txt_relations', src_lengths)
 
     # source_graphs = graph_merge('src_img_features', src_lengths)
@@ -78,7 +99,7 @@ def collate(
     src_lengths, sort_order = src_lengths.sort(descending=True)
     id = id.index_select(0, sort_order)
     src_tokens = src_tokens.index_select(0, sort_order)
-    src_img_features = src_img_features.index_select(0, sort_order)
+    src_img_features, src_img_lengths = merge_img_features(sort_order, id)
     # multimodel_graph = multimodel_graph.index_select(0, sort_order)
     # print('source_graph', source_graphs.size())
 
@@ -110,6 +131,7 @@ def collate(
             'src_tokens': src_tokens,
             'src_lengths': src_lengths,
             'src_img_features': src_img_features,
+            'src_img_lengths': src_img_lengths,
             # 'multimodel_graph':multimodel_graph
         },
         'target': target,
@@ -176,6 +198,17 @@ class LanguagePairDataset(FairseqDataset):
             containing alignments.
         append_bos (bool, optional): if set, appends bos to the beginning of
             source/target sentence.
+        src_img_index (np.ndarray, optional): maps each example to an entry
+            of *src_img_features*, for tables that store each distinct image
+            only once, or to :data:`~image_feature_dataset.MISSING_IMAGE` for
+            examples without an image (default: identity).
+        pin_memory (bool, optional): collate image features into pinned
+            memory when collating in the main process (default: False).
+        img_region_cost (float, optional): number of text tokens that each
+            image region counts as towards ``--max-tokens`` (default: 0).
+        img_mask_cost (float, optional): number of text tokens that each
+            pair of image regions counts as towards ``--max-tokens``, for
+            the text2image masks and the image attention (default: 0).
     """
 
     def __init__(
@@ -189,7 +222,10 @@ class LanguagePairDataset(FairseqDataset):
         shuffle=True, input_feeding=True,
         remove_eos_from_source=False, append_eos_to_target=False,
         align_dataset=None,
-        append_bos=False
+        append_bos=False,
+        src_img_index=None,
+        pin_memory=False,
+        img_region_cost=0., img_mask_cost=0.,
     ):
         if tgt_dict is not None:
             assert src_dict.pad() == tgt_dict.pad()
@@ -202,6 +238,11 @@ class LanguagePairDataset(FairseqDataset):
         self.src_dict = src_dict
         self.tgt_dict = tgt_dict
         self.src_img_features = src_img_features
+        self.src_img_index = src_img_index
+        self.src_img_sizes = self._img_sizes(src_img_features, src_img_index)
+        self.img_region_cost = img_region_cost
+        self.img_mask_cost = img_mask_cost
+        self.pin_memory = pin_memory
         # self.bpe_txt_relations = bpe_txt_relations
         # self.img_txt_relations = img_txt_relations
         self.left_pad_source = left_pad_source
@@ -217,10 +258,27 @@ class LanguagePairDataset(FairseqDataset):
             assert self.tgt_sizes is not None, "Both source and target needed when alignments are provided"
         self.append_bos = append_bos
 
+    @staticmethod
+    def _img_sizes(src_img_features, src_img_index):
+        """Return the number of image regions of each example, 0 for
+        examples without an image."""
+        sizes = getattr(src_img_features, 'sizes', None)
+        if sizes is None:
+            return None
+        sizes = np.asarray(sizes)
+        if src_img_index is None:
+            return sizes
+        missing = src_img_index == image_feature_dataset.MISSING_IMAGE
+        return np.where(missing, 0, sizes[np.where(missing, 0, src_img_index)])
+
     def __getitem__(self, index):
         tgt_item = self.tgt[index] if self.tgt is not None else None
         src_item = self.src[index]
-        src_img_features_item = self.src_img_features[index]
+        img_index = self.src_img_index[index] if self.src_img_index is not None else index
+        if self.src_img_features is None or img_index == image_feature_dataset.MISSING_IMAGE:
+            src_img_features_item = None
+        else:
+            src_img_features_item = self.src_img_features[img_index]
         # bpe_txt_relations_item = self.bpe_txt_relations[index]
         # img_txt_relations_item = self.img_txt_relations[index]
         # Append EOS to end of tgt sentence if it does not have an EOS and remove
@@ -279,6 +337,16 @@ class LanguagePairDataset(FairseqDataset):
                     appear on the left if *left_pad_source* is ``True``.
                   - `src_lengths` (LongTensor): 1D Tensor of the unpadded
                     lengths of each source sentence of shape `(bsz)`
+                  - `src_img_features` (Tensor): image features of shape
+                    `(bsz, num_regions, feature_dim)`, padded to the most
+                    regions in the batch, all-zero for examples without an
+                    image, or ``None`` if no example has one
+                  - `src_img_lengths` (LongTensor): 1D Tensor of the number
+                    of regions of each example of shape `(bsz)` (0 without
+                    an image), or ``None`` if no example has an image
+                  - `src_img_batch` (LongTensor): 1D Tensor of the indices
+                    of the examples with an image that is not all-zero; only
+                    present if *src_img_features* is not ``None``
                   - `prev_output_tokens` (LongTensor): a padded 2D Tensor of
                     tokens in the target sentence, shifted right by one
                     position for teacher forcing, of shape `(bsz, tgt_len)`.
@@ -290,16 +358,61 @@ class LanguagePairDataset(FairseqDataset):
                   target sentence of shape `(bsz, tgt_len)`. Padding will appear
                   on the left if *left_pad_target* is ``True``.
         """
-        return collate(
+        batch = collate(
             samples, pad_idx=self.src_dict.pad(), eos_idx=self.src_dict.eos(),
             left_pad_source=self.left_pad_source, left_pad_target=self.left_pad_target,
             input_feeding=self.input_feeding,
+            take_img_features=self._take_img_features if self.src_img_features is not None else None,
+            pin_memory=self.pin_memory,
         )
+        # float16/bfloat16 features are upcast by the model after the
+        # host-to-device copy, int8 ones need their scale/zero-point tables
+        img_store = image_feature_dataset.unwrap_image_feature_dataset(self.src_img_features)
+        if (
+            'net_input' in batch and batch['net_input']['src_img_features'] is not None
+            and getattr(img_store, 'feature_format', None) == 'int8'
+        ):
+            batch['net_input']['src_img_features'] = img_store.dequantize(
+                batch['net_input']['src_img_features']
+            )
+        if 'net_input' in batch and batch['net_input']['src_img_features'] is not None:
+            # the sentences with an image, i.e. not all-zero features, found
+            # on the CPU so that the model does not sync with the device
+            has_image = batch['net_input']['src_img_features'].flatten(1).ne(0).any(dim=1)
+            batch['net_input']['src_img_batch'] = has_image.nonzero().squeeze(1)
+        return batch
+
+    def _take_img_features(self, indices, out):
+        if self.src_img_index is not None:
+            indices = self.src_img_index[indices]
+        return image_feature_dataset.take(self.src_img_features, indices, out=out)
 
     def num_tokens(self, index):
         """Return the number of tokens in a sample. This value is used to
-        enforce ``--max-tokens`` during batching."""
-        return max(self.src_sizes[index], self.tgt_sizes[index] if self.tgt_sizes is not None else 0)
+        enforce ``--max-tokens`` during batching.
+
+        The image of the sample counts as a number of tokens too, see
+        :func:`img_cost`."""
+        return self.num_tokens_vec(np.array([index]))[0]
+
+    def num_tokens_vec(self, indices):
+        """Return the number of tokens of the samples at *indices*, as with
+        :func:`num_tokens`."""
+        sizes = self.src_sizes[indices]
+        if self.tgt_sizes is not None:
+            sizes = np.maximum(sizes, self.tgt_sizes[indices])
+        if self.src_img_sizes is not None:
+            sizes = sizes + self.img_cost(self.src_img_sizes[indices])
+        return sizes.astype(np.int64)
+
+    def img_cost(self, num_regions):
+        """Return the number of text tokens that images with *num_regions*
+        regions count as: their regions go through the image encoders
+        (*img_region_cost* each), and pairs of them through the text2image
+        masks and the image attention (*img_mask_cost* each)."""
+        num_regions = np.asarray(num_regions, dtype=np.float64)
+        cost = self.img_region_cost * num_regions + self.img_mask_cost * num_regions ** 2
+        return np.ceil(cost).astype(np.int64)
 
     def size(self, index):
         """Return an example's size as a float or tuple. This value is used when
@@ -313,6 +426,8 @@ class LanguagePairDataset(FairseqDataset):
             indices = np.random.permutation(len(self))
         else:
             indices = np.arange(len(self))
+        if self.src_img_sizes is not None:
+            indices = indices[np.argsort(self.src_img_sizes[indices], kind='mergesort')]
         if self.tgt_sizes is not None:
             indices = indices[np.argsort(self.tgt_sizes[indices], kind='mergesort')]
         return indices[np.argsort(self.src_sizes[indices], kind='mergesort')]
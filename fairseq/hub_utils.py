@@ -5,10 +5,13 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import functools
 import logging
 import os
-from typing import List, Dict, Iterator, Tuple, Any
+from typing import List, Dict, Iterator, Optional, Tuple, Any
 
 import torch
 from torch import nn
@@ -145,6 +148,7 @@ class GeneratorHubInterface(nn.Module):
         beam: int = 5,
         verbose: bool = False,
         skip_invalid_size_inputs=False,
+        src_img_features: Optional[List[Optional[torch.Tensor]]] = None,
         **kwargs
     ) -> List[List[Dict[str, torch.Tensor]]]:
         if torch.is_tensor(tokenized_sentences) and tokenized_sentences.dim() == 1:
@@ -160,7 +164,7 @@ class GeneratorHubInterface(nn.Module):
         generator = self.task.build_generator(gen_args)
 
         results = []
-        for batch in self._build_batches(tokenized_sentences, skip_invalid_size_inputs):
+        for batch in self._build_batches(tokenized_sentences, skip_invalid_size_inputs, src_img_features):
             batch = utils.apply_to_sample(lambda t: t.to(self.device), batch)
             translations = self.task.inference_step(generator, self.models, batch)
             for id, hypos in zip(batch["id"].tolist(), translations):
@@ -226,11 +230,16 @@ class GeneratorHubInterface(nn.Module):
         return self.tgt_dict.string(tokens)
 
     def _build_batches(
-        self, tokens: List[List[int]], skip_invalid_size_inputs: bool
+        self, tokens: List[List[int]], skip_invalid_size_inputs: bool,
+        src_img_features: Optional[List[Optional[torch.Tensor]]] = None,
     ) -> Iterator[Dict[str, Any]]:
         lengths = torch.LongTensor([t.numel() for t in tokens])
+        if src_img_features is not None and any(f is not None for f in src_img_features):
+            dataset = self.task.build_dataset_for_inference(tokens, lengths, src_img_features=src_img_features)
+        else:
+            dataset = self.task.build_dataset_for_inference(tokens, lengths)
         batch_iterator = self.task.get_batch_iterator(
-            dataset=self.task.build_dataset_for_inference(tokens, lengths),
+            dataset=dataset,
             max_tokens=self.args.max_tokens,
             max_sentences=self.args.max_sentences,
             max_positions=self.max_positions,
@@ -239,6 +248,123 @@ class GeneratorHubInterface(nn.Module):
         return batch_iterator
 
 
+class BatchingHubInterface(object):
+    """asyncio interface that coalesces concurrent requests to a
+    :class:`GeneratorHubInterface` into batches.
+
+    Requests are bucketed by source length (*bucket_width* tokens per bucket).
+    Batches run one at a time on a dedicated executor thread, so the event
+    loop keeps accepting requests meanwhile. Whenever the executor is idle,
+    it is given the bucket with the oldest request among those that hold
+    *max_sentences* sentences or *max_tokens* padded tokens, or whose oldest
+    request has waited *max_wait* seconds. Under load, buckets thus keep
+    filling while the previous batch decodes.
+
+    Args:
+        hub (GeneratorHubInterface): the model to translate with
+        beam (int, optional): beam size (default: 5)
+        max_tokens (int, optional): max number of padded source tokens in a
+            batch
+        max_sentences (int, optional): max number of sentences in a batch
+            (default: 64)
+        max_wait (float, optional): seconds that a request waits for others
+            of its bucket (default: 0.005)
+        bucket_width (int, optional): width of the source length buckets, in
+            tokens (default: 8)
+        **kwargs: other generation options, e.g. ``lenpen``
+    """
+
+    def __init__(
+        self, hub, beam=5, max_tokens=None, max_sentences=64, max_wait=0.005, bucket_width=8, **kwargs
+    ):
+        self.hub = hub
+        self.max_tokens = max_tokens
+        self.max_sentences = max_sentences
+        self.max_wait = max_wait
+        self.bucket_width = bucket_width
+        self.gen_kwargs = dict(beam=beam, **kwargs)
+        self.max_positions = (
+            hub.max_positions[0] if isinstance(hub.max_positions, tuple) else hub.max_positions
+        )
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batch_sizes = []
+        self._buckets = {}
+        self._busy = False
+
+    async def translate(self, sentence: str, src_img_features: Optional[torch.Tensor] = None) -> str:
+        hypos = await self.generate(self.hub.encode(sentence), src_img_features)
+        return self.hub.decode(hypos[0]['tokens'])
+
+    async def generate(
+        self, tokens: torch.LongTensor, src_img_features: Optional[torch.Tensor] = None,
+    ) -> List[Dict[str, torch.Tensor]]:
+        """Return the hypotheses of the source sentence *tokens* (and the
+        ``(num_regions, feature_dim)`` features of its image)."""
+        if self.max_positions is not None and tokens.numel() > self.max_positions:
+            raise ValueError('sentence has {} tokens, more than the max of {}'.format(
+                tokens.numel(), self.max_positions,
+            ))
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        bucket = self._buckets.setdefault(tokens.numel() // self.bucket_width, [])
+        bucket.append((tokens, src_img_features, future, loop.time()))
+        if len(bucket) == 1:
+            loop.call_later(self.max_wait, self._schedule)
+        self._schedule()
+        return await future
+
+    def _batch_size(self, bucket):
+        """Return the number of requests of *bucket* that fit in a batch."""
+        n = len(bucket) if self.max_sentences is None else min(len(bucket), self.max_sentences)
+        if self.max_tokens is not None:
+            max_len = 0
+            for i, (tokens, _, _, _) in enumerate(bucket[:n]):
+                max_len = max(max_len, tokens.numel())
+                if i > 0 and (i + 1) * max_len > self.max_tokens:
+                    return i
+        return n
+
+    def _is_ready(self, bucket, now):
+        return self._batch_size(bucket) < len(bucket) or (
+            self.max_sentences is not None and len(bucket) >= self.max_sentences
+        ) or bucket[0][3] + self.max_wait <= now
+
+    def _schedule(self):
+        """Send the next batch to the executor if it is idle."""
+        if self._busy:
+            return
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        ready = [key for key, bucket in self._buckets.items() if self._is_ready(bucket, now)]
+        if len(ready) == 0:
+            return
+        key = min(ready, key=lambda k: self._buckets[k][0][3])
+        bucket = self._buckets.pop(key)
+        n = self._batch_size(bucket)
+        if n < len(bucket):
+            self._buckets[key] = bucket[n:]
+            loop.call_at(bucket[n][3] + self.max_wait, self._schedule)
+        tokens, src_img_features, futures, _ = zip(*bucket[:n])
+        self.batch_sizes.append(n)
+        self._busy = True
+        generate = functools.partial(
+            self.hub.generate, list(tokens), src_img_features=list(src_img_features), **self.gen_kwargs
+        )
+        batch = loop.run_in_executor(self.executor, generate)
+        batch.add_done_callback(functools.partial(self._set_results, futures))
+
+    def _set_results(self, futures, batch):
+        self._busy = False
+        for i, future in enumerate(futures):
+            if future.cancelled():
+                continue
+            if batch.exception() is not None:
+                future.set_exception(batch.exception())
+            else:
+                future.set_result(batch.result()[i])
+        self._schedule()
+
+
 class BPEHubInterface(object):
     """PyTorch Hub interface for Byte-Pair Encoding (BPE)."""
 
@@ -256,6 +256,8 @@ class TransformerModel(FairseqEncoderDecoderModel):
         features_only: bool = False,
         alignment_layer: Optional[int] = None,
         alignment_heads: Optional[int] = None,
+        src_img_lengths: Optional[Tensor] = None,
+        src_img_batch: Optional[Tensor] = None,
     ):
         """
         Run the forward pass for an encoder-decoder model.
@@ -271,6 +273,8 @@ class TransformerModel(FairseqEncoderDecoderModel):
             # multimodel_graph=multimodel_graph,
             cls_input=cls_input,
             return_all_hiddens=return_all_hiddens,
+            src_img_lengths=src_img_lengths,
+            src_img_batch=src_img_batch,
         )
         decoder_out = self.decoder(
             prev_output_tokens,
@@ -357,9 +361,14 @@ EncoderOut = NamedTuple(
         ("encoder_out", Tensor),  # T x B x C
         ("encoder_padding_mask", Tensor),  # B x T
         ("encoder_embedding", Tensor),  # B x T x C
-        # ("txt_out", Tensor),
-        # ("img_out", Tensor),
         ("encoder_states", Optional[List[Tensor]]),  # List[T x B x C]
+        # mean of the final text states over the tokens (B x C), and of the
+        # final image states over the regions (B x C, zero without an image)
+        ("txt_summary", Optional[Tensor]),
+        ("img_summary", Optional[Tensor]),
+        # row of the tensors above that each hypothesis reads (B'), or None
+        # for one row per hypothesis, see TransformerEncoder.reindex_encoder_out
+        ("src_index", Optional[Tensor]),
     ],
 )
 
@@ -380,13 +389,18 @@ class TransformerEncoder(FairseqEncoder):
         self.register_buffer("version", torch.Tensor([3]))
 
         self.dropout = args.dropout
-        self.Gating = GatingMechanism(args)
         self.encoder_layerdrop = args.encoder_layerdrop
         embed_dim = embed_tokens.embedding_dim
         self.padding_idx = embed_tokens.padding_idx
         self.max_source_positions = args.max_source_positions
         self.img_feature_dim = args.img_feature_dim
         self.img_fc = Linear(self.img_feature_dim, embed_dim)
+        # set when the inputs are already projected by img_fc, see
+        # TranslationTask.load_img_projection_cache
+        self.img_proj_offset = None
+        # see set_gate_exit
+        self.gate_exit_threshold = None
+        self.gate_exit_per_sentence = False
         self.embed_tokens = embed_tokens
 
         self.embed_scale = 1.0 if args.no_scale_embedding else math.sqrt(embed_dim)
@@ -406,7 +420,7 @@ class TransformerEncoder(FairseqEncoder):
 
         self.layers = nn.ModuleList([])
         self.layers.extend(
-            [TransformerEncoderLayer(args) for i in range(args.encoder_layers)]
+            [TransformerEncoderLayer(args, layer_idx=i) for i in range(args.encoder_layers)]
         )
         self.num_layers = len(self.layers)
 
@@ -447,6 +461,8 @@ class TransformerEncoder(FairseqEncoder):
         # multimodel_graph,
         cls_input: Optional[Tensor] = None,
         return_all_hiddens: bool = False,
+        src_img_lengths: Optional[Tensor] = None,
+        src_img_batch: Optional[Tensor] = None,
     ):
 
         if self.layer_wise_attention:
@@ -457,41 +473,177 @@ class TransformerEncoder(FairseqEncoder):
         # B x T x C -> T x B x C
         x = x.transpose(0, 1)
 
-        src_img_features = self.img_fc(src_img_features)
+        # sentences without an image (missing, or with all-zero features)
+        # skip the image stream; the others are in img_batch, None for all.
+        # The collater finds them on the CPU (src_img_batch), so that the
+        # shapes alone tell whether every sentence has one
+        img_batch = None
+        if src_img_features is None:
+            img_batch = src_tokens.new_zeros(0)
+            src_img_features = x.new_zeros(0, 0, self.img_fc.out_features)
+            encoder_padding_mask_image = src_tokens.new_zeros(0, 0, dtype=torch.bool)
+        else:
+            if src_img_batch is None:
+                # found from the features, which syncs with the device
+                has_image = src_img_features.flatten(1).ne(0).any(dim=1)
+                if not has_image.all():
+                    img_batch = has_image.nonzero().squeeze(1)
+            elif src_img_batch.numel() < src_img_features.size(0):
+                img_batch = src_img_batch.to(src_img_features.device)
+            if img_batch is not None:
+                src_img_features = src_img_features.index_select(0, img_batch)
+                if src_img_lengths is not None:
+                    src_img_lengths = src_img_lengths.index_select(0, img_batch)
+            # images have different numbers of regions, padded with all-zero
+            # features; computed once for the image encoders of all the layers
+            if src_img_lengths is not None:
+                regions = torch.arange(src_img_features.size(1), device=src_img_lengths.device)
+                encoder_padding_mask_image = regions.unsqueeze(0) >= src_img_lengths.unsqueeze(1)
+            else:
+                encoder_padding_mask_image = src_img_features.eq(0).all(dim=-1)
+            if self.img_proj_offset is not None:
+                end = self.img_proj_offset + self.img_fc.out_features
+                src_img_features = src_img_features[..., self.img_proj_offset:end].type_as(self.img_fc.weight)
+            else:
+                # features may be stored in reduced precision (see --img-format)
+                src_img_features = self.img_fc(src_img_features.type_as(self.img_fc.weight))
 
-        src_img_features = src_img_features.transpose(0, 1)     # 49 * batch * dim
+        src_img_features = src_img_features.transpose(0, 1)     # regions * batch * dim
 
         batch_len = src_lengths[0].item()
 
         encoder_padding_mask = src_tokens.eq(self.padding_idx)
-        encoder_padding_mask_image = torch.sum(src_img_features, dim=-1).eq(0).transpose(0, 1)
 
         encoder_states = [] if return_all_hiddens else None
 
-        mask_matrix_tmp_tmp = torch.zeros(x.size(1), src_img_features.size(0), src_img_features.size(0)).eq(0)
-        for idx, layer in enumerate(self.layers):
-            # add LayerDrop (see https://arxiv.org/abs/1909.11556 for description)
-            mask_matrix_tmp = torch.zeros(x.size(1), src_img_features.size(0), src_img_features.size(0)).eq(0)
-            dropout_probability = torch.empty(1).uniform_()
-            if not self.training or (dropout_probability > self.encoder_layerdrop):
-                x, mask_matrix, src_img_features = layer(x, src_img_features, encoder_padding_mask,encoder_padding_mask_image, batch_len, idx, mask_matrix_tmp_tmp.cuda())
-                mask_matrix_tmp_tmp = torch.eq(mask_matrix, mask_matrix_tmp.cuda())
-                if return_all_hiddens:
-                    assert encoder_states is not None
-                    encoder_states.append(x)
+        # add LayerDrop (see https://arxiv.org/abs/1909.11556 for description)
+        layers = [
+            idx for idx in range(self.num_layers)
+            if not self.training or (torch.empty(1).uniform_() > self.encoder_layerdrop)
+        ]
+        src_img_features = self.forward_image_stream(src_img_features, encoder_padding_mask_image, layers)
+
+        # the text2image mask computed by a layer is consumed by the image
+        # encoder of the next one
+        num_regions = src_img_features.size(0)
+        mask_matrix_tmp_tmp = x.new_ones(1, 1, 1, dtype=torch.bool).expand(
+            src_img_features.size(1), num_regions, num_regions,
+        )
+        mask_is_buffer = False
+        gate_exit = not self.training and self.gate_exit_threshold is not None
+        for i, idx in enumerate(layers):
+            need_mask = i + 1 < len(layers) and self.layers[layers[i + 1]].uses_mask(layers[i + 1])
+            # masks are saved for backward, so they can only be overwritten in inference
+            reuse_mask = need_mask and mask_is_buffer and not torch.is_grad_enabled()
+            x, mask_matrix, src_img_features, gate = self.layers[idx](
+                x, src_img_features, encoder_padding_mask, encoder_padding_mask_image, batch_len, idx,
+                mask_matrix_tmp_tmp, need_mask=need_mask,
+                mask_out=mask_matrix_tmp_tmp if reuse_mask else None, img_batch=img_batch,
+            )
+            if mask_matrix is not None:
+                mask_matrix_tmp_tmp = mask_matrix
+                mask_is_buffer = True
+            if gate_exit and gate is not None:
+                padding_mask = encoder_padding_mask if img_batch is None else encoder_padding_mask[img_batch]
+                keep = self._gate_exit_keep(gate, padding_mask)
+                if not keep.all():
+                    # restrict the image stream to the sentences that keep it (see set_gate_exit)
+                    keep = keep.nonzero().squeeze(1)
+                    img_batch = keep if img_batch is None else img_batch[keep]
+                    src_img_features = src_img_features.index_select(1, keep)
+                    encoder_padding_mask_image = encoder_padding_mask_image.index_select(0, keep)
+                    mask_matrix_tmp_tmp = mask_matrix_tmp_tmp.index_select(0, keep)
+            if return_all_hiddens:
+                assert encoder_states is not None
+                encoder_states.append(x)
 
         if self.layer_norm is not None:
             x = self.layer_norm(x)
             if return_all_hiddens:
                 encoder_states[-1] = x
-                
+
+        txt_summary = self._mean(x, encoder_padding_mask)
+        img_summary = x.new_zeros(txt_summary.size())
+        if src_img_features.size(1) > 0:
+            img_mean = self._mean(src_img_features, encoder_padding_mask_image)
+            if img_batch is None:
+                img_summary = img_mean
+            else:
+                img_summary = img_summary.index_copy(0, img_batch, img_mean)
+
         return EncoderOut(
             encoder_out=x,  # T x B x C
             encoder_padding_mask=encoder_padding_mask,  # B x T
             encoder_embedding=encoder_embedding,  # B x T x C
             encoder_states=encoder_states,  # List[T x B x C]
+            txt_summary=txt_summary,  # B x C
+            img_summary=img_summary,  # B x C
+            src_index=None,
         )
 
+    @staticmethod
+    def _mean(x, padding_mask):
+        """Mean of *x* (T x B x C) over the positions that are not padding."""
+        x = x.masked_fill(padding_mask.t().unsqueeze(-1), 0.)
+        count = (~padding_mask).sum(dim=1, keepdim=True).clamp(min=1)
+        return x.sum(dim=0) / count.type_as(x)
+
+    def set_gate_exit(self, threshold: Optional[float], per_sentence: bool = False):
+        """Stop using the image in the remaining layers once the gating lets
+        little of it through, in inference.
+
+        After each layer with gating, the sentences whose gate (averaged over
+        their tokens) is below *threshold* skip the image encoder, the
+        text2image mask and the gating of the following layers, as if their
+        gate were zero. Unless *per_sentence* is set, the gate is averaged
+        over the batch, which skips the image stream as a whole.
+
+        Args:
+            threshold (float): gate threshold, or ``None`` to always use the
+                image
+            per_sentence (bool, optional): decide for each sentence rather
+                than for the batch (default: False)
+        """
+        self.gate_exit_threshold = threshold
+        self.gate_exit_per_sentence = per_sentence
+
+    def _gate_exit_keep(self, gate, encoder_padding_mask):
+        """Whether each sentence keeps using the image after a layer whose
+        gating produced *gate* (`(seq_len, batch, 1)`)."""
+        not_padding = ~encoder_padding_mask
+        gate = gate.squeeze(-1).t().float() * not_padding
+        if self.gate_exit_per_sentence:
+            gate_mean = gate.sum(dim=1) / not_padding.sum(dim=1)
+        else:
+            gate_mean = (gate.sum() / not_padding.sum()).expand(gate.size(0))
+        return gate_mean >= self.gate_exit_threshold
+
+    def forward_image_stream(self, src_img_features, encoder_padding_mask_image, layers):
+        """Run the image encoders of *layers* that do not use the text2image
+        mask, ahead of the text.
+
+        These only depend on the image stream, which the layers before the
+        first that :func:`~TransformerEncoderLayer.uses_mask` pass through
+        otherwise.
+
+        Args:
+            src_img_features (Tensor): `(num_regions, batch, embed_dim)`
+            encoder_padding_mask_image (BoolTensor): `(batch, num_regions)`
+            layers (List[int]): indices of the layers to run, in order
+
+        Returns:
+            the image stream as input to the first layer that uses the mask
+        """
+        if src_img_features.size(1) == 0:
+            return src_img_features
+        for idx in layers:
+            layer = self.layers[idx]
+            if layer.uses_mask(idx):
+                break
+            if layer.encodes_image(idx):
+                src_img_features = layer.image_encoder(idx, src_img_features, encoder_padding_mask_image, None)
+        return src_img_features
+
     def reorder_encoder_out(self, encoder_out, new_order):
         """
         Reorder encoder output according to *new_order*.
@@ -503,6 +655,9 @@ class TransformerEncoder(FairseqEncoder):
         Returns:
             *encoder_out* rearranged according to *new_order*
         """
+        if encoder_out.src_index is not None:
+            new_order = encoder_out.src_index.index_select(0, new_order)
+            encoder_out = encoder_out._replace(src_index=None)
         if encoder_out.encoder_out is not None:
             encoder_out = encoder_out._replace(
                 encoder_out=encoder_out.encoder_out.index_select(1, new_order)
@@ -520,10 +675,41 @@ class TransformerEncoder(FairseqEncoder):
                 )
             )
         if encoder_out.encoder_states is not None:
-            for idx, state in enumerate(encoder_out.encoder_states):
-                encoder_out.encoder_states[idx] = state.index_select(1, new_order)
+            encoder_out = encoder_out._replace(
+                encoder_states=[state.index_select(1, new_order) for state in encoder_out.encoder_states]
+            )
+        if encoder_out.txt_summary is not None:
+            encoder_out = encoder_out._replace(
+                txt_summary=encoder_out.txt_summary.index_select(0, new_order)
+            )
+        if encoder_out.img_summary is not None:
+            encoder_out = encoder_out._replace(
+                img_summary=encoder_out.img_summary.index_select(0, new_order)
+            )
         return encoder_out
 
+    def reindex_encoder_out(self, encoder_out, new_order):
+        """
+        Reorder encoder output according to *new_order* like
+        :func:`reorder_encoder_out`, without copying it: only the row that
+        each hypothesis reads (``src_index``) is updated, and
+        :class:`TransformerDecoder` gathers the rows when it attends to them.
+
+        Beam search reorders its hypotheses at every step, but the beam
+        copies of a sentence share the encoder output of that sentence, so
+        this costs O(len(new_order)) rather than O(len(new_order) * T * C).
+
+        Args:
+            encoder_out: output from the ``forward()`` method
+            new_order (LongTensor): desired order
+
+        Returns:
+            *encoder_out* indexed according to *new_order*
+        """
+        if encoder_out.src_index is not None:
+            new_order = encoder_out.src_index.index_select(0, new_order)
+        return encoder_out._replace(src_index=new_order)
+
     def max_positions(self):
         """Maximum input length supported by the encoder."""
         if self.embed_positions is None:
@@ -561,6 +747,10 @@ class TransformerEncoder(FairseqEncoder):
             self.layers[i].upgrade_state_dict_named(
                 state_dict, "{}.layers.{}".format(name, i)
             )
+        # earlier checkpoints have an unused gating in the encoder
+        prefix = "{}.Gating.".format(name)
+        for k in [k for k in state_dict.keys() if k.startswith(prefix)]:
+            del state_dict[k]
 
         version_key = "{}.version".format(name)
         if utils.item(state_dict.get(version_key, torch.Tensor([1]))[0]) < 2:
@@ -777,15 +967,24 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         attn: Optional[Tensor] = None
         inner_states: List[Optional[Tensor]] = [x]
         # print("encoder_out.encoder_padding_mask:", encoder_out.encoder_padding_mask)
+        # rows of the encoder output gathered for the hypotheses, see
+        # TransformerEncoder.reindex_encoder_out
+        gathered_state: Optional[Tensor] = None
+        gathered_padding_mask: Optional[Tensor] = None
         for idx, layer in enumerate(self.layers):
             encoder_state: Optional[Tensor] = None
-            if encoder_out is not None:
-                if self.layer_wise_attention:
-                    encoder_states = encoder_out.encoder_states
-                    assert encoder_states is not None
-                    encoder_state = encoder_states[idx]
-                else:
-                    encoder_state = encoder_out.encoder_out
+            encoder_padding_mask: Optional[Tensor] = None
+            # otherwise the layer attends to the keys and values it cached
+            if encoder_out is not None and self._reads_encoder_out(layer, incremental_state):
+                encoder_state, encoder_padding_mask = self._encoder_state(encoder_out, idx)
+                src_index = encoder_out.src_index
+                if src_index is not None:
+                    if gathered_state is not None and not self.layer_wise_attention:
+                        encoder_state, encoder_padding_mask = gathered_state, gathered_padding_mask
+                    else:
+                        encoder_state = encoder_state.index_select(1, src_index)
+                        encoder_padding_mask = encoder_padding_mask.index_select(0, src_index)
+                        gathered_state, gathered_padding_mask = encoder_state, encoder_padding_mask
 
             if incremental_state is None and not full_context_alignment:
                 self_attn_mask = self.buffered_future_mask(x)
@@ -797,10 +996,8 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             if not self.training or (dropout_probability > self.decoder_layerdrop):
                 x, layer_attn, _ = layer(
                     x,
-                    encoder_state[:encoder_out.encoder_padding_mask.size(1)],
-                    encoder_out.encoder_padding_mask
-                    if encoder_out is not None
-                    else None,
+                    encoder_state,
+                    encoder_padding_mask,
                     incremental_state,
                     self_attn_mask=self_attn_mask,
                     self_attn_padding_mask=self_attn_padding_mask,
@@ -827,9 +1024,68 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         if self.project_out_dim is not None:
             x = self.project_out_dim(x)
 
-        #return x, {"attn": [attn], "inner_states": inner_states, "txt_out": encoder_out.txt_out, "img_out": encoder_out.img_out}
+        txt_out: Optional[Tensor] = None
+        img_out: Optional[Tensor] = None
+        if encoder_out is not None:
+            txt_out, img_out = encoder_out.txt_summary, encoder_out.img_summary
+            if encoder_out.src_index is not None:
+                txt_out = txt_out.index_select(0, encoder_out.src_index)
+                img_out = img_out.index_select(0, encoder_out.src_index)
+
+        return x, {"attn": [attn], "inner_states": inner_states, "txt_out": txt_out, "img_out": img_out}
+
+    def _encoder_state(self, encoder_out, idx: int):
+        """The encoder output that layer *idx* attends to, and its padding mask."""
+        if self.layer_wise_attention:
+            encoder_states = encoder_out.encoder_states
+            assert encoder_states is not None
+            encoder_state = encoder_states[idx]
+        else:
+            encoder_state = encoder_out.encoder_out
+        encoder_padding_mask = encoder_out.encoder_padding_mask
+        return encoder_state[:encoder_padding_mask.size(1)], encoder_padding_mask
+
+    def cache_encoder_attn(
+        self,
+        encoder_out,
+        incremental_state: Dict[str, Dict[str, Optional[Tensor]]],
+        group_size: int = 1,
+    ):
+        """Project the encoder output to the keys and values of the
+        encoder-decoder attention of every layer once, before the first
+        decoding step, and cache them in *incremental_state*.
+
+        With a *group_size* > 1, the decoder runs *group_size* consecutive
+        hypotheses per sentence of *encoder_out* (as in beam search), which
+        share the cached keys and values of their sentence: see
+        :func:`fairseq.modules.MultiheadAttention.cache_static_kv`.
 
-        return x, {"attn": [attn], "inner_states": inner_states}
+        Args:
+            encoder_out: output from the encoder, one row per sentence
+            incremental_state (dict): dictionary used for storing state
+                during :ref:`Incremental decoding`
+            group_size (int): number of hypotheses per sentence
+        """
+        if self.cross_self_attention:
+            # attends to the encoder output along with the previous tokens
+            return
+        assert encoder_out.src_index is None
+        for idx, layer in enumerate(self.layers):
+            if layer.encoder_attn is not None:
+                encoder_state, encoder_padding_mask = self._encoder_state(encoder_out, idx)
+                layer.encoder_attn.cache_static_kv(
+                    encoder_state, encoder_padding_mask, incremental_state, group_size,
+                )
+
+    def _reads_encoder_out(
+        self, layer, incremental_state: Optional[Dict[str, Dict[str, Optional[Tensor]]]]
+    ) -> bool:
+        """Whether *layer* reads the encoder output in this step, rather than
+        only keys and values it cached in *incremental_state*."""
+        if incremental_state is None or self.cross_self_attention or layer.encoder_attn is None:
+            return True
+        saved_state = layer.encoder_attn._get_input_buffer(incremental_state)
+        return saved_state is None or "prev_key" not in saved_state
 
     def output_layer(self, features):
         """Project features to the vocabulary size."""
@@ -1027,22 +1283,3 @@ def transformer_wmt_en_de_big_align(args):
     args.alignment_layer = getattr(args, "alignment_layer", 4)
     transformer_wmt_en_de_big(args)
 
-
-######### gating  ##########
-class GatingMechanism(nn.Module):
-    def __init__(self, args):
-        super().__init__()
-
-        self.fc_img = Linear(args.gating_dim * 2, 1)
-
-    def forward(self, x, grid_img_features):
-
-
-        grid_img_features = torch.mean(grid_img_features, dim=0, keepdim=True)  ## 1*batch*dim
-        t, b, c = x.shape
-        grid_img_features = grid_img_features.expand(t, b, c)
-        merge = torch.cat([x, grid_img_features], dim=-1)
-
-        gate = torch.sigmoid(self.fc_img(merge))  # T B C
-        img_features = torch.mul(gate, x)
-        return img_features
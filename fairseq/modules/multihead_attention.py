@@ -13,7 +13,7 @@ from torch import Tensor, nn
 from torch.nn import Parameter
 from fairseq.incremental_decoding_utils import with_incremental_state
 
-from fairseq.modules.transformer_mask_attention import multi_head_attention_forward_image
+from fairseq.modules.transformer_mask_attention import masked_image_attention
 
 
 
@@ -236,6 +236,10 @@ class MultiheadAttention(nn.Module):
                 if static_kv:
                     assert self.encoder_decoder_attention and not self.self_attention
                     key = value = None
+                    if "src_index" in saved_state:
+                        return self._grouped_static_kv_attention(
+                            query, saved_state, need_weights, need_head_weights
+                        )
         else:
             saved_state = None
 
@@ -454,16 +458,132 @@ class MultiheadAttention(nn.Module):
             new_key_padding_mask = prev_key_padding_mask
         return new_key_padding_mask
 
+    def cache_static_kv(
+        self,
+        key: Tensor,
+        key_padding_mask: Optional[Tensor],
+        incremental_state: Dict[str, Dict[str, Optional[Tensor]]],
+        group_size: int = 1,
+    ):
+        """Project *key* to the static keys and values of encoder-decoder
+        attention ahead of incremental decoding, and cache them in
+        *incremental_state*.
+
+        The queries come in groups of *group_size* consecutive rows per row
+        of *key*, e.g. the hypotheses of a sentence in beam search. The
+        groups attend to the same cached keys and values, so these are
+        neither copied per query nor by :func:`reorder_incremental_state`,
+        as long as reorders keep each query in its group.
+
+        Args:
+            key (Tensor): encoder output, of shape `(src_len, batch, embed_dim)`
+            key_padding_mask (ByteTensor, optional): mask to exclude keys that
+                are pads, of shape `(batch, src_len)`
+            group_size (int): number of queries per row of *key*
+        """
+        assert self.encoder_decoder_attention and not self.self_attention
+        assert self.bias_k is None and not self.add_zero_attn
+        src_len, bsz, _ = key.size()
+        k = self.k_proj(key).view(src_len, bsz, self.num_heads, self.head_dim)
+        v = self.v_proj(key).view(src_len, bsz, self.num_heads, self.head_dim)
+        saved_state: Dict[str, Optional[Tensor]] = {
+            # stored with shape (bsz, num_heads, src_len, head_dim)
+            "prev_key": k.permute(1, 2, 0, 3).contiguous(),
+            "prev_value": v.permute(1, 2, 0, 3).contiguous(),
+            "prev_key_padding_mask": key_padding_mask,
+            # the row of the keys and values that each query attends to
+            "src_index": torch.arange(bsz, device=key.device).repeat_interleave(group_size),
+        }
+        self._set_input_buffer(incremental_state, saved_state)
+
+    def _grouped_static_kv_attention(
+        self,
+        query: Tensor,
+        saved_state: Dict[str, Optional[Tensor]],
+        need_weights: bool,
+        need_head_weights: bool,
+    ) -> Tuple[Tensor, Optional[Tensor]]:
+        """Attention of groups of queries to the keys and values cached by
+        :func:`cache_static_kv`."""
+        tgt_len, bsz, embed_dim = query.size()
+        k, v = saved_state["prev_key"], saved_state["prev_value"]
+        assert k is not None and v is not None
+        num_groups, src_len = k.size(0), k.size(2)
+        group_size = bsz // num_groups
+
+        q = self.q_proj(query) * self.scaling
+        # num_groups x num_heads x (group_size * tgt_len) x head_dim
+        q = (
+            q.view(tgt_len, num_groups, group_size, self.num_heads, self.head_dim)
+            .permute(1, 3, 2, 0, 4)
+            .reshape(num_groups, self.num_heads, group_size * tgt_len, self.head_dim)
+        )
+        attn_weights = torch.matmul(q, k.transpose(2, 3))
+        key_padding_mask = saved_state.get("prev_key_padding_mask")
+        if key_padding_mask is not None:
+            # don't attend to padding symbols
+            attn_weights = attn_weights.masked_fill(
+                key_padding_mask.unsqueeze(1).unsqueeze(2).to(torch.bool), float("-inf")
+            )
+        attn_weights_float = utils.softmax(
+            attn_weights, dim=-1, onnx_trace=self.onnx_trace
+        )
+        attn_probs = F.dropout(
+            attn_weights_float.type_as(attn_weights),
+            p=self.dropout,
+            training=self.training,
+        )
+        attn = torch.matmul(attn_probs, v)
+        attn = (
+            attn.view(num_groups, self.num_heads, group_size, tgt_len, self.head_dim)
+            .permute(3, 0, 2, 1, 4)
+            .reshape(tgt_len, bsz, embed_dim)
+        )
+        attn = self.out_proj(attn)
+        attn_weights: Optional[Tensor] = None
+        if need_weights:
+            # num_heads x bsz x tgt_len x src_len
+            attn_weights = (
+                attn_weights_float.view(num_groups, self.num_heads, group_size, tgt_len, src_len)
+                .transpose(0, 1)
+                .reshape(self.num_heads, bsz, tgt_len, src_len)
+            )
+            if not need_head_weights:
+                # average attention weights over heads
+                attn_weights = attn_weights.mean(dim=0)
+        return attn, attn_weights
+
+    @staticmethod
+    def _reorder_grouped_static_kv(input_buffer: Dict[str, Optional[Tensor]], new_order):
+        src_index = input_buffer["src_index"]
+        prev_key = input_buffer["prev_key"]
+        assert src_index is not None and prev_key is not None
+        group_size = src_index.size(0) // prev_key.size(0)
+        # reorders within a group leave the keys and values as they are
+        new_index = src_index.index_select(0, new_order)
+        if new_order.size(0) != src_index.size(0):
+            # groups were dropped: keep the keys and values of the others
+            rows = new_index.view(-1, group_size)[:, 0]
+            for k in ["prev_key", "prev_value", "prev_key_padding_mask"]:
+                input_buffer_k = input_buffer[k]
+                if input_buffer_k is not None:
+                    input_buffer[k] = input_buffer_k.index_select(0, rows)
+            new_index = torch.arange(rows.size(0), device=rows.device).repeat_interleave(group_size)
+        input_buffer["src_index"] = new_index
+
     def reorder_incremental_state(
         self, incremental_state: Dict[str, Dict[str, Optional[Tensor]]], new_order
     ):
         """Reorder buffered internal state (for incremental generation)."""
         input_buffer = self._get_input_buffer(incremental_state)
         if input_buffer is not None:
-            for k in input_buffer.keys():
-                input_buffer_k = input_buffer[k]
-                if input_buffer_k is not None:
-                    input_buffer[k] = input_buffer_k.index_select(0, new_order)
+            if "src_index" in input_buffer:
+                self._reorder_grouped_static_kv(input_buffer, new_order)
+            else:
+                for k in input_buffer.keys():
+                    input_buffer_k = input_buffer[k]
+                    if input_buffer_k is not None:
+                        input_buffer[k] = input_buffer_k.index_select(0, new_order)
             incremental_state = self._set_input_buffer(incremental_state, input_buffer)
         return incremental_state
 
@@ -637,37 +757,36 @@ class MultiheadAttention_Image(nn.Module):
         assert list(query.size()) == [tgt_len, bsz, embed_dim]
 
         if (
-            self.enable_torch_version
-            and not self.onnx_trace
+            not self.onnx_trace
             and incremental_state is None
             and not static_kv
+            and not before_softmax
+            and self.bias_k is None
+            and not self.add_zero_attn
         ):
-            assert key is not None and value is not None
-            return multi_head_attention_forward_image(
+            assert self.self_attention or (key is not None and value is not None)
+            return masked_image_attention(
                 query,
                 key,
                 value,
-                self.embed_dim,
                 self.num_heads,
-                torch.empty([0]),
-                torch.cat((self.q_proj.bias, self.k_proj.bias, self.v_proj.bias)),   ####1536###
-                self.bias_k,
-                self.bias_v,
-                self.add_zero_attn,
-                self.dropout,
+                self.q_proj.weight,
+                self.q_proj.bias,
+                self.k_proj.weight,
+                self.k_proj.bias,
+                self.v_proj.weight,
+                self.v_proj.bias,
                 self.out_proj.weight,
                 self.out_proj.bias,
-                self.training,
-                mask_matrix_tmp,
-                key_padding_mask,
-                # multimodel_graph_mask,
-                need_weights,
-                attn_mask,
-                use_separate_proj_weight=True,
-                q_proj_weight=self.q_proj.weight,
-                k_proj_weight=self.k_proj.weight,
-                v_proj_weight=self.v_proj.weight,
+                mask_matrix=mask_matrix_tmp,
+                key_padding_mask=key_padding_mask,
+                attn_mask=attn_mask,
+                self_attention=self.self_attention,
+                dropout_p=self.dropout,
+                training=self.training,
+                need_weights=need_weights,
             )
+        assert mask_matrix_tmp is None, "the text2image mask requires masked_image_attention"
 
 
 
@@ -60,13 +60,20 @@ class TransformerEncoderLayer(nn.Module):
 
     Args:
         args (argparse.Namespace): parsed command-line arguments
+        layer_idx (int, optional): index of the layer in the encoder, which
+            determines whether it encodes the image stream (see
+            :func:`encodes_image`) and has gating (see :func:`uses_gating`);
+            by default it does both
     """
 
-    def __init__(self, args):
+    def __init__(self, args, layer_idx: Optional[int] = None):
         super().__init__()
         self.embed_dim = args.encoder_embed_dim
         self.pre_mix = args.pre_mix
-        self.image_encoder = TransformerEncoderLayer_image(args)
+        if layer_idx is None or self.encodes_image(layer_idx):
+            self.image_encoder = TransformerEncoderLayer_image(args)
+        else:
+            self.image_encoder = None
 
         self.self_attn = MultiheadAttention(
             self.embed_dim,
@@ -74,13 +81,10 @@ class TransformerEncoderLayer(nn.Module):
             dropout=args.attention_dropout,
             self_attention=True,
         )
-        self.self_attn2 = MultiheadAttention(
-            self.embed_dim,
-            args.encoder_attention_heads,
-            dropout=args.attention_dropout,
-            self_attention=True,
-        )
-        self.gating = GatingMechanism(args)
+        if layer_idx is None or self.uses_gating(layer_idx):
+            self.gating = GatingMechanism(args)
+        else:
+            self.gating = None
         self.self_attn_layer_norm = LayerNorm(self.embed_dim)
         self.dropout = args.dropout
         self.activation_fn = utils.get_activation_fn(
@@ -94,8 +98,6 @@ class TransformerEncoderLayer(nn.Module):
         self.fc1 = Linear(self.embed_dim, args.encoder_ffn_embed_dim)
         self.fc2 = Linear(args.encoder_ffn_embed_dim, self.embed_dim)
 
-        # self.fc_con = Linear(2*self.embed_dim, self.embed_dim)
-        self.fc_con_layer_norm = LayerNorm(self.embed_dim)
         self.final_layer_norm = LayerNorm(self.embed_dim)
         # self.highway_net = HighWayNet(args)
 
@@ -113,58 +115,96 @@ class TransformerEncoderLayer(nn.Module):
                     state_dict["{}.{}.{}".format(name, new, m)] = state_dict[k]
                     del state_dict[k]
 
-    def getBinaryTensor(self, i, boundary):
-        one_matrix = torch.ones_like(i)
-        zero_matrix = torch.zeros_like(i)
-
-        return torch.where(i > boundary, one_matrix, zero_matrix)
-
-    def mask(self, x, src_img_features, lay_idx):
-
+        # earlier checkpoints have an image encoder and gating in every layer,
+        # and parameters that were never used
+        unused = ["self_attn2", "fc_con_layer_norm"]
+        if self.image_encoder is None:
+            unused.append("image_encoder")
+        if self.gating is None:
+            unused.append("gating")
+        prefixes = tuple("{}.{}.".format(name, m) for m in unused)
+        for k in [k for k in state_dict.keys() if k.startswith(prefixes)]:
+            del state_dict[k]
+
+    @staticmethod
+    def uses_mask(lay_idx):
+        """Whether the image encoder of layer *lay_idx* attends under the
+        text2image mask computed by the previous layer."""
+        return lay_idx >= 3
+
+    @staticmethod
+    def uses_gating(lay_idx):
+        """Whether layer *lay_idx* adds the image stream to the text through
+        its gating."""
+        return lay_idx >= 3
+
+    @staticmethod
+    def encodes_image(lay_idx):
+        """Whether layer *lay_idx* encodes the image stream: the first layer
+        does so without a text2image mask, and those that :func:`uses_mask`
+        under it. The image stream passes through the other layers."""
+        return lay_idx <= 0 or TransformerEncoderLayer.uses_mask(lay_idx)
+
+    @torch.no_grad()
+    def mask(self, x, src_img_features, lay_idx, encoder_padding_mask_image: Optional[Tensor] = None,
+             out: Optional[Tensor] = None):
+        """Return the ``(batch, num_regions, num_regions)`` boolean
+        text2image mask, which is ``True`` where a pair of regions is *not*
+        linked through the text: its image->text->image attention is at most
+        0.02 for the 7x7 grid of 49 regions, i.e. just below uniform, and
+        proportionally more (or less) for images with fewer (or more)
+        regions. Padded regions (see *encoder_padding_mask_image*) are not
+        attended to, and are not counted.
+
+        The mask is not differentiated through. It can be written into *out*
+        to reuse the buffer of a mask that is no longer needed.
+        """
         x = x.transpose(0, 1)  # batch * len * dim
-        src_img_features = src_img_features.transpose(0, 1)  # batch * 49 * dim
-        ########  mask  img ######### batch * 49 * len
-        mask_img = torch.bmm(src_img_features, x.transpose(1, 2)) / math.sqrt(128)
-        mask_img = F.softmax(mask_img, dim=-1)
-
-        # mask_matrix = torch.mean(mask_img, dim=2, keepdim=True).repeat(1,1,49)
-        # mask_img = F.sigmoid(mask_img)
-        # mask_img = self.getBinaryTensor(mask_img,0.015)
+        src_img_features = src_img_features.transpose(0, 1)  # batch * regions * dim
+        num_regions = src_img_features.size(1)
 
-        ########  mask  txt ######### batch * len * 49
-        mask_txt = torch.bmm(x, src_img_features.transpose(1, 2)) / math.sqrt(128)
-        mask_txt = F.softmax(mask_txt, dim=-1)
+        # the img->txt and txt->img scores are transposes of each other; the
+        # temperature does not depend on the number of regions
+        scores = torch.bmm(src_img_features, x.transpose(1, 2)).div_(math.sqrt(128))  # batch * regions * len
+        mask_img = F.softmax(scores, dim=-1)
+        if encoder_padding_mask_image is not None:
+            scores = scores.masked_fill(encoder_padding_mask_image.unsqueeze(-1), float('-inf'))
+            num_regions = (~encoder_padding_mask_image).sum(dim=1).view(-1, 1, 1)
+        mask_txt = F.softmax(scores, dim=1).transpose(1, 2)  # batch * len * regions
 
-        mask_matrix = torch.bmm(mask_img, mask_txt).cuda()
-
-        mask_matrix_output = self.getBinaryTensor(mask_matrix, 0.02)
-
-        # mask_matrix_output = []
-        # for i in mask_matrix:
-        #     mask_list = i.reshape(1, -1)  # Ascending    # or i.view(src_img_features.size(1) * src_img_features.size(1))
-        #     mask_list = sorted(mask_list.squeeze().tolist())
-        #     num_tmp = int(len(mask_list) * 0.15)
-        #     mask_matrix_tmp = self.getBinaryTensor(i, mask_list[num_tmp])
-        #     mask_matrix_output.append(mask_matrix_tmp.tolist())
-
-        return mask_matrix_output.detach()
+        mask_matrix = torch.bmm(mask_img, mask_txt)
+        return torch.le(mask_matrix, 0.02 * (49 / num_regions), out=out)
 
     def forward(self, x, src_img_features, encoder_padding_mask, encoder_padding_mask_image, batch_len, lay_idx,
-                mask_matrix_tmp, attn_mask: Optional[Tensor] = None):
+                mask_matrix_tmp, attn_mask: Optional[Tensor] = None, need_mask: bool = True,
+                mask_out: Optional[Tensor] = None, img_batch: Optional[Tensor] = None):
         """
         Args:
             x (Tensor): input to the layer of shape `(seq_len, batch, embed_dim)`
             encoder_padding_mask (ByteTensor): binary ByteTensor of shape
                 `(batch, src_len)` where padding elements are indicated by ``1``.
+            encoder_padding_mask_image (BoolTensor): `(batch, num_regions)`,
+                where padded image regions are indicated by ``True``
             attn_mask (ByteTensor): binary tensor of shape (T_tgt, T_src), where
             T_tgt is the length of query, while T_src is the length of key,
             though here both query and key is x here,
             attn_mask[t_tgt, t_src] = 1 means when calculating embedding
             for t_tgt, t_src is excluded (or masked out), =0 means it is
             included in attention
+            need_mask (bool, optional): compute the text2image mask for the
+                next layer; ``None`` is returned in its place otherwise
+            mask_out (Tensor, optional): buffer to write that mask into
+            img_batch (LongTensor, optional): indices of the sentences of
+                the batch that still use the image, to which the image
+                stream, its padding mask and the text2image mask are
+                restricted; the image stream is skipped if empty (see
+                :func:`TransformerEncoder.set_gate_exit`)
 
         Returns:
-            encoded output of shape `(seq_len, batch, embed_dim)`
+            tuple of the encoded output of shape `(seq_len, batch, embed_dim)`,
+            the text2image mask (or ``None``), the image stream and the gate
+            of shape `(seq_len, img_batch, 1)` (or ``None`` in layers
+            without gating)
         """
 
         # residual = x
@@ -204,34 +244,37 @@ class TransformerEncoderLayer(nn.Module):
         ####################################
         ########  image encoder  ###########
 
-        src_img_features_tmp = src_img_features
+        if img_batch is not None:
+            if img_batch.numel() == 0:
+                return x, None, src_img_features, None
+            x_img = x.index_select(1, img_batch)
+        else:
+            x_img = x
 
-        if lay_idx <= 0:
-            encoder_padding_mask_image = torch.sum(src_img_features, dim=-1).eq(0).transpose(0, 1)
-            src_img_mask = torch.zeros(src_img_features.size(1), src_img_features.size(0), src_img_features.size(0)).eq(
-                1)
-            src_img_features = self.image_encoder(lay_idx, src_img_features, encoder_padding_mask_image, src_img_mask)
-            
-        if lay_idx >= 3:
-            encoder_padding_mask_image = torch.sum(src_img_features, dim=-1).eq(0).transpose(0, 1)
+        # the image encoders that do not use the text2image mask only depend
+        # on the image, and are run ahead of the text by TransformerEncoder
+        if self.uses_mask(lay_idx):
             src_img_features = self.image_encoder(lay_idx, src_img_features, encoder_padding_mask_image,
                                                   mask_matrix_tmp)
-		
+
         # ########  mask #########
         # src_img_features = src_img_features + src_img_features_tmp
 
-        
-        mask_matrix = self.mask(x, src_img_features, lay_idx)
-
+        mask_matrix = self.mask(
+            x_img, src_img_features, lay_idx, encoder_padding_mask_image, out=mask_out,
+        ) if need_mask else None
 
         ########  gating ########
         src_img_features_tmp = src_img_features
-        if lay_idx >= 3:	
-
-            src_img_features, gate = self.gating(x, src_img_features)
-            x = x + src_img_features
+        gate = None
+        if self.uses_gating(lay_idx):
+            src_img_features, gate = self.gating(x_img, src_img_features, encoder_padding_mask_image)
+            if img_batch is not None:
+                x = x.index_add(1, img_batch, src_img_features)
+            else:
+                x = x + src_img_features
 
-        return x, mask_matrix.eq(0), src_img_features_tmp
+        return x, mask_matrix, src_img_features_tmp, gate
 
 
 
@@ -511,8 +554,6 @@ class TransformerEncoderLayer_image(nn.Module):
         self.fc1 = Linear(self.embed_dim, args.encoder_ffn_embed_dim)
         self.fc2 = Linear(args.encoder_ffn_embed_dim, self.embed_dim)
 
-        # self.fc_con = Linear(2*self.embed_dim, self.embed_dim)
-        self.fc_con_layer_norm = LayerNorm(self.embed_dim)
         self.final_layer_norm = LayerNorm(self.embed_dim)
         # self.highway_net = HighWayNet(args)
 
@@ -559,8 +600,9 @@ class TransformerEncoderLayer_image(nn.Module):
             query=src_img_features,
             key=src_img_features,
             value=src_img_features,
-            mask_matrix_tmp=mask_matrix_tmp.cuda(),
+            mask_matrix_tmp=mask_matrix_tmp,
             key_padding_mask=encoder_padding_mask,
+            need_weights=False,
             attn_mask=attn_mask,
         )
 
@@ -596,7 +638,7 @@ class GatingMechanism(nn.Module):
 
         # self.fc_img_x = Linear(args.gating_dim, 128)
 
-    def forward(self, x, grid_img_features):
+    def forward(self, x, grid_img_features, encoder_padding_mask_image: Optional[Tensor] = None):
         # x = torch.mean(x, dim=0, keepdim=True)
         # region_x_features = torch.cat([region_img_features, x.repeat(region_img_features.size(0), 1, 1)], dim=-1)
         # region_linear_x = self.fc_img(region_x_features)
@@ -605,7 +647,12 @@ class GatingMechanism(nn.Module):
         # region_img_features = torch.mul(region_sigmoid_x, region_img_features)
         # return region_img_features, region_sigmoid_x
 
-        grid_img_features = torch.mean(grid_img_features, dim=0, keepdim=True)  ## 1*batch*dim
+        if encoder_padding_mask_image is not None:
+            # average over the regions that are not padding
+            not_padding = (~encoder_padding_mask_image).t().unsqueeze(-1).type_as(grid_img_features)
+            grid_img_features = (grid_img_features * not_padding).sum(dim=0, keepdim=True) / not_padding.sum(dim=0)
+        else:
+            grid_img_features = torch.mean(grid_img_features, dim=0, keepdim=True)  ## 1*batch*dim
         t, b, c = x.shape
         grid_img_features = grid_img_features.expand(t, b, c)
         merge = torch.cat([x, grid_img_features], dim=-1)
@@ -10,6 +10,7 @@ from typing import Callable, List, Optional
 import torch
 
 from fairseq import utils
+from fairseq.data.image_feature_dataset import get_available_feature_formats
 from fairseq.data.indexed_dataset import get_available_dataset_impl
 
 
@@ -282,6 +283,20 @@ def add_preprocess_args(parser):
                        help="Pad dictionary size to be multiple of N")
     group.add_argument("--workers", metavar="N", default=1, type=int,
                        help="number of parallel workers")
+    group.add_argument("--img-features", metavar="SUFFIX", default=None,
+                       help="image feature suffix; binarizes <trainpref>.<suffix> etc. (.npy, one "
+                            "row per source sentence) into the source image feature store")
+    group.add_argument("--img-order", metavar="SUFFIX", default=None,
+                       help="suffix of files listing, per source sentence, its 0-based row "
+                            "in the image features (or -1 if it has no image), if they are not "
+                            "in sentence order")
+    group.add_argument("--img-format", metavar="FORMAT", default=None,
+                       choices=get_available_feature_formats(),
+                       help="storage precision of the image feature store (default: float32); "
+                            "without --img-features, binarizes <destdir>/<split>.<src>-<tgt>.<src>.npy")
+    group.add_argument("--img-dedup", action="store_true",
+                       help="store each distinct image once, plus a sentence-to-image index; "
+                            "without --img-features, of <destdir>/<split>.<src>-<tgt>.<src>.npy")
     # fmt: on
     return parser
 
@@ -291,6 +306,8 @@ def add_dataset_args(parser, train=False, gen=False):
     # fmt: off
     group.add_argument('--num-workers', default=1, type=int, metavar='N',
                        help='how many subprocesses to use for data loading')
+    group.add_argument('--no-device-prefetch', action='store_true',
+                       help='do not pin batches and copy them to the GPU ahead of time')
     group.add_argument('--skip-invalid-size-inputs-valid-test', action='store_true',
                        help='ignore too long or too short lines in valid and test set')
     group.add_argument('--max-tokens', type=int, metavar='N',
@@ -449,6 +466,10 @@ def add_checkpoint_args(parser):
                        help=('early stop training if valid performance doesn\'t '
                              'improve for N consecutive validation runs; note '
                              'that this is influenced by --validate-interval'))
+    group.add_argument('--slim-after-updates', type=int, default=0, metavar='N',
+                       help='after N updates (and a batch with images), remove the modules whose '
+                            'parameters received no gradient so far from the model, its optimizer and '
+                            'its checkpoints; not compatible with LayerDrop')
     # fmt: on
     return group
 
@@ -492,6 +513,19 @@ def add_generation_args(parser):
     # fmt: off
     group.add_argument('--beam', default=5, type=int, metavar='N',
                        help='beam size')
+    group.add_argument('--img-proj-cache', action='store_true',
+                       help='project the image features by img_fc once and cache them '
+                            'next to the data, keyed by a hash of the checkpoint(s)')
+    group.add_argument('--gate-exit-threshold', default=None, type=float, metavar='G',
+                       help='skip the image encoder, text2image mask and gating of the remaining '
+                            'encoder layers once the mean gate of the batch falls below G')
+    group.add_argument('--gate-exit-per-sentence', action='store_true',
+                       help='apply --gate-exit-threshold to each sentence rather than to the batch')
+    group.add_argument('--pipeline', action='store_true',
+                       help='post-process, score and write the translations of each batch on a '
+                            'background thread while the next batch is decoded')
+    group.add_argument('--pipeline-depth', default=8, type=int, metavar='N',
+                       help='with --pipeline, number of decoded batches that may wait for post-processing')
     group.add_argument('--nbest', default=1, type=int, metavar='N',
                        help='number of hypotheses to output')
     group.add_argument('--max-len-a', default=0, type=float, metavar='N',
@@ -569,6 +603,24 @@ def add_interactive_args(parser):
                        help='read this many sentences into a buffer before processing them')
     group.add_argument('--input', default='-', type=str, metavar='FILE',
                        help='file to read from; use - for stdin')
+    group.add_argument('--img-store', default=None, type=str, metavar='PREFIX',
+                       help='image features of the text dataset at this prefix (e.g. data-bin/test.en-de.en), '
+                            'indexed by the image ids given after a tab on input lines; any other image '
+                            'is read as a .npy file of its features')
+    group.add_argument('--serve', action='store_true',
+                       help='translate each input line as soon as it is read, with a worker that '
+                            'batches concurrent sentences by --max-tokens, --max-regions and --max-sentences')
+    group.add_argument('--max-wait-ms', default=5., type=float, metavar='MS',
+                       help='with --serve or fairseq-serve, how long a sentence may wait for others to '
+                            'batch with')
+    group.add_argument('--max-regions', default=None, type=int, metavar='N',
+                       help='with --serve, maximum number of (padded) image regions in a batch')
+    group.add_argument('--socket', default=None, type=str, metavar='ADDR',
+                       help='fairseq-serve listens on this HOST:PORT or unix socket path instead of '
+                            'reading stdin')
+    group.add_argument('--length-bucket-width', default=8, type=int, metavar='N',
+                       help='fairseq-serve batches sentences whose lengths are in the same bucket of '
+                            'this many tokens')
     # fmt: on
 
 
@@ -130,6 +130,8 @@ class SequenceGenerator(object):
 
         # compute the encoder output for each beam
         encoder_outs = model.forward_encoder(encoder_input)
+        # the hypotheses of a sentence share its cross-attention keys and values
+        model.cache_encoder_attn(encoder_outs, beam_size)
         new_order = torch.arange(bsz).view(-1, 1).repeat(1, beam_size).view(-1)
         new_order = new_order.to(src_tokens.device).long()
         encoder_outs = model.reorder_encoder_out(encoder_outs, new_order)
@@ -591,11 +593,21 @@ class EnsembleModel(torch.nn.Module):
         probs = probs[:, -1, :]
         return probs, attn
 
+    def cache_encoder_attn(self, encoder_outs, group_size):
+        if self.incremental_states is None or not self.has_encoder():
+            return
+        for model, encoder_out in zip(self.models, encoder_outs):
+            if hasattr(model.decoder, 'cache_encoder_attn'):
+                model.decoder.cache_encoder_attn(encoder_out, self.incremental_states[model], group_size)
+
     def reorder_encoder_out(self, encoder_outs, new_order):
         if not self.has_encoder():
             return
         return [
-            model.encoder.reorder_encoder_out(encoder_out, new_order)
+            # without copying the encoder output, if the encoder supports it
+            model.encoder.reindex_encoder_out(encoder_out, new_order)
+            if hasattr(model.encoder, 'reindex_encoder_out')
+            else model.encoder.reorder_encoder_out(encoder_out, new_order)
             for model, encoder_out in zip(self.models, encoder_outs)
         ]
 
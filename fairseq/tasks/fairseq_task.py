@@ -99,6 +99,7 @@ class FairseqTask(object):
         self, dataset, max_tokens=None, max_sentences=None, max_positions=None,
         ignore_invalid_inputs=False, required_batch_size_multiple=1,
         seed=1, num_shards=1, shard_id=0, num_workers=0, epoch=0,
+        prefetch_to_device=False,
     ):
         """
         Get an iterator that yields batches of data from the given dataset.
@@ -126,6 +127,8 @@ class FairseqTask(object):
                 (default: 0).
             epoch (int, optional): the epoch to start the iterator from
                 (default: 0).
+            prefetch_to_device (bool, optional): pin batches and copy them
+                to the GPU ahead of time on a side stream (default: False).
         Returns:
             ~fairseq.iterators.EpochBatchIterator: a batched iterator over the
                 given dataset split
@@ -151,10 +154,15 @@ class FairseqTask(object):
                 indices, dataset, max_positions, raise_exception=(not ignore_invalid_inputs),
             )
 
+        try:
+            num_tokens_vec = dataset.num_tokens_vec(indices)
+        except NotImplementedError:
+            num_tokens_vec = None
+
         # create mini-batches with given size constraints
         batch_sampler = data_utils.batch_by_size(
             indices, dataset.num_tokens, max_tokens=max_tokens, max_sentences=max_sentences,
-            required_batch_size_multiple=required_batch_size_multiple,
+            required_batch_size_multiple=required_batch_size_multiple, num_tokens_vec=num_tokens_vec,
         )
 
         # return a reusable, sharded iterator
@@ -167,6 +175,7 @@ class FairseqTask(object):
             shard_id=shard_id,
             num_workers=num_workers,
             epoch=epoch,
+            prefetch_to_device=prefetch_to_device,
         )
         self.dataset_to_epoch_iter[dataset] = epoch_iter
         return epoch_iter
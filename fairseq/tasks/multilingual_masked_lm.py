@@ -295,6 +295,7 @@ class MultiLingualMaskedLMTask(FairseqTask):
         self, dataset, max_tokens=None, max_sentences=None, max_positions=None,
         ignore_invalid_inputs=False, required_batch_size_multiple=1,
         seed=1, num_shards=1, shard_id=0, num_workers=0, epoch=0,
+        prefetch_to_device=False,
     ):
         # Recreate epoch iterator every epoch cause the underlying
         # datasets are dynamic due to sampling.
@@ -303,6 +304,7 @@ class MultiLingualMaskedLMTask(FairseqTask):
             dataset, max_tokens, max_sentences, max_positions,
             ignore_invalid_inputs, required_batch_size_multiple,
             seed, num_shards, shard_id, num_workers, epoch,
+            prefetch_to_device,
         )
         self.dataset_to_epoch_iter = {}
         return epoch_iter
@@ -8,8 +8,10 @@ import json
 import itertools
 import logging
 import os
+import time
 
 import numpy as np
+import torch
 
 from fairseq import metrics, options, utils
 from fairseq.data import (
@@ -17,6 +19,7 @@ from fairseq.data import (
     ConcatDataset,
     data_utils,
     encoders,
+    image_feature_dataset,
     indexed_dataset,
     LanguagePairDataset,
     PrependTokenDataset,
@@ -39,7 +42,7 @@ def load_langpair_dataset(
     combine, dataset_impl, upsample_primary,
     left_pad_source, left_pad_target, max_source_positions,
     max_target_positions, prepend_bos=False, load_alignments=False,
-    truncate_source=False,
+    truncate_source=False, img_region_cost=0., img_mask_cost=0.,
 ):
 
     def split_exists(split, src, tgt, lang, data_path):
@@ -48,6 +51,8 @@ def load_langpair_dataset(
 
     src_datasets = []
     tgt_datasets = []
+    src_img_datasets = []
+    src_img_indices = []
 
     for k in itertools.count():
         split_k = split + (str(k) if k > 0 else '')
@@ -78,8 +83,13 @@ def load_langpair_dataset(
         )
 
         # src_graph = data_utils.load_sp_graph(prefix + src)
-        src_img_features = data_utils.load_img_features(prefix + src)
-
+        src_img_datasets.append(data_utils.load_img_features(prefix + src))
+        src_img_indices.append(data_utils.load_img_index(prefix + src))
+        num_img_examples = len(
+            src_img_indices[-1] if src_img_indices[-1] is not None else src_img_datasets[-1]
+        )
+        assert num_img_examples == len(src_datasets[-1]), \
+            'image features and source sentences of {} differ in length'.format(split_k)
 
         logger.info('{} {} {}-{} {} examples'.format(
             data_path, split_k, src, tgt, len(src_datasets[-1])
@@ -88,15 +98,36 @@ def load_langpair_dataset(
         if not combine:
             break
 
-    assert len(src_datasets) == len(tgt_datasets)
+    assert len(src_datasets) == len(tgt_datasets) == len(src_img_datasets)
 
     if len(src_datasets) == 1:
         src_dataset, tgt_dataset = src_datasets[0], tgt_datasets[0]
+        src_img_features = src_img_datasets[0]
+        src_img_index = src_img_indices[0]
     else:
         sample_ratios = [1] * len(src_datasets)
         sample_ratios[0] = upsample_primary
         src_dataset = ConcatDataset(src_datasets, sample_ratios)
         tgt_dataset = ConcatDataset(tgt_datasets, sample_ratios)
+        image_feature_dataset.check_compatible(src_img_datasets)
+        if all(index is None for index in src_img_indices):
+            src_img_features = ConcatDataset(src_img_datasets, sample_ratios)
+            src_img_index = None
+        else:
+            # deduplicated tables are concatenated once; the per-split indices
+            # are shifted into the combined table and upsampled like the text
+            src_img_features = ConcatDataset(src_img_datasets)
+            offsets = np.cumsum([0] + [len(ds) for ds in src_img_datasets[:-1]])
+            src_img_index = []
+            for ds, index, offset, ratio in zip(src_img_datasets, src_img_indices, offsets, sample_ratios):
+                if index is None:
+                    index = np.arange(len(ds))
+                upsampled = np.arange(int(ratio * len(index))) % len(index)
+                index = index[upsampled]
+                src_img_index.append(
+                    np.where(index == image_feature_dataset.MISSING_IMAGE, index, index + offset)
+                )
+            src_img_index = np.concatenate(src_img_index)
 
     if prepend_bos:
         assert hasattr(src_dict, "bos_index") and hasattr(tgt_dict, "bos_index")
@@ -120,6 +151,9 @@ def load_langpair_dataset(
         max_source_positions=max_source_positions,
         max_target_positions=max_target_positions,
         align_dataset=align_dataset,
+        src_img_index=src_img_index,
+        img_region_cost=img_region_cost,
+        img_mask_cost=img_mask_cost,
     )
 
 
@@ -169,6 +203,13 @@ class TranslationTask(FairseqTask):
                             help='amount to upsample primary dataset')
         parser.add_argument('--truncate-source', action='store_true', default=False,
                             help='truncate source to max-source-positions')
+        parser.add_argument('--img-region-cost', default=0., type=float, metavar='F',
+                            help='number of tokens each image region counts as towards --max-tokens '
+                                 '(e.g. 0.2 for transformer_iwslt_de_en)')
+        parser.add_argument('--img-mask-cost', default=0., type=float, metavar='F',
+                            help='number of tokens each pair of image regions counts as towards '
+                                 '--max-tokens, for the text2image masks and image attention '
+                                 '(e.g. 0.0002 for transformer_iwslt_de_en)')
 
         # options for reporting BLEU during validation
         parser.add_argument('--eval-bleu', action='store_true',
@@ -187,6 +228,12 @@ class TranslationTask(FairseqTask):
         parser.add_argument('--eval-bleu-args', type=str, metavar='JSON',
                             help='generation args for BLUE scoring, '
                                  'e.g., \'{"beam": 4, "lenpen": 0.6}\'')
+        parser.add_argument('--eval-bleu-beam', type=int, default=None, metavar='N',
+                            help='beam size for BLEU scoring (1 for greedy decoding), '
+                                 'overrides the one in --eval-bleu-args')
+        parser.add_argument('--eval-bleu-subset', type=float, default=1., metavar='FRACTION',
+                            help='score BLEU on a fixed random fraction of the validation '
+                                 'sentences (the loss is computed on all of them)')
         parser.add_argument('--eval-bleu-print-samples', action='store_true',
                             help='print sample generations during validation')
         # fmt: on
@@ -248,10 +295,63 @@ class TranslationTask(FairseqTask):
             max_target_positions=self.args.max_target_positions,
             load_alignments=self.args.load_alignments,
             truncate_source=self.args.truncate_source,
+            img_region_cost=getattr(self.args, 'img_region_cost', 0.),
+            img_mask_cost=getattr(self.args, 'img_mask_cost', 0.),
         )
 
-    def build_dataset_for_inference(self, src_tokens, src_lengths):
-        return LanguagePairDataset(src_tokens, src_lengths, self.source_dictionary)
+    def load_img_projection_cache(self, split, models):
+        """Replace the image features of *split* by their ``img_fc``
+        projection under each of *models*, so that the encoders consume them
+        directly.
+
+        The projections are computed once and cached next to the data, keyed
+        by a hash of the ``img_fc`` parameters of the ensemble.
+        """
+        encoders = [model.encoder for model in models]
+        projections = [encoder.img_fc for encoder in encoders]
+        src, tgt = self.args.source_lang, self.args.target_lang
+        data_path = self.args.data.split(os.pathsep)[0]
+        prefix = image_feature_dataset.image_projection_prefix(
+            image_feature_dataset.image_feature_prefix(
+                os.path.join(data_path, '{}.{}-{}.{}'.format(split, src, tgt, src))
+            ),
+            image_feature_dataset.projection_key(projections),
+        )
+
+        dataset = self.dataset(split)
+        if not image_feature_dataset.MMapImageFeatureDataset.exists(prefix):
+            logger.info('caching projected image features to {}'.format(prefix))
+            image_feature_dataset.binarize_image_projections(
+                dataset.src_img_features, prefix, projections,
+            )
+        dataset.src_img_features = image_feature_dataset.MMapImageFeatureDataset(prefix)
+
+        offset = 0
+        for encoder in encoders:
+            encoder.img_proj_offset = offset
+            offset += encoder.img_fc.out_features
+
+    def build_dataset_for_inference(self, src_tokens, src_lengths, src_img_features=None):
+        """*src_img_features* optionally gives the ``(num_regions,
+        feature_dim)`` image features of each sentence, or ``None`` for
+        sentences without an image (see
+        :class:`~fairseq.data.image_feature_dataset.ImageFeatureStore`)."""
+        src_img_index = None
+        if src_img_features is not None and any(f is not None for f in src_img_features):
+            src_img_index = np.full(len(src_img_features), image_feature_dataset.MISSING_IMAGE, dtype=np.int64)
+            has_image = [i for i, f in enumerate(src_img_features) if f is not None]
+            src_img_index[has_image] = np.arange(len(has_image))
+            src_img_features = image_feature_dataset.ListImageFeatureDataset(
+                [src_img_features[i] for i in has_image]
+            )
+        else:
+            src_img_features = None
+        return LanguagePairDataset(
+            src_tokens, src_lengths, self.source_dictionary,
+            src_img_features=src_img_features, src_img_index=src_img_index,
+            img_region_cost=getattr(self.args, 'img_region_cost', 0.),
+            img_mask_cost=getattr(self.args, 'img_mask_cost', 0.),
+        )
 
     def build_model(self, args):
         if getattr(args, 'eval_bleu', False):
@@ -267,13 +367,20 @@ class TranslationTask(FairseqTask):
             ))
 
             gen_args = json.loads(getattr(args, 'eval_bleu_args', '{}') or '{}')
+            if getattr(args, 'eval_bleu_beam', None) is not None:
+                gen_args['beam'] = args.eval_bleu_beam
             self.sequence_generator = self.build_generator(Namespace(**gen_args))
         return super().build_model(args)
 
     def valid_step(self, sample, model, criterion):
         loss, sample_size, logging_output = super().valid_step(sample, model, criterion)
         if self.args.eval_bleu:
+            sample = self._eval_bleu_subset(sample)
+            if sample is None:
+                return loss, sample_size, logging_output
+            start = time.perf_counter()
             bleu = self._inference_with_bleu(self.sequence_generator, sample, model)
+            logging_output['_bleu_time'] = time.perf_counter() - start
             logging_output['_bleu_sys_len'] = bleu.sys_len
             logging_output['_bleu_ref_len'] = bleu.ref_len
             # we split counts into separate entries so that they can be
@@ -302,16 +409,23 @@ class TranslationTask(FairseqTask):
                 metrics.log_scalar('_bleu_totals', np.array(totals))
                 metrics.log_scalar('_bleu_sys_len', sum_logs('_bleu_sys_len'))
                 metrics.log_scalar('_bleu_ref_len', sum_logs('_bleu_ref_len'))
+                metrics.log_scalar('_bleu_time', sum_logs('_bleu_time'))
 
                 def compute_bleu(meters):
                     import inspect
                     import sacrebleu
-                    fn_sig = inspect.getfullargspec(sacrebleu.compute_bleu)[0]
+                    try:
+                        from sacrebleu.metrics import BLEU
+                        compute_bleu = BLEU.compute_bleu
+                    except ImportError:
+                        # sacrebleu < 1.4.12
+                        compute_bleu = sacrebleu.compute_bleu
+                    fn_sig = inspect.getfullargspec(compute_bleu)[0]
                     if 'smooth_method' in fn_sig:
                         smooth = {'smooth_method': 'exp'}
                     else:
                         smooth = {'smooth': 'exp'}
-                    bleu = sacrebleu.compute_bleu(
+                    bleu = compute_bleu(
                         correct=meters['_bleu_counts'].sum,
                         total=meters['_bleu_totals'].sum,
                         sys_len=meters['_bleu_sys_len'].sum,
@@ -321,6 +435,8 @@ class TranslationTask(FairseqTask):
                     return round(bleu.score, 2)
 
                 metrics.log_derived('bleu', compute_bleu)
+                # seconds spent generating and scoring, over all the batches
+                metrics.log_derived('bleu_time', lambda meters: round(meters['_bleu_time'].sum, 1))
 
     def max_positions(self):
         """Return the max sentence length allowed by the task."""
@@ -336,12 +452,75 @@ class TranslationTask(FairseqTask):
         """Return the target :class:`~fairseq.data.Dictionary`."""
         return self.tgt_dict
 
+    def _eval_bleu_subset(self, sample):
+        """Return the sentences of *sample* in the --eval-bleu-subset, or
+        ``None`` if there are none."""
+        subset = getattr(self.args, 'eval_bleu_subset', 1.)
+        if subset >= 1.:
+            return sample
+        # a multiplicative hash of the ids, so that the same sentences are
+        # scored at every validation, spread over all lengths
+        keep = sample['id'].mul(2654435761).remainder(2 ** 32).lt(subset * 2 ** 32)
+        if not keep.any():
+            return None
+        keep = keep.nonzero().squeeze(1)
+        subset = utils.apply_to_sample(lambda t: t.index_select(0, keep), {
+            'id': sample['id'],
+            # src_img_batch indexes the whole batch, the encoder finds the
+            # sentences of the subset with an image itself
+            'net_input': {
+                k: v for k, v in sample['net_input'].items() if k not in {'prev_output_tokens', 'src_img_batch'}
+            },
+            'target': sample['target'],
+        })
+        # the encoder expects no padding column, and sentences sorted by
+        # decreasing source length as they still are
+        net_input = subset['net_input']
+        src_len = net_input['src_lengths'][0].item()
+        if self.args.left_pad_source:
+            net_input['src_tokens'] = net_input['src_tokens'][:, -src_len:]
+        else:
+            net_input['src_tokens'] = net_input['src_tokens'][:, :src_len]
+        return subset
+
     def _inference_with_bleu(self, generator, sample, model):
         import sacrebleu
 
+        gen_out = self.inference_step(generator, [model], sample, None)
+        hyp_tokens = [hypos[0]['tokens'] for hypos in gen_out]
+
+        if (
+            self.args.eval_tokenized_bleu and self.args.eval_bleu_remove_bpe is None
+            and not self.args.eval_bleu_print_samples
+            and getattr(self.args, 'eval_bleu_detok', None) in {None, 'space'}
+        ):
+            # the BLEU of the tokens, as sacrebleu would score their strings,
+            # can be counted on the device without decoding them
+            from fairseq.bleu import BatchScorer
+            pad = self.tgt_dict.pad()
+
+            def strip(tokens):
+                # move the tokens that Dictionary.string drops to the end
+                drop = tokens.eq(pad) | tokens.eq(self.tgt_dict.eos()) | tokens.eq(self.tgt_dict.bos())
+                positions = torch.arange(tokens.size(1), device=tokens.device)
+                order = (drop.long() * tokens.size(1) + positions).argsort(dim=1)
+                return tokens.gather(1, order).masked_fill(drop.gather(1, order), pad)
+
+            scorer = BatchScorer(pad, self.tgt_dict.eos(), self.tgt_dict.unk())
+            scorer.add_batch(
+                strip(sample['target']),
+                strip(torch.nn.utils.rnn.pad_sequence(hyp_tokens, batch_first=True, padding_value=pad)),
+            )
+            stat = scorer.stat
+            return Namespace(
+                sys_len=stat.predlen, ref_len=stat.reflen,
+                counts=[stat.match1, stat.match2, stat.match3, stat.match4],
+                totals=[stat.count1, stat.count2, stat.count3, stat.count4],
+            )
+
         def decode(toks, escape_unk=False):
             s = self.tgt_dict.string(
-                toks.int().cpu(),
+                toks,
                 self.args.eval_bleu_remove_bpe,
                 escape_unk=escape_unk,
             )
@@ -349,19 +528,18 @@ class TranslationTask(FairseqTask):
                 s = self.tokenizer.decode(s)
             return s
 
-        gen_out = self.inference_step(generator, [model], sample, None)
-        hyps, refs = [], []
-        for i in range(len(gen_out)):
-            try:
-                hyps.append(decode(gen_out[i][0]['tokens']))
-                refs.append(decode(
-                    utils.strip_pad(sample['target'][i], self.tgt_dict.pad()),
-                    escape_unk=True,  # don't count <unk> as matches to the hypo
-                ))
-            except :
-                print(gen_out[i])
+        # copy the batch to the host at once rather than sentence by sentence
+        pad = self.tgt_dict.pad()
+        hyp_tokens = torch.nn.utils.rnn.pad_sequence(hyp_tokens, batch_first=True, padding_value=pad).int().cpu()
+        ref_tokens = sample['target'].int().cpu()
+        hyps = [decode(utils.strip_pad(toks, pad)) for toks in hyp_tokens]
+        refs = [
+            # don't count <unk> as matches to the hypo
+            decode(utils.strip_pad(toks, pad), escape_unk=True) for toks in ref_tokens
+        ]
         if self.args.eval_bleu_print_samples:
             logger.info('example hypothesis: ' + hyps[0])
             logger.info('example reference: ' + refs[0])
-        tokenize = sacrebleu.DEFAULT_TOKENIZER if not self.args.eval_tokenized_bleu else 'none'
+        # sacrebleu >= 2 dropped DEFAULT_TOKENIZER
+        tokenize = getattr(sacrebleu, 'DEFAULT_TOKENIZER', '13a') if not self.args.eval_tokenized_bleu else 'none'
         return sacrebleu.corpus_bleu(hyps, [refs], tokenize=tokenize)
@@ -44,6 +44,7 @@ class Trainer(object):
         self._criterion = criterion
         self._model = model
         self.cuda = torch.cuda.is_available() and not args.cpu
+        self.prefetch_to_device = self.cuda and not getattr(args, "no_device_prefetch", False)
         if args.fp16:
             self._criterion = self._criterion.half()
             self._model = self._model.half()
@@ -59,6 +60,20 @@ class Trainer(object):
         self._warn_once = set()
         self._wrapped_criterion = None
         self._wrapped_model = None
+        # whether each parameter received a gradient, and whether a batch
+        # with images was seen, see --slim-after-updates
+        self._has_grad = None
+        self._slim_saw_images = False
+        if getattr(args, "slim_after_updates", 0) > 0:
+            if (
+                getattr(args, "encoder_layerdrop", 0) > 0
+                or getattr(args, "decoder_layerdrop", 0) > 0
+                or getattr(args, "gate_exit_threshold", None) is not None
+            ):
+                raise ValueError(
+                    "--slim-after-updates cannot tell unused modules from those skipped "
+                    "by LayerDrop or gate exit, disable them or --slim-after-updates"
+                )
 
         if self.cuda and args.distributed_world_size > 1:
             self._grad_norm_buf = torch.cuda.DoubleTensor(args.distributed_world_size)
@@ -168,6 +183,12 @@ class Trainer(object):
         bexists = PathManager.isfile(filename)
         if bexists:
             state = checkpoint_utils.load_checkpoint_to_cpu(filename)
+            # the tensors of the checkpoint, before the model upgrades them
+            numels = [(k, v.numel()) for k, v in state["model"].items()]
+
+            slimmed_modules = getattr(state["args"], "slimmed_modules", None)
+            if slimmed_modules:
+                self._remove_modules(slimmed_modules)
 
             # load model parameters
             try:
@@ -187,6 +208,9 @@ class Trainer(object):
             extra_state = state["extra_state"]
             self._optim_history = state["optimizer_history"]
             last_optim_state = state.get("last_optimizer_state", None)
+            if last_optim_state is not None and not reset_optimizer:
+                last_optim_state = self._upgrade_optimizer_state(last_optim_state, numels)
+                reset_optimizer = last_optim_state is None
 
         if last_optim_state is not None and not reset_optimizer:
             # rebuild optimizer after loading model, since params may have changed
@@ -229,6 +253,130 @@ class Trainer(object):
 
         return extra_state
 
+    def _upgrade_optimizer_state(self, optimizer_state, numels):
+        """Drop the state of the parameters of a checkpoint that the model
+        does not have (e.g. those removed by its upgrade_state_dict), given
+        the number of elements of each tensor of the checkpoint. Returns
+        ``None`` if the optimizer has to be reset."""
+        model = self.get_model()
+        # tied weights have several names but are optimized once
+        params = dict(model.named_parameters(remove_duplicate=False))
+        num_params = len({id(p) for p in params.values() if p.requires_grad})
+        buffers = {n for n, _ in model.named_buffers()}
+        if all(k in params or k in buffers for k, _ in numels):
+            # the upgrade removed no parameters
+            return optimizer_state
+        old_params, seen = [], set()
+        for k, n in numels:
+            if k in buffers:
+                continue
+            if k in params:
+                if not params[k].requires_grad or id(params[k]) in seen:
+                    continue
+                seen.add(id(params[k]))
+            old_params.append((k, n))
+        if len(old_params) == num_params:
+            # only renamed
+            return optimizer_state
+        kept = set(params)
+        criterion_numels = [p.numel() for p in self.get_criterion().parameters() if p.requires_grad]
+        optimizer_state = checkpoint_utils.prune_optimizer_state(
+            optimizer_state,
+            [k in kept for k, _ in old_params] + [True] * len(criterion_numels),
+            [n for _, n in old_params] + criterion_numels,
+        )
+        if optimizer_state is None:
+            logger.warning(
+                "the parameters of the checkpoint do not match the model, resetting the optimizer"
+            )
+        else:
+            logger.info(
+                "dropped the optimizer state of {} parameters of the checkpoint that the "
+                "model does not have".format(len(old_params) - num_params)
+            )
+        return optimizer_state
+
+    def _remove_modules(self, modules):
+        """Remove *modules* from the model (see checkpoint_utils.remove_modules)
+        and record them in the checkpoints."""
+        checkpoint_utils.remove_modules(self.get_model(), modules)
+        self.args.slimmed_modules = sorted(
+            set(getattr(self.args, "slimmed_modules", None) or []) | set(modules)
+        )
+        # rebuilt for the remaining parameters
+        self._wrapped_model = None
+        self._optimizer = None
+        self._lr_scheduler = None
+
+    def _slim_model(self):
+        """Track which parameters receive a gradient, and after the first
+        --slim-after-updates updates remove the modules whose parameters did
+        not, keeping the optimizer state of the other parameters.
+
+        The image modules only get gradients from batches with images, so
+        tracking goes on until such a batch was seen."""
+        model = self.get_model()
+        named_params = [(n, p) for n, p in model.named_parameters() if p.requires_grad]
+        no_grad = torch.zeros((), dtype=torch.bool, device=named_params[0][1].device)
+        # with --ddp-backend=no_c10d, missing gradients are filled with zeros
+        has_grad = torch.stack([
+            p.grad.ne(0).any() if p.grad is not None else no_grad for _, p in named_params
+        ])
+        self._has_grad = has_grad if self._has_grad is None else self._has_grad | has_grad
+        if self.get_num_updates() < self.args.slim_after_updates:
+            return
+
+        # the last entry counts the workers that saw a batch with images
+        has_grad = torch.cat([
+            self._has_grad.float(), self._has_grad.new_tensor([self._slim_saw_images]).float(),
+        ])
+        if self.args.distributed_world_size > 1:
+            distributed_utils.all_reduce(has_grad)
+        has_grad = has_grad.tolist()
+        takes_images = getattr(getattr(model, "encoder", None), "img_fc", None) is not None
+        if takes_images and has_grad[-1] == 0:
+            if "slim_no_images" not in self._warn_once:
+                self._warn_once.add("slim_no_images")
+                logger.warning(
+                    "no batch with images in {} updates, not removing modules until one is seen".format(
+                        self.get_num_updates()
+                    )
+                )
+            return
+        unused = [n for (n, _), h in zip(named_params, has_grad) if h == 0]
+        modules = checkpoint_utils.unused_modules(model, unused)
+        # done tracking
+        self.args.slim_after_updates = 0
+        self._has_grad = None
+        self._slim_saw_images = False
+        if len(modules) == 0:
+            logger.info("no module without gradients to remove")
+            return
+
+        removed = {
+            id(p) for m in modules for p in checkpoint_utils._get_module(model, m).parameters()
+        }
+        params = [p for _, p in named_params] + [
+            p for p in self.get_criterion().parameters() if p.requires_grad
+        ]
+        optimizer_state = checkpoint_utils.prune_optimizer_state(
+            self.optimizer.state_dict(),
+            [id(p) not in removed for p in params],
+            [p.numel() for p in params],
+        )
+        lr_scheduler_state = self.lr_scheduler.state_dict()
+        self._remove_modules(modules)
+        if optimizer_state is not None:
+            self.optimizer.load_state_dict(optimizer_state)
+        self.lr_scheduler.load_state_dict(lr_scheduler_state)
+        self.lr_scheduler.step_update(self.get_num_updates())
+        logger.info(
+            "removed {} modules without gradients in {} updates ({} parameters): {}".format(
+                len(modules), self.get_num_updates(),
+                sum(p.numel() for p in params if id(p) in removed), ", ".join(modules),
+            )
+        )
+
     def get_train_iterator(
         self,
         epoch,
@@ -262,6 +410,7 @@ class Trainer(object):
             shard_id=self.args.distributed_rank if shard_batch_itr else 0,
             num_workers=self.args.num_workers,
             epoch=epoch,
+            prefetch_to_device=self.prefetch_to_device,
         )
 
     @metrics.aggregate("train")
@@ -288,6 +437,8 @@ class Trainer(object):
                 ignore_grad = True
             else:
                 ignore_grad = False
+                if sample.get("net_input", {}).get("src_img_features") is not None:
+                    self._slim_saw_images = True
 
             def maybe_no_sync():
                 """
@@ -370,6 +521,9 @@ class Trainer(object):
             # task specific update per step
             self.task.update_step(self.get_num_updates())
 
+            if getattr(self.args, "slim_after_updates", 0) > 0:
+                self._slim_model()
+
             # log stats
             logging_output = self._reduce_and_log_stats(logging_outputs, sample_size)
             metrics.log_speed("ups", 1., ignore_first=10, priority=100, round=2)
@@ -539,7 +693,8 @@ class Trainer(object):
             return None
 
         if self.cuda:
-            sample = utils.move_to_cuda(sample)
+            # a no-op for batches already prefetched to the GPU
+            sample = utils.move_to_cuda(sample, non_blocking=True)
 
         def apply_half(t):
             if t.dtype is torch.float32:
@@ -0,0 +1,229 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from concurrent.futures import Future
+import itertools
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+from fairseq import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+# queued by TranslationServer.stop after the last request
+_STOP = object()
+
+
+class TranslationRequest(object):
+    """A sentence (and optionally the features of its image) to translate."""
+
+    def __init__(self, id, src_str, src_tokens, src_img_features):
+        self.id = id
+        self.src_str = src_str
+        self.src_tokens = src_tokens
+        self.src_img_features = src_img_features
+        self.num_regions = 0 if src_img_features is None else len(src_img_features)
+        self.future = Future()
+        self.arrival = time.perf_counter()
+        self.latency = None
+
+
+class TranslationServer(object):
+    """Translate concurrent requests with a worker thread that batches them
+    dynamically.
+
+    The worker takes the oldest pending request and adds any others that
+    arrive within *max_wait* seconds of it, until the padded batch would
+    exceed *max_tokens* source tokens, *max_regions* image regions or
+    *max_sentences* sentences. Each request made with :func:`submit` holds a
+    :class:`~concurrent.futures.Future` of the hypotheses of its sentence.
+
+    Args:
+        task (~fairseq.tasks.FairseqTask): builds the inference datasets and
+            runs the generator
+        models (List[~fairseq.models.FairseqModel]): ensemble to translate
+            with
+        generator: e.g., a :class:`~fairseq.sequence_generator.SequenceGenerator`
+        encode_fn (callable, optional): tokenizes and applies BPE to the
+            source sentences
+        image_store (~fairseq.data.image_feature_dataset.ImageFeatureStore,
+            optional): resolves the images of the requests to features
+        max_tokens (int, optional): max number of padded source tokens in a
+            batch
+        max_regions (int, optional): max number of padded image regions in a
+            batch
+        max_sentences (int, optional): max number of sentences in a batch
+        max_wait (float, optional): seconds that the oldest request of a
+            batch waits for others (default: 0.005)
+        max_positions (int, optional): max number of tokens of a source
+            sentence
+        use_cuda (bool, optional): run the models on GPU (default: False)
+    """
+
+    def __init__(
+        self, task, models, generator, encode_fn=None, image_store=None,
+        max_tokens=None, max_regions=None, max_sentences=None, max_wait=0.005,
+        max_positions=None, use_cuda=False,
+    ):
+        self.task = task
+        self.models = models
+        self.generator = generator
+        self.encode_fn = encode_fn
+        self.image_store = image_store
+        self.max_tokens = max_tokens
+        self.max_regions = max_regions
+        self.max_sentences = max_sentences
+        self.max_wait = max_wait
+        self.max_positions = max_positions
+        self.use_cuda = use_cuda
+
+        self._ids = itertools.count()
+        self._queue = queue.Queue()
+        self._pending = None
+        self._worker = None
+        self._latencies = []
+        self._batch_sizes = []
+        self._first_arrival = None
+        self._last_finish = None
+
+    def start(self):
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+        return self
+
+    def stop(self):
+        """Translate the pending requests and stop the worker."""
+        self._queue.put(_STOP)
+        self._worker.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def submit(self, src_str, image=None):
+        """Queue *src_str* for translation, with the image *image* (see
+        :class:`~fairseq.data.image_feature_dataset.ImageFeatureStore`).
+
+        The sentence is encoded and its image features resolved on the
+        calling thread. Returns the :class:`TranslationRequest`, whose
+        ``future`` holds the hypotheses of the sentence on CPU.
+        """
+        src_tokens = self.task.source_dictionary.encode_line(
+            self.encode_fn(src_str) if self.encode_fn is not None else src_str,
+            add_if_not_exist=False,
+        ).long()
+        if self.max_positions is not None and src_tokens.numel() > self.max_positions:
+            raise ValueError('sentence has {} tokens, more than the max of {}'.format(
+                src_tokens.numel(), self.max_positions,
+            ))
+        src_img_features = None
+        if image is not None and image != '':
+            if self.image_store is None:
+                raise ValueError('image {} given without an image feature store'.format(image))
+            src_img_features = self.image_store(image)
+        request = TranslationRequest(next(self._ids), src_str, src_tokens, src_img_features)
+        self._queue.put(request)
+        return request
+
+    def _fits(self, batch, request):
+        n = len(batch) + 1
+        if self.max_sentences is not None and n > self.max_sentences:
+            return False
+        if self.max_tokens is not None and n * max(
+            request.src_tokens.numel(), max(r.src_tokens.numel() for r in batch)
+        ) > self.max_tokens:
+            return False
+        if self.max_regions is not None and n * max(
+            request.num_regions, max(r.num_regions for r in batch)
+        ) > self.max_regions:
+            return False
+        return True
+
+    def _next_batch(self):
+        """Return the next batch of requests, or ``None`` once stopped."""
+        first = self._pending if self._pending is not None else self._queue.get()
+        self._pending = None
+        if first is _STOP:
+            return None
+        batch = [first]
+        deadline = first.arrival + self.max_wait
+        while True:
+            try:
+                request = self._queue.get(timeout=max(deadline - time.perf_counter(), 0.))
+            except queue.Empty:
+                break
+            if request is _STOP or not self._fits(batch, request):
+                # left for the next batch
+                self._pending = request
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            try:
+                hypos = self._translate(batch)
+            except Exception as e:
+                logger.exception('failed to translate a batch of {} requests'.format(len(batch)))
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            finish = time.perf_counter()
+            for request, hypos_i in zip(batch, hypos):
+                request.latency = finish - request.arrival
+                self._latencies.append(request.latency)
+                request.future.set_result(hypos_i)
+            self._batch_sizes.append(len(batch))
+            if self._first_arrival is None:
+                self._first_arrival = batch[0].arrival
+            self._last_finish = finish
+
+    def _translate(self, batch):
+        src_tokens = [r.src_tokens for r in batch]
+        src_lengths = [t.numel() for t in src_tokens]
+        if any(r.src_img_features is not None for r in batch):
+            dataset = self.task.build_dataset_for_inference(
+                src_tokens, src_lengths, src_img_features=[r.src_img_features for r in batch],
+            )
+        else:
+            dataset = self.task.build_dataset_for_inference(src_tokens, src_lengths)
+        sample = dataset.collater([dataset[i] for i in range(len(batch))])
+        if self.use_cuda:
+            sample = utils.move_to_cuda(sample)
+        translations = self.task.inference_step(self.generator, self.models, sample)
+        hypos = [None] * len(batch)
+        for i, hypos_i in zip(sample['id'].tolist(), translations):
+            hypos[i] = [
+                {k: v.cpu() if torch.is_tensor(v) else v for k, v in hypo.items()}
+                for hypo in hypos_i
+            ]
+        return hypos
+
+    def stats(self):
+        """Return the number of translated requests, their p50/p99 latency
+        (in ms), the mean batch size and the throughput (in requests/s)."""
+        if len(self._latencies) == 0:
+            return {'requests': 0}
+        latencies = 1000 * np.array(self._latencies)
+        elapsed = self._last_finish - self._first_arrival
+        return {
+            'requests': len(latencies),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'batch_size': float(np.mean(self._batch_sizes)),
+            'requests_per_s': len(latencies) / elapsed if elapsed > 0 else float('inf'),
+        }
@@ -54,9 +54,9 @@ def apply_to_sample(f, sample):
     return _apply(sample)
 
 
-def move_to_cuda(sample):
+def move_to_cuda(sample, non_blocking=False):
     def _move_to_cuda(tensor):
-        return tensor.cuda()
+        return tensor.cuda(non_blocking=non_blocking)
 
     return apply_to_sample(_move_to_cuda, sample)
 
@@ -7,10 +7,13 @@
 Translate pre-processed data with a trained model.
 """
 
+import io
 import logging
 import math
 import os
+import queue
 import sys
+import threading
 
 import torch
 
@@ -18,6 +21,42 @@ from fairseq import bleu, checkpoint_utils, options, progress_bar, tasks, utils
 from fairseq.meters import StopwatchMeter, TimeMeter
 
 
+class Pipeline(object):
+    """Call *fn* on the items :func:`put` into a queue of up to *depth* items,
+    in order, on a background thread."""
+
+    def __init__(self, fn, depth):
+        self.fn = fn
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    self.fn(*item)
+                except Exception as e:
+                    # keep consuming, so that put never blocks
+                    self.error = e
+
+    def put(self, *item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def close(self):
+        """Wait for the queued items to be processed."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
 def main(args):
     assert args.path is not None, '--path required for generation!'
     assert not args.sampling or args.nbest == args.beam, \
@@ -81,6 +120,12 @@ def _main(args, output_file):
         if use_cuda:
             model.cuda()
 
+    if args.img_proj_cache:
+        task.load_img_projection_cache(args.gen_subset, models)
+    if args.gate_exit_threshold is not None:
+        for model in models:
+            model.encoder.set_gate_exit(args.gate_exit_threshold, args.gate_exit_per_sentence)
+
     # Load alignment dictionary for unknown word replacement
     # (None if no unknown word replacement, empty if no path to align dictionary)
     align_dict = utils.load_align_dict(args.replace_unk)
@@ -99,6 +144,7 @@ def _main(args, output_file):
         num_shards=args.num_shards,
         shard_id=args.shard_id,
         num_workers=args.num_workers,
+        prefetch_to_device=use_cuda and not args.no_device_prefetch,
     ).next_epoch_itr(shuffle=False)
 
     # Initialize generator
@@ -109,9 +155,105 @@ def _main(args, output_file):
     if args.sacrebleu:
         scorer = bleu.SacrebleuScorer()
     else:
-        scorer = bleu.Scorer(tgt_dict.pad(), tgt_dict.eos(), tgt_dict.unk())
+        scorer = bleu.BatchScorer(tgt_dict.pad(), tgt_dict.eos(), tgt_dict.unk())
+    # score the tokens of whole batches where they were generated, unless
+    # they need to be detokenized first
+    score_batches = not args.sacrebleu and align_dict is None and args.remove_bpe is None
     num_sentences = 0
     has_target = True
+
+    def postprocess(sample, hypos, out=output_file):
+        """Print the translations of a batch to *out* and score them."""
+        for i, sample_id in enumerate(sample['id'].tolist()):
+            has_target = sample['target'] is not None
+
+            # Remove padding
+            src_tokens = utils.strip_pad(sample['net_input']['src_tokens'][i, :], tgt_dict.pad())
+            target_tokens = None
+            if has_target:
+                target_tokens = utils.strip_pad(sample['target'][i, :], tgt_dict.pad()).int().cpu()
+
+            # Either retrieve the original sentences or regenerate them from tokens.
+            if align_dict is not None:
+                src_str = task.dataset(args.gen_subset).src.get_original_text(sample_id)
+                target_str = task.dataset(args.gen_subset).tgt.get_original_text(sample_id)
+            else:
+                if src_dict is not None:
+                    src_str = src_dict.string(src_tokens, args.remove_bpe)
+                else:
+                    src_str = ""
+                if has_target:
+                    target_str = tgt_dict.string(target_tokens, args.remove_bpe, escape_unk=True)
+
+            if not args.quiet:
+                if src_dict is not None:
+                    print('S-{}\t{}'.format(sample_id, src_str), file=out)
+                if has_target:
+                    print('T-{}\t{}'.format(sample_id, target_str), file=out)
+
+            # Process top predictions
+            for j, hypo in enumerate(hypos[i][:args.nbest]):
+                hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
+                    hypo_tokens=hypo['tokens'].int().cpu(),
+                    src_str=src_str,
+                    alignment=hypo['alignment'],
+                    align_dict=align_dict,
+                    tgt_dict=tgt_dict,
+                    remove_bpe=args.remove_bpe,
+                )
+
+                if not args.quiet:
+                    score = hypo['score'] / math.log(2)  # convert to base 2
+                    print('H-{}\t{}\t{}'.format(sample_id, score, hypo_str), file=out)
+                    print('P-{}\t{}'.format(
+                        sample_id,
+                        ' '.join(map(
+                            lambda x: '{:.4f}'.format(x),
+                            # convert from base e to base 2
+                            hypo['positional_scores'].div_(math.log(2)).tolist(),
+                        ))
+                    ), file=out)
+
+                    if args.print_alignment:
+                        print('A-{}\t{}'.format(
+                            sample_id,
+                            ' '.join(['{}-{}'.format(src_idx, tgt_idx) for src_idx, tgt_idx in alignment])
+                        ), file=out)
+
+                    if args.print_step:
+                        print('I-{}\t{}'.format(sample_id, hypo['steps']), file=out)
+
+                    if getattr(args, 'retain_iter_history', False):
+                        for step, h in enumerate(hypo['history']):
+                            _, h_str, _ = utils.post_process_prediction(
+                                hypo_tokens=h['tokens'].int().cpu(),
+                                src_str=src_str,
+                                alignment=None,
+                                align_dict=None,
+                                tgt_dict=tgt_dict,
+                                remove_bpe=None,
+                            )
+                            print('E-{}_{}\t{}'.format(sample_id, step, h_str), file=out)
+
+                # Score only the top hypothesis
+                if has_target and j == 0 and not score_batches:
+                    if align_dict is not None or args.remove_bpe is not None:
+                        # Convert back to tokens for evaluation with unk replacement and/or without BPE
+                        target_tokens = tgt_dict.encode_line(target_str, add_if_not_exist=True)
+                    if hasattr(scorer, 'add_string'):
+                        scorer.add_string(target_str, hypo_str)
+                    else:
+                        scorer.add(target_tokens, hypo_tokens)
+
+    def write_batch(sample, hypos):
+        # written at once, not interleaved with the log lines of the main thread
+        out = io.StringIO()
+        postprocess(sample, hypos, out)
+        output_file.write(out.getvalue())
+
+    if args.pipeline:
+        pipeline = Pipeline(write_batch, args.pipeline_depth)
+
     with progress_bar.build_progress_bar(args, itr) as t:
         wps_meter = TimeMeter()
         for sample in t:
@@ -128,91 +270,30 @@ def _main(args, output_file):
             num_generated_tokens = sum(len(h[0]['tokens']) for h in hypos)
             gen_timer.stop(num_generated_tokens)
 
-            for i, sample_id in enumerate(sample['id'].tolist()):
-                has_target = sample['target'] is not None
-
-                # Remove padding
-                src_tokens = utils.strip_pad(sample['net_input']['src_tokens'][i, :], tgt_dict.pad())
-                target_tokens = None
-                if has_target:
-                    target_tokens = utils.strip_pad(sample['target'][i, :], tgt_dict.pad()).int().cpu()
-
-                # Either retrieve the original sentences or regenerate them from tokens.
-                if align_dict is not None:
-                    src_str = task.dataset(args.gen_subset).src.get_original_text(sample_id)
-                    target_str = task.dataset(args.gen_subset).tgt.get_original_text(sample_id)
-                else:
-                    if src_dict is not None:
-                        src_str = src_dict.string(src_tokens, args.remove_bpe)
-                    else:
-                        src_str = ""
-                    if has_target:
-                        target_str = tgt_dict.string(target_tokens, args.remove_bpe, escape_unk=True)
-
-                if not args.quiet:
-                    if src_dict is not None:
-                        print('S-{}\t{}'.format(sample_id, src_str), file=output_file)
-                    if has_target:
-                        print('T-{}\t{}'.format(sample_id, target_str), file=output_file)
-
-                # Process top predictions
-                for j, hypo in enumerate(hypos[i][:args.nbest]):
-                    hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
-                        hypo_tokens=hypo['tokens'].int().cpu(),
-                        src_str=src_str,
-                        alignment=hypo['alignment'],
-                        align_dict=align_dict,
-                        tgt_dict=tgt_dict,
-                        remove_bpe=args.remove_bpe,
-                    )
-
-                    if not args.quiet:
-                        score = hypo['score'] / math.log(2)  # convert to base 2
-                        print('H-{}\t{}\t{}'.format(sample_id, score, hypo_str), file=output_file)
-                        print('P-{}\t{}'.format(
-                            sample_id,
-                            ' '.join(map(
-                                lambda x: '{:.4f}'.format(x),
-                                # convert from base e to base 2
-                                hypo['positional_scores'].div_(math.log(2)).tolist(),
-                            ))
-                        ), file=output_file)
-
-                        if args.print_alignment:
-                            print('A-{}\t{}'.format(
-                                sample_id,
-                                ' '.join(['{}-{}'.format(src_idx, tgt_idx) for src_idx, tgt_idx in alignment])
-                            ), file=output_file)
-
-                        if args.print_step:
-                            print('I-{}\t{}'.format(sample_id, hypo['steps']), file=output_file)
-
-                        if getattr(args, 'retain_iter_history', False):
-                            for step, h in enumerate(hypo['history']):
-                                _, h_str, _ = utils.post_process_prediction(
-                                    hypo_tokens=h['tokens'].int().cpu(),
-                                    src_str=src_str,
-                                    alignment=None,
-                                    align_dict=None,
-                                    tgt_dict=tgt_dict,
-                                    remove_bpe=None,
-                                )
-                                print('E-{}_{}\t{}'.format(sample_id, step, h_str), file=output_file)
-
-                    # Score only the top hypothesis
-                    if has_target and j == 0:
-                        if align_dict is not None or args.remove_bpe is not None:
-                            # Convert back to tokens for evaluation with unk replacement and/or without BPE
-                            target_tokens = tgt_dict.encode_line(target_str, add_if_not_exist=True)
-                        if hasattr(scorer, 'add_string'):
-                            scorer.add_string(target_str, hypo_str)
-                        else:
-                            scorer.add(target_tokens, hypo_tokens)
+            has_target = sample['target'] is not None
+            if has_target and score_batches:
+                scorer.add_batch(sample['target'], [h[0]['tokens'] for h in hypos])
+            if args.pipeline:
+                # copy to CPU here, as copies queued by the background thread
+                # would wait for the next batch to be decoded
+                pipeline.put(
+                    utils.apply_to_sample(lambda t: t.cpu(), {
+                        'id': sample['id'],
+                        'net_input': {'src_tokens': sample['net_input']['src_tokens']},
+                        'target': sample['target'],
+                    }),
+                    utils.apply_to_sample(lambda t: t.cpu(), hypos),
+                )
+            else:
+                postprocess(sample, hypos)
 
             wps_meter.update(num_generated_tokens)
             t.log({'wps': round(wps_meter.avg)})
             num_sentences += sample['nsentences']
 
+    if args.pipeline:
+        pipeline.close()
+
     logger.info('NOTE: hypothesis and token scores are output in base 2')
     logger.info('Translated {} sentences ({} tokens) in {:.1f}s ({:.2f} sentences/s, {:.2f} tokens/s)'.format(
         num_sentences, gen_timer.n, gen_timer.sum, num_sentences / gen_timer.sum, 1. / gen_timer.avg))
@@ -11,13 +11,16 @@ from collections import namedtuple
 import fileinput
 import logging
 import math
+import queue
 import sys
 import os
+import threading
 
 import torch
 
 from fairseq import checkpoint_utils, options, tasks, utils
-from fairseq.data import encoders
+from fairseq.data import encoders, ImageFeatureStore
+from fairseq.translation_server import TranslationServer
 
 
 logging.basicConfig(
@@ -29,7 +32,7 @@ logging.basicConfig(
 logger = logging.getLogger('fairseq_cli.interactive')
 
 
-Batch = namedtuple('Batch', 'ids src_tokens src_lengths')
+Batch = namedtuple('Batch', 'ids src_tokens src_lengths src_img_features src_img_lengths src_img_batch')
 Translation = namedtuple('Translation', 'src_str hypos pos_scores alignments')
 
 
@@ -46,7 +49,16 @@ def buffered_read(input, buffer_size):
         yield buffer
 
 
-def make_batches(lines, args, task, max_positions, encode_fn):
+def parse_line(line):
+    """Split an input line into the source sentence and the image, given
+    after a tab as an id in --img-store or the path of a .npy file of image
+    features, or ``None``."""
+    src_str, _, image = line.partition('\t')
+    return src_str, image or None
+
+
+def make_batches(lines, args, task, max_positions, encode_fn, image_store=None):
+    lines, images = zip(*[parse_line(line) for line in lines])
     tokens = [
         task.source_dictionary.encode_line(
             encode_fn(src_str), add_if_not_exist=False
@@ -54,8 +66,15 @@ def make_batches(lines, args, task, max_positions, encode_fn):
         for src_str in lines
     ]
     lengths = [t.numel() for t in tokens]
+    if any(image is not None for image in images):
+        image_store = image_store if image_store is not None else ImageFeatureStore()
+        dataset = task.build_dataset_for_inference(
+            tokens, lengths, src_img_features=[image_store(image) for image in images],
+        )
+    else:
+        dataset = task.build_dataset_for_inference(tokens, lengths)
     itr = task.get_batch_iterator(
-        dataset=task.build_dataset_for_inference(tokens, lengths),
+        dataset=dataset,
         max_tokens=args.max_tokens,
         max_sentences=args.max_sentences,
         max_positions=max_positions,
@@ -65,6 +84,51 @@ def make_batches(lines, args, task, max_positions, encode_fn):
         yield Batch(
             ids=batch['id'],
             src_tokens=batch['net_input']['src_tokens'], src_lengths=batch['net_input']['src_lengths'],
+            src_img_features=batch['net_input'].get('src_img_features'),
+            src_img_lengths=batch['net_input'].get('src_img_lengths'),
+            src_img_batch=batch['net_input'].get('src_img_batch'),
+        )
+
+
+def serve(server, lines, print_translation):
+    """Submit each of *lines* to *server* as soon as it is read, and print
+    the translations in input order as they complete."""
+    requests = queue.Queue()
+
+    def printer():
+        while True:
+            item = requests.get()
+            if item is None:
+                break
+            id, request = item
+            try:
+                hypos = request.future.result()
+            except Exception as e:
+                logger.warning('failed to translate sentence {}: {}'.format(id, e))
+                continue
+            print_translation(id, request.src_tokens, hypos)
+            sys.stdout.flush()
+
+    printer_thread = threading.Thread(target=printer, daemon=True)
+    printer_thread.start()
+    try:
+        with server:
+            for id, line in enumerate(lines):
+                src_str, image = parse_line(line)
+                try:
+                    requests.put((id, server.submit(src_str, image)))
+                except ValueError as e:
+                    logger.warning('skipping sentence {}: {}'.format(id, e))
+    finally:
+        # print the translations already submitted
+        requests.put(None)
+        printer_thread.join()
+
+    stats = server.stats()
+    if stats['requests'] > 0:
+        logger.info(
+            'translated {requests} sentences in batches of {batch_size:.1f} on average, '
+            'latency p50 {p50_ms:.1f} ms, p99 {p99_ms:.1f} ms, {requests_per_s:.1f} sentences/s'.format(**stats)
         )
 
 
@@ -73,12 +137,12 @@ def main(args):
 
     if args.buffer_size < 1:
         args.buffer_size = 1
-    if args.max_tokens is None and args.max_sentences is None:
+    if args.max_tokens is None and args.max_sentences is None and not getattr(args, 'serve', False):
         args.max_sentences = 1
 
     assert not args.sampling or args.nbest == args.beam, \
         '--sampling requires --nbest to be equal to --beam'
-    assert not args.max_sentences or args.max_sentences <= args.buffer_size, \
+    assert getattr(args, 'serve', False) or not args.max_sentences or args.max_sentences <= args.buffer_size, \
         '--max-sentences/--batch-size cannot be larger than --buffer-size'
 
     logger.info(args)
@@ -141,6 +205,54 @@ def main(args):
         *[model.max_positions() for model in models]
     )
 
+    image_store = ImageFeatureStore(getattr(args, 'img_store', None))
+
+    def print_translation(id, src_tokens, hypos):
+        if src_dict is not None:
+            src_str = src_dict.string(src_tokens, args.remove_bpe)
+            print('S-{}\t{}'.format(id, src_str))
+
+        # Process top predictions
+        for hypo in hypos[:min(len(hypos), args.nbest)]:
+            hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
+                hypo_tokens=hypo['tokens'].int().cpu(),
+                src_str=src_str,
+                alignment=hypo['alignment'],
+                align_dict=align_dict,
+                tgt_dict=tgt_dict,
+                remove_bpe=args.remove_bpe,
+            )
+            hypo_str = decode_fn(hypo_str)
+            score = hypo['score'] / math.log(2)  # convert to base 2
+            print('H-{}\t{}\t{}'.format(id, score, hypo_str))
+            print('P-{}\t{}'.format(
+                id,
+                ' '.join(map(
+                    lambda x: '{:.4f}'.format(x),
+                    # convert from base e to base 2
+                    hypo['positional_scores'].div_(math.log(2)).tolist(),
+                ))
+            ))
+            if args.print_alignment:
+                alignment_str = " ".join(["{}-{}".format(src, tgt) for src, tgt in alignment])
+                print('A-{}\t{}'.format(
+                    id,
+                    alignment_str
+                ))
+
+    if getattr(args, 'serve', False):
+        server = TranslationServer(
+            task, models, generator, encode_fn=encode_fn, image_store=image_store,
+            max_tokens=args.max_tokens, max_regions=args.max_regions, max_sentences=args.max_sentences,
+            max_wait=args.max_wait_ms / 1000.,
+            max_positions=max_positions[0] if isinstance(max_positions, tuple) else max_positions,
+            use_cuda=use_cuda,
+        )
+        logger.info('NOTE: hypothesis and token scores are output in base 2')
+        logger.info('Type the input sentence (and a tab and its image) and press return:')
+        serve(server, (line for lines in buffered_read(args.input, 1) for line in lines), print_translation)
+        return
+
     if args.buffer_size > 1:
         logger.info('Sentence buffer size: %s', args.buffer_size)
     logger.info('NOTE: hypothesis and token scores are output in base 2')
@@ -148,17 +260,27 @@ def main(args):
     start_id = 0
     for inputs in buffered_read(args.input, args.buffer_size):
         results = []
-        for batch in make_batches(inputs, args, task, max_positions, encode_fn):
+        for batch in make_batches(inputs, args, task, max_positions, encode_fn, image_store):
             src_tokens = batch.src_tokens
             src_lengths = batch.src_lengths
+            src_img_features = batch.src_img_features
+            src_img_lengths = batch.src_img_lengths
+            src_img_batch = batch.src_img_batch
             if use_cuda:
                 src_tokens = src_tokens.cuda()
                 src_lengths = src_lengths.cuda()
+                if src_img_features is not None:
+                    src_img_features = src_img_features.cuda()
+                    src_img_lengths = src_img_lengths.cuda()
+                    src_img_batch = src_img_batch.cuda()
 
             sample = {
                 'net_input': {
                     'src_tokens': src_tokens,
                     'src_lengths': src_lengths,
+                    'src_img_features': src_img_features,
+                    'src_img_lengths': src_img_lengths,
+                    'src_img_batch': src_img_batch,
                 },
             }
             translations = task.inference_step(generator, models, sample)
@@ -168,37 +290,7 @@ def main(args):
 
         # sort output to match input order
         for id, src_tokens, hypos in sorted(results, key=lambda x: x[0]):
-            if src_dict is not None:
-                src_str = src_dict.string(src_tokens, args.remove_bpe)
-                print('S-{}\t{}'.format(id, src_str))
-
-            # Process top predictions
-            for hypo in hypos[:min(len(hypos), args.nbest)]:
-                hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
-                    hypo_tokens=hypo['tokens'].int().cpu(),
-                    src_str=src_str,
-                    alignment=hypo['alignment'],
-                    align_dict=align_dict,
-                    tgt_dict=tgt_dict,
-                    remove_bpe=args.remove_bpe,
-                )
-                hypo_str = decode_fn(hypo_str)
-                score = hypo['score'] / math.log(2)  # convert to base 2
-                print('H-{}\t{}\t{}'.format(id, score, hypo_str))
-                print('P-{}\t{}'.format(
-                    id,
-                    ' '.join(map(
-                        lambda x: '{:.4f}'.format(x),
-                        # convert from base e to base 2
-                        hypo['positional_scores'].div_(math.log(2)).tolist(),
-                    ))
-                ))
-                if args.print_alignment:
-                    alignment_str = " ".join(["{}-{}".format(src, tgt) for src, tgt in alignment])
-                    print('A-{}\t{}'.format(
-                        id,
-                        alignment_str
-                    ))
+            print_translation(id, src_tokens, hypos)
 
         # update running id counter
         start_id += len(inputs)
@@ -15,8 +15,10 @@ import os
 import shutil
 import sys
 
+import numpy as np
+
 from fairseq import options, tasks, utils
-from fairseq.data import indexed_dataset
+from fairseq.data import image_feature_dataset, indexed_dataset
 from fairseq.binarizer import Binarizer
 
 
@@ -256,11 +258,129 @@ def main(args):
         if args.testpref and os.path.exists(args.testpref + "." + args.align_suffix):
             make_binary_alignment_dataset(args.testpref + "." + args.align_suffix, "test.align", num_workers=args.workers)
 
+    def make_img_features(input_prefix, output_prefix, num_workers):
+        prefix = dataset_dest_prefix(args, output_prefix, args.source_lang)
+        if args.img_features:
+            input_file = "{}.{}".format(input_prefix, args.img_features)
+        else:
+            input_file = prefix + ".npy"
+        if not os.path.exists(input_file):
+            logger.warning("[img] {} not found, skipping".format(input_file))
+            return
+        features = image_feature_dataset.NumpyImageFeatureDataset(input_file)
+        feature_format = args.img_format or "float32"
+
+        # validate and reorder: one feature row per source sentence
+        with open("{}.{}".format(input_prefix, args.source_lang), "r", encoding="utf-8") as f:
+            num_sents = sum(1 for _ in f)
+        if args.img_order:
+            rows = np.loadtxt("{}.{}".format(input_prefix, args.img_order), dtype=np.int64, ndmin=1)
+            missing = rows == image_feature_dataset.MISSING_IMAGE
+            if (~missing).any() and (rows[~missing].min() < 0 or rows.max() >= len(features)):
+                raise ValueError("[img] {}.{}: rows must be in [0, {}), or {} for no image".format(
+                    input_prefix, args.img_order, len(features), image_feature_dataset.MISSING_IMAGE))
+        else:
+            rows = np.arange(len(features))
+            missing = np.zeros(len(rows), dtype=bool)
+        if len(rows) != num_sents:
+            raise ValueError("[img] {}: {} image feature rows for {} source sentences".format(
+                input_file, len(rows), num_sents))
+        # sentences without an image are only recorded in the index
+        sent_rows, rows = rows, rows[~missing]
+
+        pool = None
+        if num_workers > 1:
+            pool = Pool(processes=num_workers - 1)
+
+        def chunk_items(chunks):
+            # pickled object arrays cannot be memory-mapped by the workers,
+            # so each one gets the items of its chunk rather than reloading
+            # the whole file
+            if features.memory_mapped:
+                return None
+            return [features] + [{i: features[i].numpy() for i in chunk} for chunk in chunks[1:]]
+
+        table_rows = rows
+        image_ids = np.arange(len(rows))
+        scale, zero_point = None, None
+        if args.img_dedup or feature_format == "int8":
+            chunks = np.array_split(rows, num_workers)
+            scans = _map_img_chunks(
+                pool, scan_img_features, chunks, input_file, features.feature_dim,
+                args.img_dedup, feature_format == "int8", chunk_items(chunks),
+            )
+            if args.img_dedup:
+                unique_indices, image_ids = image_feature_dataset.deduplicate_digests(
+                    [digest for scan in scans for digest in scan["digests"]]
+                )
+                table_rows = rows[unique_indices]
+            if feature_format == "int8":
+                scale, zero_point = image_feature_dataset.quantization_params_from_range(
+                    np.min([scan["lo"] for scan in scans], axis=0),
+                    np.max([scan["hi"] for scan in scans], axis=0),
+                )
+
+        img_prefix = image_feature_dataset.image_feature_prefix(prefix)
+        chunks = np.array_split(table_rows, num_workers)
+        temp_prefixes = [img_prefix] + [
+            image_feature_dataset.image_feature_prefix(
+                dataset_dest_prefix(args, "{}{}".format(output_prefix, worker_id), args.source_lang)
+            )
+            for worker_id in range(1, num_workers)
+        ]
+        results = _map_img_chunks(
+            pool, binarize_img_features, chunks, input_file, features.feature_dim, temp_prefixes,
+            feature_format, scale, zero_point, chunk_items(chunks),
+        )
+        if num_workers > 1:
+            pool.close()
+            pool.join()
+            ds = image_feature_dataset.MMapImageFeatureDatasetBuilder(
+                indexed_dataset.data_file_path(img_prefix + ".merged"), features.feature_dim,
+                feature_format, scale, zero_point,
+            )
+            for temp_file_path in temp_prefixes:
+                ds.merge_file_(temp_file_path)
+                os.remove(indexed_dataset.data_file_path(temp_file_path))
+                os.remove(indexed_dataset.index_file_path(temp_file_path))
+            ds.finalize(indexed_dataset.index_file_path(img_prefix))
+            os.replace(
+                indexed_dataset.data_file_path(img_prefix + ".merged"),
+                indexed_dataset.data_file_path(img_prefix),
+            )
+
+        index_path = image_feature_dataset.image_index_path(img_prefix)
+        if args.img_dedup or missing.any():
+            sent_image_ids = np.full(len(sent_rows), image_feature_dataset.MISSING_IMAGE, dtype=np.int64)
+            sent_image_ids[~missing] = image_ids
+            np.save(index_path, sent_image_ids)
+        elif os.path.exists(index_path):
+            os.remove(index_path)
+
+        logger.info("[img] {}: {} sents ({} without an image), {} images, {} regions as {}".format(
+            input_file, num_sents, missing.sum(), sum(r["nimg"] for r in results),
+            sum(r["nreg"] for r in results), feature_format,
+        ))
+
+    def make_all_img_features():
+        if args.trainpref:
+            make_img_features(args.trainpref, "train", num_workers=args.workers)
+        if args.validpref:
+            for k, validpref in enumerate(args.validpref.split(",")):
+                outprefix = "valid{}".format(k) if k > 0 else "valid"
+                make_img_features(validpref, outprefix, num_workers=args.workers)
+        if args.testpref:
+            for k, testpref in enumerate(args.testpref.split(",")):
+                outprefix = "test{}".format(k) if k > 0 else "test"
+                make_img_features(testpref, outprefix, num_workers=args.workers)
+
     make_all(args.source_lang, src_dict)
     if target:
         make_all(args.target_lang, tgt_dict)
     if args.align_suffix:
         make_all_alignments()
+    if args.img_features or args.img_format or args.img_dedup or args.img_order:
+        make_all_img_features()
 
     logger.info("Wrote preprocessed data to {}".format(args.destdir))
 
@@ -333,6 +453,58 @@ def binarize_alignments(args, filename, parse_alignment, output_prefix, offset,
     return res
 
 
+def _img_features(filename, items):
+    """The image features of a chunk: *items* if given (indexable by row),
+    else those memory-mapped from *filename*."""
+    if items is not None:
+        return items
+    return image_feature_dataset.NumpyImageFeatureDataset(filename)
+
+
+def scan_img_features(filename, rows, feature_dim, dedup, quantize, items=None):
+    features = _img_features(filename, items)
+    res = {}
+    if dedup:
+        res["digests"] = [
+            image_feature_dataset.feature_digest(np.asarray(features[i]).reshape(-1, feature_dim)) for i in rows
+        ]
+    if quantize:
+        res["lo"], res["hi"] = image_feature_dataset.compute_feature_range(features, feature_dim, rows)
+    return res
+
+
+def binarize_img_features(filename, rows, feature_dim, output_prefix, feature_format, scale, zero_point,
+                          items=None):
+    features = _img_features(filename, items)
+    ds = image_feature_dataset.MMapImageFeatureDatasetBuilder(
+        indexed_dataset.data_file_path(output_prefix), feature_dim,
+        feature_format, scale, zero_point,
+    )
+    nreg = 0
+    for i in rows:
+        item = np.asarray(features[i]).reshape(-1, feature_dim)
+        if not np.isfinite(item).all():
+            raise ValueError("{}: non-finite image features in row {}".format(filename, i))
+        ds.add_item(item)
+        nreg += item.shape[0]
+    ds.finalize(indexed_dataset.index_file_path(output_prefix))
+    return {"nimg": len(rows), "nreg": nreg}
+
+
+def _map_img_chunks(pool, fn, chunks, filename, *fn_args):
+    """Run *fn* over ``chunks[1:]`` in *pool* and over ``chunks[0]`` in this
+    process; returns the results in chunk order. List-valued *fn_args* are
+    distributed one element per chunk."""
+    def chunk_args(worker_id):
+        return [a[worker_id] if isinstance(a, list) else a for a in fn_args]
+
+    pending = [
+        pool.apply_async(fn, (filename, chunks[worker_id], *chunk_args(worker_id)))
+        for worker_id in range(1, len(chunks))
+    ]
+    return [fn(filename, chunks[0], *chunk_args(0))] + [r.get() for r in pending]
+
+
 def dataset_dest_prefix(args, output_prefix, lang):
     base = "{}/{}".format(args.destdir, output_prefix)
     if lang is not None:
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3 -u
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Serve translations of JSON-lines requests from stdin or a local socket.
+
+Each request is a line like ``{"id": 1, "src": "a sentence", "image": "12"}``
+(``id`` and ``image`` are optional, see --img-store for images), and is
+answered, possibly out of order, by a line like ``{"id": 1, "translation":
+"...", "score": -0.42}``, or ``{"id": 1, "error": "..."}``. Concurrent
+requests are batched with :class:`~fairseq.hub_utils.BatchingHubInterface`.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+
+import torch
+
+from fairseq import checkpoint_utils, options, tasks, utils
+from fairseq.data import ImageFeatureStore
+from fairseq.hub_utils import BatchingHubInterface, GeneratorHubInterface
+
+
+logging.basicConfig(
+    format='%(asctime)s | %(levelname)s | %(name)s | %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO,
+    stream=sys.stderr,
+)
+logger = logging.getLogger('fairseq_cli.serve')
+
+
+async def respond(server, image_store, line, write):
+    """Translate the request *line* and *write* the response line."""
+    response = {}
+    try:
+        request = json.loads(line)
+        response['id'] = request.get('id')
+        src_img_features = image_store(request.get('image'))
+        hypos = await server.generate(server.hub.encode(request['src']), src_img_features)
+        response['translation'] = server.hub.decode(hypos[0]['tokens'])
+        response['score'] = hypos[0]['score'].item() if torch.is_tensor(hypos[0]['score']) else hypos[0]['score']
+    except Exception as e:
+        response['error'] = '{}: {}'.format(type(e).__name__, e)
+    write(json.dumps(response) + '\n')
+
+
+async def serve_stdin(server, image_store):
+    loop = asyncio.get_event_loop()
+    pending = set()
+
+    def write(line):
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+    while True:
+        # stdin may be a regular file, which asyncio cannot read from
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            break
+        if line.strip():
+            pending.add(asyncio.ensure_future(respond(server, image_store, line, write)))
+        pending = {task for task in pending if not task.done()}
+    if pending:
+        await asyncio.wait(pending)
+
+
+def connection_handler(server, image_store):
+    """Return a callback for :func:`asyncio.start_server` that answers the
+    requests of a connection."""
+    async def handle(reader, writer):
+        pending = set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.strip():
+                pending.add(asyncio.ensure_future(respond(
+                    server, image_store, line.decode('utf-8'), lambda s: writer.write(s.encode('utf-8')),
+                )))
+            pending = {task for task in pending if not task.done()}
+        if pending:
+            await asyncio.wait(pending)
+        await writer.drain()
+        writer.close()
+
+    return handle
+
+
+async def serve_socket(server, image_store, address):
+    handle = connection_handler(server, image_store)
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        socket_server = await asyncio.start_server(handle, host, int(port))
+    else:
+        socket_server = await asyncio.start_unix_server(handle, address)
+    logger.info('serving on {}'.format(address))
+    await socket_server.wait_closed()
+
+
+def main(args):
+    utils.import_user_module(args)
+    logger.info(args)
+
+    use_cuda = torch.cuda.is_available() and not args.cpu
+
+    task = tasks.setup_task(args)
+    logger.info('loading model(s) from {}'.format(args.path))
+    models, _model_args = checkpoint_utils.load_model_ensemble(
+        args.path.split(os.pathsep),
+        arg_overrides=eval(args.model_overrides),
+        task=task,
+    )
+    hub = GeneratorHubInterface(args, task, models)
+    if args.fp16:
+        hub.half()
+    if use_cuda:
+        hub.cuda()
+    hub.eval()
+
+    server = BatchingHubInterface(
+        hub, beam=args.beam, max_tokens=args.max_tokens, max_sentences=args.max_sentences or 64,
+        max_wait=args.max_wait_ms / 1000., bucket_width=args.length_bucket_width,
+    )
+    image_store = ImageFeatureStore(args.img_store)
+
+    loop = asyncio.get_event_loop()
+    if args.socket is None:
+        loop.run_until_complete(serve_stdin(server, image_store))
+    else:
+        loop.run_until_complete(serve_socket(server, image_store, args.socket))
+
+
+def cli_main():
+    parser = options.get_generation_parser(interactive=True)
+    args = options.parse_args_and_arch(parser)
+    main(args)
+
+
+if __name__ == '__main__':
+    cli_main()
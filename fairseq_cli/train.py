@@ -252,6 +252,7 @@ def validate(args, trainer, task, epoch_itr, subsets):
             num_shards=args.distributed_world_size,
             shard_id=args.distributed_rank,
             num_workers=args.num_workers,
+            prefetch_to_device=trainer.prefetch_to_device,
         ).next_epoch_itr(shuffle=False)
         progress = progress_bar.build_progress_bar(
             args, itr, epoch_itr.epoch,
@@ -269,10 +270,10 @@ def validate(args, trainer, task, epoch_itr, subsets):
         stats = get_valid_stats(args, trainer, agg.get_smoothed_values())
         progress.print(stats, tag=subset, step=trainer.get_num_updates())
 
-        writer.add_scalar('valid/bleu', stats['bleu'], epoch_itr.epoch)
+        if 'bleu' in stats:
+            writer.add_scalar('valid/bleu', stats['bleu'], epoch_itr.epoch)
         writer_loss.add_scalar('valid/loss', stats['loss'], epoch_itr.epoch)
 
-
         valid_losses.append(stats[args.best_checkpoint_metric])
     return valid_losses
 
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Compare --max-tokens batching by text length only against batching that also
+counts the image (see LanguagePairDataset.img_cost), by the training
+throughput and peak memory of a model on a synthetic corpus, e.g.:
+
+    python scripts/benchmark_batching.py --arch transformer_iwslt_de_en \\
+        --max-tokens 4096 --num-regions 49
+
+With --fit, instead estimate --img-region-cost and --img-mask-cost for the
+model from the memory of batches of different sentence lengths and numbers of
+regions. Peak memory is measured by CUDA on GPU, and as the memory of the
+activations saved for backward on CPU.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from fairseq.data import Dictionary, LanguagePairDataset, data_utils
+from fairseq.models import ARCH_MODEL_REGISTRY, ARCH_CONFIG_REGISTRY
+
+
+class RandomImages(torch.utils.data.Dataset):
+    """Image features of the given numbers of regions, all views of one
+    random table."""
+
+    def __init__(self, sizes, feature_dim):
+        self.sizes = np.asarray(sizes, dtype=np.int32)
+        self.table = torch.rand(max(self.sizes.max(), 1), feature_dim)
+
+    def __getitem__(self, i):
+        return self.table[:self.sizes[i]]
+
+    def __len__(self):
+        return len(self.sizes)
+
+
+def build_model(args):
+    model_parser = argparse.ArgumentParser()
+    ARCH_MODEL_REGISTRY[args.arch].add_args(model_parser)
+    # leave unset options to the architecture defaults
+    model_args = argparse.Namespace(**{
+        k: v for k, v in vars(model_parser.parse_args([])).items() if v is not None
+    })
+    model_args.arch = args.arch
+    model_args.encoder_layers_to_keep = model_args.decoder_layers_to_keep = None
+    ARCH_CONFIG_REGISTRY[args.arch](model_args)
+
+    vocab = Dictionary()
+    for i in range(args.vocab_size):
+        vocab.add_symbol(str(i))
+    task = argparse.Namespace(source_dictionary=vocab, target_dictionary=vocab)
+    model = ARCH_MODEL_REGISTRY[args.arch].build_model(model_args, task)
+    return model, model_args, vocab
+
+
+class MemoryMeter(object):
+    """Peak memory of the forward/backward passes run under :func:`measure`."""
+
+    def __init__(self, model, use_cuda):
+        self.use_cuda = use_cuda
+        self.params = {p.data_ptr() for p in model.parameters()}
+        self.peak = 0
+
+    def measure(self, fn):
+        if self.use_cuda:
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+            fn()
+            self.peak = max(self.peak, torch.cuda.max_memory_allocated() - base)
+            return
+        saved = {}
+
+        def pack(t):
+            storage = t.untyped_storage()
+            if storage.data_ptr() not in self.params:
+                saved[storage.data_ptr()] = storage.nbytes()
+            return t
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            fn()
+        self.peak = max(self.peak, sum(saved.values()))
+
+
+def train_step(model, batch, device):
+    net_input = {
+        k: v.to(device) if torch.is_tensor(v) else v for k, v in batch['net_input'].items()
+    }
+
+    def step():
+        model.zero_grad()
+        out, _ = model(**net_input)
+        lprobs = torch.log_softmax(out.float(), dim=-1)
+        target = batch['target'].to(device)
+        loss = -lprobs.gather(-1, target.unsqueeze(-1)).sum()
+        loss.backward()
+
+    return step
+
+
+def random_corpus(vocab, lengths, num_regions, feature_dim, **kwargs):
+    tokens = [
+        torch.cat([torch.randint(vocab.nspecial, len(vocab), (n - 1, )), torch.LongTensor([vocab.eos()])])
+        for n in lengths
+    ]
+    return LanguagePairDataset(
+        tokens, lengths, vocab, tokens, lengths, vocab,
+        src_img_features=RandomImages(num_regions, feature_dim), **kwargs
+    )
+
+
+def fit(args, model, model_args, vocab, device, use_cuda):
+    """Fit the memory per sentence to a + b * len + c * regions + d * regions^2."""
+    rows, memory = [], []
+    for src_len in [8, 16, 32]:
+        for num_regions in [0, 25, 49, 100]:
+            dataset = random_corpus(
+                vocab, [src_len] * args.fit_batch_size, [num_regions] * args.fit_batch_size,
+                model_args.img_feature_dim,
+            )
+            batch = dataset.collater([dataset[i] for i in range(len(dataset))])
+            meter = MemoryMeter(model, use_cuda)
+            meter.measure(train_step(model, batch, device))
+            rows.append([1., src_len, num_regions, num_regions ** 2])
+            memory.append(meter.peak / args.fit_batch_size)
+            print('| {} | {} | {:.1f} |'.format(src_len, num_regions, meter.peak / 2 ** 20))
+    coef = np.linalg.lstsq(np.array(rows), np.array(memory), rcond=None)[0]
+    per_token = coef[1]
+    print('memory per token: {:.1f} KB'.format(per_token / 1024))
+    print('--img-region-cost {:.3g} --img-mask-cost {:.3g}'.format(coef[2] / per_token, coef[3] / per_token))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arch', default='transformer_iwslt_de_en',
+                        choices=[a for a, m in ARCH_MODEL_REGISTRY.items() if m.__name__ == 'TransformerModel'])
+    parser.add_argument('--max-tokens', type=int, default=4096)
+    parser.add_argument('--num-sentences', type=int, default=2000)
+    parser.add_argument('--min-len', type=int, default=4)
+    parser.add_argument('--max-len', type=int, default=30)
+    parser.add_argument('--num-regions', type=int, default=49,
+                        help='number of image regions, or the largest with --min-regions')
+    parser.add_argument('--min-regions', type=int, default=None)
+    parser.add_argument('--img-region-cost', type=float, default=0.2)
+    parser.add_argument('--img-mask-cost', type=float, default=0.0002)
+    parser.add_argument('--vocab-size', type=int, default=10000)
+    parser.add_argument('--fit', action='store_true')
+    parser.add_argument('--fit-batch-size', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    model, model_args, vocab = build_model(args)
+    if use_cuda:
+        model.cuda()
+    device = next(model.parameters()).device
+    model.train()
+
+    if args.fit:
+        print('| length | regions | memory (MB) |')
+        print('|---|---|---|')
+        fit(args, model, model_args, vocab, device, use_cuda)
+        return
+
+    lengths = np.random.randint(args.min_len, args.max_len + 1, args.num_sentences)
+    num_regions = np.random.randint(
+        args.min_regions if args.min_regions is not None else args.num_regions,
+        args.num_regions + 1, args.num_sentences,
+    )
+
+    print('| batching | batches | sentences/batch | tokens/s | peak memory (MB) |')
+    print('|---|---|---|---|---|')
+    for name, region_cost, mask_cost in [
+        ('text only', 0., 0.),
+        ('with image', args.img_region_cost, args.img_mask_cost),
+    ]:
+        dataset = random_corpus(
+            vocab, lengths, num_regions, model_args.img_feature_dim, shuffle=False,
+            img_region_cost=region_cost, img_mask_cost=mask_cost,
+        )
+        indices = dataset.ordered_indices()
+        batches = data_utils.batch_by_size(
+            indices, dataset.num_tokens, max_tokens=args.max_tokens,
+            num_tokens_vec=dataset.num_tokens_vec(indices),
+        )
+        meter = MemoryMeter(model, use_cuda)
+        ntokens, elapsed = 0, 0.
+        for batch_indices in batches:
+            batch = dataset.collater([dataset[i] for i in batch_indices])
+            step = train_step(model, batch, device)
+            if use_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            meter.measure(step)
+            if use_cuda:
+                torch.cuda.synchronize()
+            elapsed += time.perf_counter() - start
+            ntokens += batch['ntokens']
+        print('| {} | {} | {:.1f} | {:.0f} | {:.1f} |'.format(
+            name, len(batches), args.num_sentences / len(batches), ntokens / elapsed, meter.peak / 2 ** 20,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Time beam search with the encoder output reordered by copying it (see
+TransformerEncoder.reorder_encoder_out) against reordering it by index (see
+TransformerEncoder.reindex_encoder_out), with a random model on random
+inputs, at the settings of data-generate.sh, e.g.:
+
+    python scripts/benchmark_beam_reorder.py --arch transformer_iwslt_de_en \\
+        --beam 5 --batch-size 128 --num-regions 49
+"""
+
+import argparse
+import time
+from unittest import mock
+
+import torch
+
+from fairseq.data import Dictionary
+from fairseq.models import ARCH_MODEL_REGISTRY, ARCH_CONFIG_REGISTRY
+from fairseq.sequence_generator import SequenceGenerator
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arch', default='transformer_iwslt_de_en',
+                        choices=[a for a, m in ARCH_MODEL_REGISTRY.items() if m.__name__ == 'TransformerModel'])
+    parser.add_argument('--beam', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--src-len', type=int, default=30)
+    parser.add_argument('--max-len', type=int, default=30)
+    parser.add_argument('--num-regions', type=int, default=49)
+    parser.add_argument('--vocab-size', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--fp16', action='store_true')
+    args = parser.parse_args()
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    torch.manual_seed(1)
+
+    model_parser = argparse.ArgumentParser()
+    ARCH_MODEL_REGISTRY[args.arch].add_args(model_parser)
+    # leave unset options to the architecture defaults
+    model_args = argparse.Namespace(**{
+        k: v for k, v in vars(model_parser.parse_args([])).items() if v is not None
+    })
+    model_args.arch = args.arch
+    model_args.encoder_layers_to_keep = model_args.decoder_layers_to_keep = None
+    ARCH_CONFIG_REGISTRY[args.arch](model_args)
+
+    vocab = Dictionary()
+    for i in range(args.vocab_size):
+        vocab.add_symbol(str(i))
+    task = argparse.Namespace(source_dictionary=vocab, target_dictionary=vocab)
+    model = ARCH_MODEL_REGISTRY[args.arch].build_model(model_args, task)
+    model.eval()
+    if args.fp16:
+        model.half()
+    if use_cuda:
+        model.cuda()
+    device = next(model.parameters()).device
+
+    src_tokens = torch.randint(vocab.nspecial, len(vocab), (args.batch_size, args.src_len), device=device)
+    src_lengths = torch.full((args.batch_size, ), args.src_len, dtype=torch.long, device=device)
+    src_img_features = torch.rand(args.batch_size, args.num_regions, model_args.img_feature_dim, device=device)
+    if args.fp16:
+        src_img_features = src_img_features.half()
+    sample = {'net_input': {
+        'src_tokens': src_tokens, 'src_lengths': src_lengths, 'src_img_features': src_img_features,
+    }}
+    # never stop early, so that both runs decode the same number of steps
+    generator = SequenceGenerator(vocab, beam_size=args.beam, max_len_b=args.max_len, min_len=args.max_len)
+
+    encoder = model.encoder
+    reorder_time = [0.]
+
+    def timed(fn):
+        def wrapper(*a, **kw):
+            if use_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            out = fn(*a, **kw)
+            if use_cuda:
+                torch.cuda.synchronize()
+            reorder_time[0] += time.perf_counter() - start
+            return out
+        return wrapper
+
+    def run():
+        reorder_time[0] = 0.
+        if use_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            with torch.no_grad():
+                generator.generate([model], sample)
+        if use_cuda:
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) / args.repeat, reorder_time[0] / args.repeat
+
+    print('| encoder output reorder | generate (s) | reorders (ms) |')
+    print('|---|---|---|')
+    for name, reindex in [
+        ('copy', timed(encoder.reorder_encoder_out)),
+        ('index', timed(encoder.reindex_encoder_out)),
+    ]:
+        with mock.patch.object(encoder, 'reindex_encoder_out', reindex):
+            with torch.no_grad():
+                generator.generate([model], sample)  # warmup
+            total, reorders = run()
+        print('| {} | {:.3f} | {:.1f} |'.format(name, total, 1000 * reorders))
+
+
+if __name__ == '__main__':
+    main()
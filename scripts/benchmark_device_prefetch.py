@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Measure the training step time with and without pinned batches that are
+prefetched to the GPU on a side stream (see ``--no-device-prefetch``), e.g.:
+
+    python scripts/benchmark_device_prefetch.py data-bin/en-de \\
+        --arch transformer_iwslt_de_en -s en -t de --max-tokens 4096 \\
+        --optimizer adam --criterion label_smoothed_cross_entropy --num-steps 200
+"""
+
+import time
+
+import torch
+
+from fairseq import options, tasks, utils
+from fairseq.trainer import Trainer
+
+
+def time_steps(trainer, num_steps, warmup):
+    epoch_itr = trainer.get_train_iterator(epoch=0, load_dataset=False)
+    itr = epoch_itr.next_epoch_itr(shuffle=False)
+    for _ in range(warmup):
+        trainer.train_step([next(itr)])
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    n = 0
+    for sample in itr:
+        trainer.train_step([sample])
+        n += 1
+        if n == num_steps:
+            break
+    torch.cuda.synchronize()
+    return (time.perf_counter() - start) / max(n, 1)
+
+
+def main():
+    parser = options.get_training_parser()
+    parser.add_argument('--num-steps', type=int, default=100,
+                        help='number of timed training steps per setting')
+    parser.add_argument('--warmup-steps', type=int, default=10,
+                        help='number of untimed training steps per setting')
+    args = options.parse_args_and_arch(parser)
+    assert torch.cuda.is_available() and not args.cpu, 'benchmark requires a GPU'
+    utils.import_user_module(args)
+
+    task = tasks.setup_task(args)
+    task.load_dataset(args.train_subset, combine=False, epoch=0)
+    model = task.build_model(args)
+    criterion = task.build_criterion(args)
+    trainer = Trainer(args, task, model, criterion)
+
+    results = {}
+    for prefetch in [False, True]:
+        trainer.prefetch_to_device = prefetch
+        task.dataset_to_epoch_iter = {}
+        results[prefetch] = time_steps(trainer, args.num_steps, args.warmup_steps)
+        print('prefetch_to_device={}: {:.2f} ms/step'.format(prefetch, 1000 * results[prefetch]))
+    print('speedup: {:.3f}x'.format(results[False] / results[True]))
+
+
+if __name__ == '__main__':
+    main()
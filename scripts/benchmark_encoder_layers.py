@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Time the forward pass of each multimodal encoder layer, of the text2image
+mask computed in it, and of the image encoders run ahead of the layers, on
+random inputs, e.g.:
+
+    python scripts/benchmark_encoder_layers.py --arch transformer_iwslt_de_en \\
+        --batch-size 128 --src-len 30 --num-regions 49
+"""
+
+import argparse
+import time
+from collections import defaultdict
+
+import torch
+
+from fairseq.data import Dictionary
+from fairseq.models import ARCH_MODEL_REGISTRY, ARCH_CONFIG_REGISTRY
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arch', default='transformer_iwslt_de_en',
+                        choices=[a for a, m in ARCH_MODEL_REGISTRY.items() if m.__name__ == 'TransformerModel'])
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--src-len', type=int, default=30)
+    parser.add_argument('--num-regions', type=int, default=49)
+    parser.add_argument('--vocab-size', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--fp16', action='store_true')
+    args = parser.parse_args()
+    use_cuda = torch.cuda.is_available() and not args.cpu
+
+    model_parser = argparse.ArgumentParser()
+    ARCH_MODEL_REGISTRY[args.arch].add_args(model_parser)
+    # leave unset options to the architecture defaults
+    model_args = argparse.Namespace(**{
+        k: v for k, v in vars(model_parser.parse_args([])).items() if v is not None
+    })
+    model_args.arch = args.arch
+    model_args.encoder_layers_to_keep = model_args.decoder_layers_to_keep = None
+    ARCH_CONFIG_REGISTRY[args.arch](model_args)
+
+    vocab = Dictionary()
+    for i in range(args.vocab_size):
+        vocab.add_symbol(str(i))
+    task = argparse.Namespace(source_dictionary=vocab, target_dictionary=vocab)
+    model = ARCH_MODEL_REGISTRY[args.arch].build_model(model_args, task)
+    model.eval()
+    if args.fp16:
+        model.half()
+    if use_cuda:
+        model.cuda()
+    device = next(model.parameters()).device
+
+    def sync():
+        if use_cuda:
+            torch.cuda.synchronize()
+
+    timings = defaultdict(float)
+
+    def timed(name, fn):
+        def wrapper(*a, **kw):
+            sync()
+            start = time.perf_counter()
+            out = fn(*a, **kw)
+            sync()
+            timings[name] += time.perf_counter() - start
+            return out
+        return wrapper
+
+    encoder = model.encoder
+    encoder.forward_image_stream = timed('image stream', encoder.forward_image_stream)
+    for idx, layer in enumerate(model.encoder.layers):
+        layer.forward = timed((idx, 'layer'), layer.forward)
+        layer.mask = timed((idx, 'mask'), layer.mask)
+
+    src_tokens = torch.randint(vocab.nspecial, len(vocab), (args.batch_size, args.src_len), device=device)
+    src_lengths = torch.full((args.batch_size, ), args.src_len, dtype=torch.long, device=device)
+    src_img_features = torch.rand(args.batch_size, args.num_regions, model_args.img_feature_dim, device=device)
+
+    with torch.no_grad():
+        model.encoder(src_tokens, src_lengths, src_img_features)  # warmup
+        timings.clear()
+        for _ in range(args.repeat):
+            model.encoder(src_tokens, src_lengths, src_img_features)
+
+    print('image encoders run ahead of the text: {:.3f} ms'.format(
+        1000 * timings['image stream'] / args.repeat,
+    ))
+    print('| layer | forward (ms) | mask (ms) |')
+    print('|---|---|---|')
+    for idx in range(len(model.encoder.layers)):
+        print('| {} | {:.3f} | {:.3f} |'.format(
+            idx, 1000 * timings[(idx, 'layer')] / args.repeat, 1000 * timings[(idx, 'mask')] / args.repeat,
+        ))
+
+
+if __name__ == '__main__':
+    main()
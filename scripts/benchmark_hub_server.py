@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Load generator for fairseq-serve: many clients, each sending JSON-lines
+requests of random sentences over its own connection and waiting for each
+answer before the next request, e.g.:
+
+    python scripts/benchmark_hub_server.py --connect localhost:8080 --clients 32
+
+Without --connect, it serves a random model in-process on a unix socket,
+first with one sentence per batch and then micro-batched at each of
+--max-wait-ms, e.g.:
+
+    python scripts/benchmark_hub_server.py --arch transformer_iwslt_de_en \\
+        --clients 32 --max-wait-ms 2,10 --num-regions 49
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from fairseq.data import Dictionary
+from fairseq.hub_utils import BatchingHubInterface, GeneratorHubInterface
+from fairseq.models import ARCH_MODEL_REGISTRY, ARCH_CONFIG_REGISTRY
+from fairseq.tasks.translation import TranslationTask
+from fairseq_cli import serve
+
+
+def build_hub(args):
+    model_parser = argparse.ArgumentParser()
+    ARCH_MODEL_REGISTRY[args.arch].add_args(model_parser)
+    # leave unset options to the architecture defaults
+    model_args = argparse.Namespace(**{
+        k: v for k, v in vars(model_parser.parse_args([])).items() if v is not None
+    })
+    model_args.arch = args.arch
+    model_args.encoder_layers_to_keep = model_args.decoder_layers_to_keep = None
+    ARCH_CONFIG_REGISTRY[args.arch](model_args)
+
+    vocab = Dictionary()
+    for i in range(args.vocab_size):
+        vocab.add_symbol(str(i))
+    hub_args = argparse.Namespace(
+        max_source_positions=1024, max_target_positions=1024, max_tokens=None, max_sentences=None,
+        max_len_b=args.max_len,
+    )
+    task = TranslationTask(hub_args, vocab, vocab)
+    model = ARCH_MODEL_REGISTRY[args.arch].build_model(model_args, task)
+    hub = GeneratorHubInterface(hub_args, task, [model])
+    hub.eval()
+    return hub, model_args
+
+
+def random_requests(args, rng):
+    requests = []
+    for i in range(args.clients * args.requests_per_client):
+        length = rng.randint(args.min_len, args.max_len + 1)
+        request = {'id': i, 'src': ' '.join(str(w) for w in rng.randint(0, args.vocab_size, length))}
+        if args.num_images > 0 and rng.rand() < args.img_ratio:
+            request['image'] = str(rng.randint(args.num_images))
+        requests.append(json.dumps(request))
+    return requests
+
+
+async def run_clients(args, connect, requests):
+    """Send *requests* from --clients concurrent connections and return the
+    latency of each and the elapsed time."""
+    latencies = []
+
+    async def client(k):
+        reader, writer = await connect()
+        for line in requests[k::args.clients]:
+            start = time.perf_counter()
+            writer.write((line + '\n').encode('utf-8'))
+            response = json.loads(await reader.readline())
+            assert 'error' not in response, response['error']
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(k) for k in range(args.clients)])
+    return np.array(latencies), time.perf_counter() - start
+
+
+def report(name, latencies, elapsed, batch_sizes=None):
+    print('| {} | {} | {:.1f} | {:.1f} | {:.1f} |'.format(
+        name, '{:.1f}'.format(np.mean(batch_sizes)) if batch_sizes else '-',
+        1000 * np.percentile(latencies, 50), 1000 * np.percentile(latencies, 99), len(latencies) / elapsed,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connect', default=None, metavar='ADDR',
+                        help='HOST:PORT or unix socket path of a running fairseq-serve')
+    parser.add_argument('--arch', default='transformer_iwslt_de_en',
+                        choices=[a for a, m in ARCH_MODEL_REGISTRY.items() if m.__name__ == 'TransformerModel'])
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--requests-per-client', type=int, default=10)
+    parser.add_argument('--max-wait-ms', default='2,10', help='comma separated max-wait windows')
+    parser.add_argument('--max-sentences', type=int, default=64)
+    parser.add_argument('--bucket-width', type=int, default=8)
+    parser.add_argument('--beam', type=int, default=5)
+    parser.add_argument('--min-len', type=int, default=4)
+    parser.add_argument('--max-len', type=int, default=30)
+    parser.add_argument('--num-regions', type=int, default=49)
+    parser.add_argument('--num-images', type=int, default=100,
+                        help='size of the image feature store of the in-process server; '
+                             'with --connect, ids of --img-store to send')
+    parser.add_argument('--img-ratio', type=float, default=1., help='fraction of the requests with an image')
+    parser.add_argument('--vocab-size', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--fp16', action='store_true')
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    requests = random_requests(args, np.random.RandomState(args.seed))
+    loop = asyncio.get_event_loop()
+
+    print('| server | batch size | p50 latency (ms) | p99 latency (ms) | requests/s |')
+    print('|---|---|---|---|---|')
+
+    if args.connect is not None:
+        host, _, port = args.connect.rpartition(':')
+        if host and port.isdigit():
+            def connect():
+                return asyncio.open_connection(host, int(port))
+        else:
+            def connect():
+                return asyncio.open_unix_connection(args.connect)
+        report(args.connect, *loop.run_until_complete(run_clients(args, connect, requests)))
+        return
+
+    hub, model_args = build_hub(args)
+    if args.fp16:
+        hub.half()
+    if torch.cuda.is_available() and not args.cpu:
+        hub.cuda()
+    images = {
+        str(i): torch.rand(args.num_regions, model_args.img_feature_dim) for i in range(args.num_images)
+    }
+
+    def run(max_sentences, max_wait):
+        server = BatchingHubInterface(
+            hub, beam=args.beam, max_sentences=max_sentences, max_wait=max_wait, bucket_width=args.bucket_width,
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'serve.sock')
+            socket_server = loop.run_until_complete(
+                asyncio.start_unix_server(serve.connection_handler(server, images.get), path)
+            )
+            latencies, elapsed = loop.run_until_complete(
+                run_clients(args, lambda: asyncio.open_unix_connection(path), requests)
+            )
+            socket_server.close()
+            loop.run_until_complete(socket_server.wait_closed())
+        return latencies, elapsed, server.batch_sizes
+
+    run(args.max_sentences, 0.)  # warmup
+    report('one sentence per batch', *run(1, 0.))
+    for max_wait_ms in [float(w) for w in args.max_wait_ms.split(',')]:
+        report('batched, max wait {:g} ms'.format(max_wait_ms), *run(args.max_sentences, max_wait_ms / 1000.))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Time the masked image self-attention of MultiheadAttention_Image against the
+previous unfused computation (repeated mask, two masked_fills, softmax) on
+batches of image regions, and check that both agree, e.g.:
+
+    python scripts/benchmark_image_attention.py --batch-size 128 --num-regions 49
+"""
+
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from fairseq.modules import MultiheadAttention_Image
+
+
+def unfused_image_attention(attn, x, mask, key_padding_mask):
+    """The previous computation, for a batch of one sample (with more, the
+    repeated mask pairs the heads of a sample with the masks of others)."""
+    tgt_len, bsz, embed_dim = x.size()
+    num_heads, head_dim = attn.num_heads, attn.head_dim
+    q = attn.q_proj(x) * attn.scaling
+    k = attn.k_proj(x)
+    v = attn.v_proj(x)
+    q = q.contiguous().view(tgt_len, bsz * num_heads, head_dim).transpose(0, 1)
+    k = k.contiguous().view(-1, bsz * num_heads, head_dim).transpose(0, 1)
+    v = v.contiguous().view(-1, bsz * num_heads, head_dim).transpose(0, 1)
+    weights = torch.bmm(q, k.transpose(1, 2))
+    weights = weights.masked_fill(mask.repeat(num_heads, 1, 1), float(1e-4))
+    weights = weights.view(bsz, num_heads, tgt_len, -1).masked_fill(
+        key_padding_mask.unsqueeze(1).unsqueeze(2), float('-inf'),
+    ).view(bsz * num_heads, tgt_len, -1)
+    weights = F.softmax(weights, dim=-1)
+    out = torch.bmm(weights, v).transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
+    return attn.out_proj(out), weights.view(bsz, num_heads, tgt_len, -1).sum(dim=1) / num_heads
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--num-regions', type=int, default=49)
+    parser.add_argument('--embed-dim', type=int, default=512)
+    parser.add_argument('--num-heads', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--fp16', action='store_true')
+    args = parser.parse_args()
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    dtype = torch.half if args.fp16 else torch.float
+
+    attn = MultiheadAttention_Image(args.embed_dim, args.num_heads, self_attention=True)
+    attn.eval().to(device=device, dtype=dtype)
+    x = torch.rand(args.num_regions, args.batch_size, args.embed_dim, device=device, dtype=dtype)
+    x[-args.num_regions // 4:, ::2] = 0  # padded regions
+    key_padding_mask = x.sum(dim=-1).eq(0).t()
+    mask = torch.rand(args.batch_size, args.num_regions, args.num_regions, device=device) > 0.5
+
+    def fused():
+        return attn(query=x, key=x, value=x, mask_matrix_tmp=mask, key_padding_mask=key_padding_mask)
+
+    def unfused():
+        return unfused_image_attention(attn, x, mask, key_padding_mask)
+
+    def timeit(fn):
+        fn()  # warmup
+        if use_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            fn()
+        if use_cuda:
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) / args.repeat
+
+    with torch.no_grad():
+        max_diff = 0.
+        for b in range(args.batch_size):
+            sl = slice(b, b + 1)
+            out, weights = attn(
+                query=x[:, sl], key=x[:, sl], value=x[:, sl], mask_matrix_tmp=mask[sl],
+                key_padding_mask=key_padding_mask[sl],
+            )
+            ref_out, ref_weights = unfused_image_attention(attn, x[:, sl], mask[sl], key_padding_mask[sl])
+            max_diff = max(
+                max_diff, (out - ref_out).abs().max().item(), (weights - ref_weights).abs().max().item(),
+            )
+        print('max abs diff (per sample): {:.3g}'.format(max_diff))
+
+        t_unfused, t_fused = timeit(unfused), timeit(fused)
+    print('{} x {} regions: unfused {:.3f} ms, fused {:.3f} ms ({:.2f}x)'.format(
+        args.batch_size, args.num_regions, 1000 * t_unfused, 1000 * t_fused, t_unfused / t_fused,
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Latency and throughput of serving translation requests (see
+fairseq.translation_server.TranslationServer) with a random model, for
+requests of random sentences and images arriving as a Poisson process, at
+several max-wait windows, e.g.:
+
+    python scripts/benchmark_serving.py --arch transformer_iwslt_de_en \\
+        --rate 50 --max-wait-ms 0,5,20,50 --max-sentences 64 --num-regions 49
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from fairseq.data import Dictionary
+from fairseq.models import ARCH_MODEL_REGISTRY, ARCH_CONFIG_REGISTRY
+from fairseq.sequence_generator import SequenceGenerator
+from fairseq.tasks.translation import TranslationTask
+from fairseq.translation_server import TranslationServer
+
+
+def build_model(args):
+    model_parser = argparse.ArgumentParser()
+    ARCH_MODEL_REGISTRY[args.arch].add_args(model_parser)
+    # leave unset options to the architecture defaults
+    model_args = argparse.Namespace(**{
+        k: v for k, v in vars(model_parser.parse_args([])).items() if v is not None
+    })
+    model_args.arch = args.arch
+    model_args.encoder_layers_to_keep = model_args.decoder_layers_to_keep = None
+    ARCH_CONFIG_REGISTRY[args.arch](model_args)
+
+    vocab = Dictionary()
+    for i in range(args.vocab_size):
+        vocab.add_symbol(str(i))
+    task = TranslationTask(argparse.Namespace(), vocab, vocab)
+    model = ARCH_MODEL_REGISTRY[args.arch].build_model(model_args, task)
+    return model, model_args, task
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arch', default='transformer_iwslt_de_en',
+                        choices=[a for a, m in ARCH_MODEL_REGISTRY.items() if m.__name__ == 'TransformerModel'])
+    parser.add_argument('--max-wait-ms', default='0,5,20,50', help='comma separated max-wait windows')
+    parser.add_argument('--rate', type=float, default=50., help='requests per second')
+    parser.add_argument('--num-requests', type=int, default=500)
+    parser.add_argument('--max-tokens', type=int, default=None)
+    parser.add_argument('--max-regions', type=int, default=None)
+    parser.add_argument('--max-sentences', type=int, default=64)
+    parser.add_argument('--beam', type=int, default=5)
+    parser.add_argument('--min-len', type=int, default=4)
+    parser.add_argument('--max-len', type=int, default=30)
+    parser.add_argument('--num-regions', type=int, default=49)
+    parser.add_argument('--num-images', type=int, default=100, help='size of the image feature store')
+    parser.add_argument('--img-ratio', type=float, default=1., help='fraction of the requests with an image')
+    parser.add_argument('--vocab-size', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--fp16', action='store_true')
+    args = parser.parse_args()
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    torch.manual_seed(args.seed)
+
+    model, model_args, task = build_model(args)
+    model.eval()
+    if args.fp16:
+        model.half()
+    if use_cuda:
+        model.cuda()
+    generator = SequenceGenerator(task.target_dictionary, beam_size=args.beam, max_len_b=args.max_len)
+
+    # the same requests, at the same times, for every window
+    rng = np.random.RandomState(args.seed)
+    images = {
+        str(i): torch.rand(args.num_regions, model_args.img_feature_dim) for i in range(args.num_images)
+    }
+    requests = []
+    for _ in range(args.num_requests):
+        length = rng.randint(args.min_len, args.max_len + 1)
+        src_str = ' '.join(str(w) for w in rng.randint(0, args.vocab_size, length))
+        image = str(rng.randint(args.num_images)) if rng.rand() < args.img_ratio else None
+        requests.append((src_str, image))
+    arrivals = np.cumsum(rng.exponential(1. / args.rate, args.num_requests))
+
+    def run(max_wait):
+        server = TranslationServer(
+            task, [model], generator, image_store=images.get,
+            max_tokens=args.max_tokens, max_regions=args.max_regions, max_sentences=args.max_sentences,
+            max_wait=max_wait, use_cuda=use_cuda,
+        )
+        with server:
+            start = time.perf_counter()
+            for (src_str, image), arrival in zip(requests, arrivals):
+                time.sleep(max(start + arrival - time.perf_counter(), 0.))
+                server.submit(src_str, image)
+        return server.stats()
+
+    # warmup
+    run(0.)
+
+    print('| max wait (ms) | batch size | p50 latency (ms) | p99 latency (ms) | requests/s |')
+    print('|---|---|---|---|---|')
+    for max_wait_ms in [float(w) for w in args.max_wait_ms.split(',')]:
+        stats = run(max_wait_ms / 1000.)
+        print('| {:g} | {:.1f} | {:.1f} | {:.1f} | {:.1f} |'.format(
+            max_wait_ms, stats['batch_size'], stats['p50_ms'], stats['p99_ms'], stats['requests_per_s'],
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Compare the corpus BLEU of fairseq.bleu.BatchScorer with the libbleu Scorer
+and with sacrebleu (without its tokenization) on tokenized text, and the time
+each takes, e.g.:
+
+    python scripts/compare_bleu.py --ref data-raw/test_2016_flickr.bpe.de --sys hyp.de
+
+Without --sys, the system output is a copy of the references with --noise of
+their tokens replaced, dropped or swapped.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from fairseq import bleu
+from fairseq.data import Dictionary
+
+
+def noised(lines, noise, rng):
+    out = []
+    for line in lines:
+        words = line.split()
+        for i in range(len(words)):
+            if rng.rand() < noise:
+                words[i] = words[rng.randint(len(words))]
+        words = [w for w in words if rng.rand() >= noise / 2] or words[:1]
+        out.append(' '.join(words))
+    return out
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ref', required=True, help='tokenized references')
+    parser.add_argument('--sys', default=None, help='tokenized system output')
+    parser.add_argument('--noise', type=float, default=0.2)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with open(args.ref) as f:
+        refs = [line.strip() for line in f]
+    if args.sys is not None:
+        with open(args.sys) as f:
+            hyps = [line.strip() for line in f]
+    else:
+        hyps = noised(refs, args.noise, np.random.RandomState(args.seed))
+    assert len(hyps) == len(refs)
+
+    # all words are in the dictionary, so no reference word is unknown
+    vocab = Dictionary()
+    ref_tokens = [vocab.encode_line(line, add_if_not_exist=True) for line in refs]
+    hyp_tokens = [vocab.encode_line(line, add_if_not_exist=True) for line in hyps]
+    pad = vocab.pad()
+
+    def batches(tokens):
+        return [
+            torch.nn.utils.rnn.pad_sequence(tokens[i:i + args.batch_size], batch_first=True, padding_value=pad)
+            for i in range(0, len(tokens), args.batch_size)
+        ]
+
+    ref_batches, hyp_batches = batches(ref_tokens), batches(hyp_tokens)
+
+    def libbleu_score():
+        scorer = bleu.Scorer(pad, vocab.eos(), vocab.unk())
+        for ref, hyp in zip(ref_tokens, hyp_tokens):
+            scorer.add(ref, hyp)
+        return scorer.score(), scorer.stat.predlen, scorer.stat.reflen
+
+    def batch_score():
+        scorer = bleu.BatchScorer(pad, vocab.eos(), vocab.unk())
+        for ref, hyp in zip(ref_batches, hyp_batches):
+            scorer.add_batch(ref, hyp)
+        stat = scorer.stat
+        return scorer.score(), stat.predlen, stat.reflen
+
+    def sacrebleu_score():
+        import sacrebleu
+        score = sacrebleu.corpus_bleu(hyps, [refs], tokenize='none')
+        return score.score, score.sys_len, score.ref_len
+
+    scorers = [('BatchScorer', batch_score), ('sacrebleu', sacrebleu_score)]
+    if bleu.C is not None:
+        scorers.insert(0, ('Scorer (libbleu)', libbleu_score))
+
+    print('{} sentences'.format(len(refs)))
+    print('| scorer | BLEU | sys len | ref len | time (ms) |')
+    print('|---|---|---|---|---|')
+    for name, fn in scorers:
+        (score, sys_len, ref_len), seconds = timed(fn, args.repeat)
+        print('| {} | {:.4f} | {} | {} | {:.1f} |'.format(name, score, sys_len, ref_len, 1000 * seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Report disk footprint, generation speed and BLEU of a trained multimodal model
+when its source image features are stored in each supported storage format,
+e.g.:
+
+    python scripts/compare_img_feature_formats.py data-bin/en-de/test2016 \\
+        --path results/mmtimg/model.pt -s en -t de -- --beam 5 --batch-size 128 --remove-bpe
+
+Arguments after ``--`` are passed on to generation.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from fairseq import options
+from fairseq.data import data_utils, image_feature_dataset
+from fairseq.data.indexed_dataset import data_file_path, index_file_path
+from fairseq_cli import generate
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data', help='binarized data directory')
+    parser.add_argument('--path', required=True, help='model checkpoint')
+    parser.add_argument('-s', '--source-lang', required=True)
+    parser.add_argument('-t', '--target-lang', required=True)
+    parser.add_argument('--gen-subset', default='test')
+    parser.add_argument('--formats', nargs='+',
+                        default=image_feature_dataset.get_available_feature_formats(),
+                        choices=image_feature_dataset.get_available_feature_formats())
+    args, gen_args = parser.parse_known_args()
+    if gen_args and gen_args[0] == '--':
+        gen_args = gen_args[1:]
+
+    prefix = '{}.{}-{}.{}'.format(args.gen_subset, args.source_lang, args.target_lang, args.source_lang)
+    features = data_utils.load_img_features(os.path.join(args.data, prefix))
+    float_features = _Dequantized(features)
+
+    rows = []
+    for feature_format in args.formats:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            img_index = os.path.basename(image_feature_dataset.image_index_path(
+                image_feature_dataset.image_feature_prefix(prefix)
+            ))
+            for name in os.listdir(args.data):
+                if name == img_index or (not name.startswith(prefix + '.img') and not name.endswith('.npy')):
+                    os.symlink(os.path.abspath(os.path.join(args.data, name)), os.path.join(tmpdir, name))
+            img_prefix = image_feature_dataset.image_feature_prefix(os.path.join(tmpdir, prefix))
+            image_feature_dataset.binarize_image_features(
+                float_features, img_prefix, features.feature_dim, feature_format,
+            )
+            nbytes = os.path.getsize(data_file_path(img_prefix)) + os.path.getsize(index_file_path(img_prefix))
+
+            gen_parser = options.get_generation_parser()
+            gen = options.parse_args_and_arch(gen_parser, [
+                tmpdir, '--path', args.path, '--gen-subset', args.gen_subset,
+                '-s', args.source_lang, '-t', args.target_lang, '--quiet',
+            ] + gen_args)
+            start = time.time()
+            scorer = generate.main(gen)
+            elapsed = time.time() - start
+            rows.append((feature_format, nbytes, len(features) / elapsed, scorer.score()))
+
+    print('| format | size (MB) | sentences/s | BLEU |')
+    print('|---|---|---|---|')
+    for feature_format, nbytes, speed, bleu in rows:
+        print('| {} | {:.1f} | {:.1f} | {:.2f} |'.format(feature_format, nbytes / 2 ** 20, speed, bleu))
+
+
+class _Dequantized(object):
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, i):
+        return self.dataset.dequantize(self.dataset[i]).numpy()
+
+
+if __name__ == '__main__':
+    main()
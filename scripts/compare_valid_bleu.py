@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Validate checkpoints of a training run with full validation BLEU (beam
+search over every sentence) and with fast validation BLEU (--eval-bleu-beam
+and --eval-bleu-subset), and report the time each validation takes and how
+well the fast BLEU correlates with the full one across checkpoints, e.g.:
+
+    python scripts/compare_valid_bleu.py data-bin/en-de -s en -t de \\
+        --checkpoints results/mmtimg/checkpoint{5,10,15,20,25,30}.pt \\
+        --eval-bleu-remove-bpe --fast-beam 1 --fast-subset 0.25
+
+Other --eval-bleu-* options apply to both.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from fairseq import checkpoint_utils, metrics, utils
+from fairseq.tasks.translation import TranslationTask
+
+
+def validate(args, path, overrides, max_tokens):
+    """Return the validation BLEU of checkpoint *path*, the seconds spent
+    generating and scoring, and the seconds of the whole validation."""
+    models, model_args, task = checkpoint_utils.load_model_ensemble_and_task([path], arg_overrides=overrides)
+    model = models[0]
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    if use_cuda:
+        model.cuda()
+    model.eval()
+    criterion = task.build_criterion(model_args)
+    task.load_dataset(args.valid_subset)
+    itr = task.get_batch_iterator(
+        dataset=task.dataset(args.valid_subset),
+        max_tokens=max_tokens,
+        max_positions=utils.resolve_max_positions(task.max_positions(), model.max_positions()),
+    ).next_epoch_itr(shuffle=False)
+
+    start = time.perf_counter()
+    log_outputs = []
+    for sample in itr:
+        sample = utils.move_to_cuda(sample) if use_cuda else sample
+        log_outputs.append(task.valid_step(sample, model, criterion)[2])
+    with metrics.aggregate(new_root=True) as agg:
+        task.reduce_metrics(log_outputs, criterion)
+        stats = agg.get_smoothed_values()
+    return stats.get('bleu', 0.), stats.get('bleu_time', 0.), time.perf_counter() - start
+
+
+def ranks(x):
+    return np.argsort(np.argsort(x))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    # data, languages and the --eval-bleu-* options
+    TranslationTask.add_args(parser)
+    parser.add_argument('--checkpoints', nargs='+', required=True, help='checkpoints of one training run')
+    parser.add_argument('--valid-subset', default='valid')
+    parser.add_argument('--max-tokens', type=int, default=4096)
+    parser.add_argument('--full-beam', type=int, default=5)
+    parser.add_argument('--fast-beam', type=int, default=1)
+    parser.add_argument('--fast-subset', type=float, default=0.25)
+    parser.add_argument('--fast-max-tokens', type=int, default=None,
+                        help='batch size of the fast validation (default: --max-tokens)')
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+
+    task_args = vars(args).copy()
+    task_args['eval_bleu'] = True
+    modes = [
+        ('full', dict(task_args, eval_bleu_beam=args.full_beam, eval_bleu_subset=1.), args.max_tokens),
+        ('fast', dict(task_args, eval_bleu_beam=args.fast_beam, eval_bleu_subset=args.fast_subset),
+         args.fast_max_tokens or args.max_tokens),
+    ]
+
+    print('| checkpoint | full BLEU | fast BLEU | full BLEU time (s) | fast BLEU time (s) '
+          '| full validation (s) | fast validation (s) |')
+    print('|---|---|---|---|---|---|---|')
+    results = {name: [] for name, _, _ in modes}
+    for path in args.checkpoints:
+        for name, overrides, max_tokens in modes:
+            results[name].append(validate(args, path, overrides, max_tokens))
+        (full_bleu, full_bleu_time, full_time), (fast_bleu, fast_bleu_time, fast_time) = \
+            results['full'][-1], results['fast'][-1]
+        print('| {} | {:.2f} | {:.2f} | {:.1f} | {:.1f} | {:.1f} | {:.1f} |'.format(
+            path, full_bleu, fast_bleu, full_bleu_time, fast_bleu_time, full_time, fast_time,
+        ))
+
+    full, fast = np.array(results['full']), np.array(results['fast'])
+    print('mean validation time: full {:.1f}s, fast {:.1f}s ({:.1f}s saved per epoch, {:.1f}x faster)'.format(
+        full[:, 2].mean(), fast[:, 2].mean(), full[:, 2].mean() - fast[:, 2].mean(),
+        full[:, 2].mean() / fast[:, 2].mean(),
+    ))
+    if len(args.checkpoints) > 2:
+        print('BLEU correlation over {} checkpoints: pearson {:.3f}, spearman {:.3f}'.format(
+            len(args.checkpoints),
+            np.corrcoef(full[:, 0], fast[:, 0])[0, 1],
+            np.corrcoef(ranks(full[:, 0]), ranks(fast[:, 0]))[0, 1],
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Report the latency/BLEU trade-off of --gate-exit-threshold on the Multi30K
+test sets, e.g.:
+
+    python scripts/gate_exit_report.py data-bin/en-de \\
+        --path results/mmtimg/model.pt -s en -t de --beam 5 --batch-size 128 \\
+        --remove-bpe --gate-exit-thresholds 0.05,0.1,0.2,0.3
+"""
+
+import copy
+import os
+import re
+import tempfile
+
+from fairseq import options
+from fairseq_cli import generate
+
+
+def run(args):
+    """Generate with *args*, and return the BLEU score and the generation
+    time in seconds."""
+    with tempfile.TemporaryDirectory() as results_path:
+        args.results_path = results_path
+        scorer = generate.main(args)
+        with open(os.path.join(results_path, 'generate-{}.txt'.format(args.gen_subset))) as h:
+            log = h.read()
+    seconds = float(re.search(r'Translated \d+ sentences \(\d+ tokens\) in ([\d.]+)s', log).group(1))
+    return scorer.score(), seconds
+
+
+def main():
+    parser = options.get_generation_parser()
+    parser.add_argument('--test-sets', default='test2016,test2017,test2017mscoco',
+                        help='comma separated data directories, relative to the data directory')
+    parser.add_argument('--gate-exit-thresholds', default='0.05,0.1,0.2,0.3',
+                        help='comma separated values of --gate-exit-threshold to compare')
+    args = options.parse_args_and_arch(parser)
+    args.quiet = True
+
+    thresholds = [None] + [float(t) for t in args.gate_exit_thresholds.split(',')]
+    results = {}
+    for test_set in args.test_sets.split(','):
+        for threshold in thresholds:
+            run_args = copy.deepcopy(args)
+            run_args.data = os.path.join(args.data, test_set)
+            run_args.gate_exit_threshold = threshold
+            results[test_set, threshold] = run(run_args)
+
+    print('| threshold | ' + ' | '.join(
+        '{0} BLEU | {0} time (s)'.format(test_set) for test_set in args.test_sets.split(',')
+    ) + ' |')
+    print('|---' * (1 + 2 * len(args.test_sets.split(','))) + '|')
+    for threshold in thresholds:
+        print('| {} | '.format('-' if threshold is None else threshold) + ' | '.join(
+            '{:.2f} | {:.1f}'.format(*results[test_set, threshold]) for test_set in args.test_sets.split(',')
+        ) + ' |')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Decoding step latency of beam search with the cross-attention keys and values
+cached once per sentence (see TransformerDecoder.cache_encoder_attn) against
+projecting them at the first step and reordering them with the beam, with a
+random model on random inputs, e.g.:
+
+    python -m tests.benchmark_encoder_attn_cache --arch transformer_iwslt_de_en \\
+        --beams 1,5,10 --batch-size 128 --num-regions 49
+"""
+
+import argparse
+import time
+from unittest import mock
+
+import torch
+
+from fairseq.data import Dictionary
+from fairseq.models import ARCH_MODEL_REGISTRY, ARCH_CONFIG_REGISTRY
+from fairseq.sequence_generator import EnsembleModel, SequenceGenerator
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arch', default='transformer_iwslt_de_en',
+                        choices=[a for a, m in ARCH_MODEL_REGISTRY.items() if m.__name__ == 'TransformerModel'])
+    parser.add_argument('--beams', default='1,5,10', help='comma separated beam sizes')
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--src-len', type=int, default=30)
+    parser.add_argument('--steps', type=int, default=20, help='decoding steps per batch')
+    parser.add_argument('--num-regions', type=int, default=49)
+    parser.add_argument('--vocab-size', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--fp16', action='store_true')
+    args = parser.parse_args()
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    torch.manual_seed(1)
+
+    model_parser = argparse.ArgumentParser()
+    ARCH_MODEL_REGISTRY[args.arch].add_args(model_parser)
+    # leave unset options to the architecture defaults
+    model_args = argparse.Namespace(**{
+        k: v for k, v in vars(model_parser.parse_args([])).items() if v is not None
+    })
+    model_args.arch = args.arch
+    model_args.encoder_layers_to_keep = model_args.decoder_layers_to_keep = None
+    ARCH_CONFIG_REGISTRY[args.arch](model_args)
+
+    vocab = Dictionary()
+    for i in range(args.vocab_size):
+        vocab.add_symbol(str(i))
+    task = argparse.Namespace(source_dictionary=vocab, target_dictionary=vocab)
+    model = ARCH_MODEL_REGISTRY[args.arch].build_model(model_args, task)
+    model.eval()
+    if args.fp16:
+        model.half()
+    if use_cuda:
+        model.cuda()
+    device = next(model.parameters()).device
+
+    src_tokens = torch.randint(vocab.nspecial, len(vocab), (args.batch_size, args.src_len), device=device)
+    src_lengths = torch.full((args.batch_size, ), args.src_len, dtype=torch.long, device=device)
+    src_img_features = torch.rand(args.batch_size, args.num_regions, model_args.img_feature_dim, device=device)
+    if args.fp16:
+        src_img_features = src_img_features.half()
+    sample = {'net_input': {
+        'src_tokens': src_tokens, 'src_lengths': src_lengths, 'src_img_features': src_img_features,
+    }}
+
+    # time the decoding steps only, without the encoder
+    encoder_time = [0.]
+    forward_encoder = EnsembleModel.forward_encoder
+
+    def timed_forward_encoder(self, encoder_input):
+        if use_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        out = forward_encoder(self, encoder_input)
+        if use_cuda:
+            torch.cuda.synchronize()
+        encoder_time[0] += time.perf_counter() - start
+        return out
+
+    def step_latency(generator):
+        with torch.no_grad():
+            generator.generate([model], sample)  # warmup
+            encoder_time[0] = 0.
+            if use_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                generator.generate([model], sample)
+            if use_cuda:
+                torch.cuda.synchronize()
+        return (time.perf_counter() - start - encoder_time[0]) / (args.repeat * (args.steps + 1))
+
+    print('| beam | step without cache (ms) | step with cache (ms) | speedup |')
+    print('|---|---|---|---|')
+    with mock.patch.object(EnsembleModel, 'forward_encoder', timed_forward_encoder):
+        for beam in [int(b) for b in args.beams.split(',')]:
+            # never stop early, so that every run decodes the same number of steps
+            generator = SequenceGenerator(vocab, beam_size=beam, max_len_b=args.steps, min_len=args.steps)
+            with mock.patch.object(EnsembleModel, 'cache_encoder_attn'):
+                uncached = step_latency(generator)
+            cached = step_latency(generator)
+            print('| {} | {:.2f} | {:.2f} | {:.2f}x |'.format(
+                beam, 1000 * uncached, 1000 * cached, uncached / cached,
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,9 @@ import random
 import sys
 import tempfile
 import unittest
+from unittest import mock
 
+import numpy as np
 import torch
 
 from fairseq import options
@@ -184,6 +186,32 @@ class TestTranslation(unittest.TestCase):
                 ], run_validation=True)
                 generate_main(data_dir)
 
+    def test_generate_pipeline(self):
+        with contextlib.redirect_stdout(StringIO()):
+            with tempfile.TemporaryDirectory('test_generate_pipeline') as data_dir:
+                create_dummy_data(data_dir)
+                preprocess_translation_data(data_dir)
+                create_dummy_img_features(data_dir, feature_dim=16)
+                # checkpoints pickle the training args, which torch>=2.6
+                # only loads with weights_only=False
+                with mock.patch.dict(os.environ, {'TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD': '1'}):
+                    train_translation_model(data_dir, 'transformer_iwslt_de_en', [
+                        '--encoder-layers', '2',
+                        '--decoder-layers', '2',
+                        '--encoder-embed-dim', '8',
+                        '--decoder-embed-dim', '8',
+                        '--img_feature_dim', '16',
+                        '--disable-validation',
+                    ])
+                    outputs = []
+                    for flags in [[], ['--pipeline', '--pipeline-depth', '1']]:
+                        results_path = os.path.join(data_dir, 'results' + ''.join(flags))
+                        generate_main(data_dir, ['--print-alignment', '--results-path', results_path] + flags)
+                        with open(os.path.join(results_path, 'generate-valid.txt')) as h:
+                            outputs.append([line for line in h if line[:2] in {'S-', 'T-', 'H-', 'P-', 'A-'}])
+                self.assertGreater(len(outputs[0]), 0)
+                self.assertEqual(outputs[0], outputs[1])
+
     def test_multilingual_transformer(self):
         # test with all combinations of encoder/decoder lang tokens
         encoder_langtok_flags = [[], ['--encoder-langtok', 'src'], ['--encoder-langtok', 'tgt']]
@@ -756,6 +784,16 @@ def create_dummy_data(data_dir, num_examples=100, maxlen=20, alignment=False):
         _create_dummy_alignment_data('valid.in', 'valid.out', 'valid.align')
         _create_dummy_alignment_data('test.in', 'test.out', 'test.align')
 
+def create_dummy_img_features(data_dir, feature_dim=2048, num_regions=4):
+    for split in ['train', 'valid', 'test']:
+        with open(os.path.join(data_dir, split + '.in')) as h:
+            num_examples = sum(1 for _ in h)
+        np.save(
+            os.path.join(data_dir, '{}.in-out.in.npy'.format(split)),
+            np.random.rand(num_examples, num_regions, feature_dim).astype(np.float32),
+        )
+
+
 def preprocess_translation_data(data_dir, extra_flags=None):
     preprocess_parser = options.get_preprocessing_parser()
     preprocess_args = preprocess_parser.parse_args(
@@ -0,0 +1,161 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import unittest
+
+import torch
+
+from fairseq import bleu
+from fairseq.tasks.translation import TranslationTask
+from tests.test_multimodal_transformer import build_model, IMG_FEATURE_DIM, NUM_REGIONS
+
+
+PAD, EOS, UNK = 1, 2, 3
+
+
+def random_sentences(n, vocab_size=8, max_len=12):
+    # a small vocabulary, so that hypotheses and references share n-grams
+    sentences = []
+    for _ in range(n):
+        length = torch.randint(1, max_len, (1,)).item()
+        tokens = torch.randint(UNK, vocab_size, (length,), dtype=torch.int)
+        sentences.append(torch.cat([tokens, torch.IntTensor([EOS])]))
+    return sentences
+
+
+def left_pad(sentences):
+    width = max(s.numel() for s in sentences)
+    return torch.stack([torch.cat([s.new_full((width - s.numel(),), PAD), s]) for s in sentences])
+
+
+@unittest.skipIf(bleu.C is None, 'libbleu is not built')
+class TestBatchScorer(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def reference_stat(self, refs, preds, one_init=False):
+        scorer = bleu.Scorer(PAD, EOS, UNK)
+        scorer.reset(one_init=one_init)
+        for ref, pred in zip(refs, preds):
+            scorer.add(ref, pred)
+        return scorer
+
+    def assertSameStat(self, expected, scorer):
+        stat = scorer.stat
+        for field, _ in bleu.BleuStat._fields_:
+            self.assertEqual(getattr(expected.stat, field), getattr(stat, field), field)
+        self.assertAlmostEqual(expected.score(), scorer.score())
+
+    def test_add_batch(self):
+        refs, preds = random_sentences(50), random_sentences(50)
+        for one_init in [False, True]:
+            scorer = bleu.BatchScorer(PAD, EOS, UNK)
+            scorer.reset(one_init=one_init)
+            scorer.add_batch(refs[:20], preds[:20])
+            # padded tensors, e.g. sample['target'] and left padded sources
+            scorer.add_batch(left_pad(refs[20:]), torch.nn.utils.rnn.pad_sequence(
+                preds[20:], batch_first=True, padding_value=PAD,
+            ))
+            self.assertSameStat(self.reference_stat(refs, preds, one_init), scorer)
+
+    def test_add(self):
+        refs, preds = random_sentences(30), random_sentences(30)
+        scorer = bleu.BatchScorer(PAD, EOS, UNK, buffer_size=7)
+        for ref, pred in zip(refs, preds):
+            scorer.add(ref, pred)
+        self.assertSameStat(self.reference_stat(refs, preds), scorer)
+
+    def test_edge_cases(self):
+        refs = list(map(torch.IntTensor, [
+            [4, 5, 3, 6, 2],  # unknown words never match
+            [4, 5, 6, 7, 2],
+            [2],  # only eos
+            [PAD, 4, 2, 5, 2, 2],  # leading pad, eos inside the sentence
+            [4, 5, 6],  # no eos
+            [7, 7, 7, 7, 2],  # clipped counts
+        ]))
+        preds = list(map(torch.IntTensor, [
+            [4, 5, 3, 6, 2],
+            [4, 5, 2],
+            [4, 2],
+            [4, 2, 5, PAD],
+            [2, 2],
+            [7, 7, 2],
+        ]))
+        scorer = bleu.BatchScorer(PAD, EOS, UNK)
+        scorer.add_batch(refs, preds)
+        self.assertSameStat(self.reference_stat(refs, preds), scorer)
+
+
+class TestValidationBleu(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model, self.vocab = build_model()
+        self.model.eval()
+        self.args = argparse.Namespace(
+            eval_bleu=True, eval_tokenized_bleu=True, eval_bleu_remove_bpe=None, eval_bleu_detok='space',
+            eval_bleu_print_samples=False, eval_bleu_subset=1., left_pad_source=True,
+        )
+        self.task = TranslationTask(self.args, self.vocab, self.vocab)
+        self.task.tokenizer = None
+        self.generator = self.task.build_generator(argparse.Namespace(beam=1, max_len_b=6))
+
+        bsz = 16
+        src_lengths = torch.arange(bsz + 1, 1, -1)
+        src_tokens = torch.randint(self.vocab.nspecial, len(self.vocab), (bsz, bsz + 1))
+        src_tokens[:, -1] = self.vocab.eos()
+        for i, length in enumerate(src_lengths):
+            src_tokens[i, :-length] = self.vocab.pad()
+        target = torch.randint(self.vocab.nspecial, len(self.vocab), (bsz, 6))
+        target[:, -1] = self.vocab.eos()
+        target[::3, -3:] = self.vocab.pad()
+        target[::3, -4] = self.vocab.eos()
+        self.sample = {
+            'id': torch.arange(bsz),
+            'net_input': {
+                'src_tokens': src_tokens,
+                'src_lengths': src_lengths,
+                'src_img_features': torch.rand(bsz, NUM_REGIONS, IMG_FEATURE_DIM),
+                'src_img_lengths': torch.full((bsz,), NUM_REGIONS, dtype=torch.long),
+            },
+            'target': target,
+        }
+
+    def test_tokenized_bleu_on_device(self):
+        import sacrebleu
+
+        stats = self.task._inference_with_bleu(self.generator, self.sample, self.model)
+        hypos = self.task.inference_step(self.generator, [self.model], self.sample)
+        expected = sacrebleu.corpus_bleu(
+            [self.vocab.string(h[0]['tokens']) for h in hypos],
+            [[self.vocab.string(t[t.ne(self.vocab.pad())], escape_unk=True) for t in self.sample['target']]],
+            tokenize='none',
+        )
+        self.assertGreater(expected.counts[0], 0)
+        self.assertEqual(stats.sys_len, expected.sys_len)
+        self.assertEqual(stats.ref_len, expected.ref_len)
+        self.assertEqual(list(stats.counts), list(expected.counts))
+        self.assertEqual(list(stats.totals), list(expected.totals))
+
+    def test_subset(self):
+        self.args.eval_bleu_subset = 0.5
+        subset = self.task._eval_bleu_subset(self.sample)
+        ids = subset['id'].tolist()
+        self.assertTrue(0 < len(ids) < 16)
+        # the same sentences at every validation
+        self.assertEqual(self.task._eval_bleu_subset(self.sample)['id'].tolist(), ids)
+        self.assertEqual(subset['net_input']['src_tokens'].size(1), subset['net_input']['src_lengths'].max())
+        # sentences are translated as in the whole batch
+        hypos = self.task.inference_step(self.generator, [self.model], self.sample)
+        subset_hypos = self.task.inference_step(self.generator, [self.model], subset)
+        for i, h in zip(ids, subset_hypos):
+            self.assertEqual(h[0]['tokens'].tolist(), hypos[i][0]['tokens'].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,258 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+import torch.nn as nn
+
+from fairseq import checkpoint_utils
+from fairseq.criterions import FairseqCriterion
+from fairseq.models import BaseFairseqModel
+from fairseq.trainer import Trainer
+
+
+class ModelWithUnusedModules(BaseFairseqModel):
+
+    def __init__(self, build_unused=True):
+        super().__init__()
+        self.used = nn.Linear(4, 2)
+        self.unused = nn.Linear(4, 3) if build_unused else None
+        self.partly_used = nn.ModuleDict({'a': nn.Linear(4, 2), 'b': nn.Linear(4, 2)})
+
+    def forward(self, x):
+        return self.used(x) + self.partly_used['a'](x)
+
+    def upgrade_state_dict_named(self, state_dict, name):
+        if self.unused is None:
+            for k in [k for k in state_dict if k.startswith('unused.')]:
+                del state_dict[k]
+
+
+class ModelWithImages(ModelWithUnusedModules):
+
+    def __init__(self):
+        super().__init__()
+        self.encoder = nn.Module()
+        self.encoder.img_fc = nn.Linear(4, 2)
+
+    def forward(self, x, src_img_features=None):
+        out = super().forward(x)
+        if src_img_features is not None:
+            out = out + self.encoder.img_fc(src_img_features)
+        return out
+
+
+class ModelWithTiedWeights(ModelWithUnusedModules):
+
+    def __init__(self, build_unused=True):
+        super().__init__(build_unused)
+        # e.g. --share-all-embeddings
+        self.tied = nn.Linear(4, 2)
+        self.tied.weight = self.used.weight
+
+    def forward(self, x):
+        return super().forward(x) + self.tied(x)
+
+
+class SumCriterion(FairseqCriterion):
+
+    def forward(self, model, sample, reduce=True):
+        loss = model(sample['x'], **sample.get('net_input', {})).pow(2).sum()
+        return loss, 1, {'loss': loss.item(), 'ntokens': 1, 'nsentences': 1, 'sample_size': 1}
+
+    @staticmethod
+    def reduce_metrics(logging_outputs):
+        pass
+
+
+def build_trainer(model, slim_after_updates=0, criterion_cls=SumCriterion, **kwargs):
+    args = argparse.Namespace(
+        task='translation', arch='transformer', cpu=True, fp16=False, distributed_world_size=1, distributed_rank=0,
+        use_bmuf=False, optimizer='adam', lr=[0.01], adam_betas='(0.9, 0.999)', adam_eps=1e-8,
+        weight_decay=0., lr_scheduler='fixed', force_anneal=None, lr_shrink=0.1, warmup_updates=0,
+        clip_norm=0., empty_cache_freq=0, seed=1, no_save_optimizer_state=False,
+        slim_after_updates=slim_after_updates, **kwargs
+    )
+    task = argparse.Namespace(target_dictionary=None)
+    task.train_step = lambda sample, model, criterion, optimizer, ignore_grad: _train_step(
+        sample, model, criterion, optimizer,
+    )
+    task.update_step = lambda num_updates: None
+    task.reduce_metrics = lambda logging_outputs, criterion: None
+    return Trainer(args, task, model, criterion_cls(args, task))
+
+
+def _train_step(sample, model, criterion, optimizer):
+    model.train()
+    loss, sample_size, logging_output = criterion(model, sample)
+    optimizer.backward(loss)
+    return loss, sample_size, logging_output
+
+
+def loadable_checkpoints():
+    # checkpoints pickle the training args, which torch>=2.6 only loads with
+    # weights_only=False
+    return mock.patch.dict(os.environ, {'TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD': '1'})
+
+
+def optimizer_state_of(trainer, param):
+    params = [p for p in trainer.get_model().parameters() if p.requires_grad]
+    i = [id(p) for p in params].index(id(param))
+    return trainer.optimizer.state_dict()['state'][i]
+
+
+class TestCheckpointUtils(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.sample = {'x': torch.rand(5, 4)}
+
+    def test_unused_modules(self):
+        model = ModelWithUnusedModules()
+        unused = ['unused.weight', 'unused.bias', 'partly_used.b.weight', 'partly_used.b.bias', 'used.bias']
+        modules = checkpoint_utils.unused_modules(model, unused)
+        self.assertEqual(modules, ['unused', 'partly_used.b'])
+        checkpoint_utils.remove_modules(model, modules)
+        self.assertEqual(
+            sorted(n for n, _ in model.named_parameters()),
+            ['partly_used.a.bias', 'partly_used.a.weight', 'used.bias', 'used.weight'],
+        )
+        model(self.sample['x'])
+
+    def test_prune_optimizer_state(self):
+        params = [nn.Parameter(torch.rand(n)) for n in [3, 2, 4]]
+        optimizer = torch.optim.Adam(params)
+        sum(p.sum() for p in params).backward()
+        optimizer.step()
+        state = optimizer.state_dict()
+        pruned = checkpoint_utils.prune_optimizer_state(state, [True, False, True], [3, 2, 4])
+        self.assertEqual(pruned['param_groups'][0]['params'], [0, 1])
+        self.assertTrue(torch.equal(pruned['state'][1]['exp_avg'], state['state'][2]['exp_avg']))
+        torch.optim.Adam([params[0], params[2]]).load_state_dict(pruned)
+        self.assertIsNone(checkpoint_utils.prune_optimizer_state(state, [True, False, True], [3, 4, 2]))
+
+        # a flat copy of the parameters
+        flat = nn.Parameter(torch.cat([p.data for p in params]))
+        optimizer = torch.optim.Adam([flat])
+        flat.sum().backward()
+        optimizer.step()
+        state = optimizer.state_dict()
+        pruned = checkpoint_utils.prune_optimizer_state(state, [True, False, True], [3, 2, 4])
+        self.assertEqual(
+            pruned['state'][0]['exp_avg'].tolist(), state['state'][0]['exp_avg'][[0, 1, 2, 5, 6, 7, 8]].tolist(),
+        )
+
+    def test_slim_after_updates(self):
+        model = ModelWithUnusedModules()
+        trainer = build_trainer(model, slim_after_updates=2)
+        trainer.train_step([self.sample])
+        self.assertEqual(len(list(trainer.optimizer.params)), 8)
+        trainer.train_step([self.sample])
+        self.assertIsNone(model.unused)
+        self.assertIsNone(model.partly_used['b'])
+        self.assertEqual(trainer.args.slimmed_modules, ['partly_used.b', 'unused'])
+        self.assertEqual(len(list(trainer.optimizer.params)), 4)
+        # the optimizer state of the other parameters is kept
+        self.assertEqual(optimizer_state_of(trainer, model.used.weight)['step'], 2)
+        trainer.train_step([self.sample])
+
+        with tempfile.TemporaryDirectory() as save_dir, loadable_checkpoints():
+            filename = os.path.join(save_dir, 'checkpoint.pt')
+            trainer.save_checkpoint(filename, {'train_iterator': {'epoch': 1}})
+            state = checkpoint_utils.load_checkpoint_to_cpu(filename)
+            self.assertFalse(any(k.startswith(('unused.', 'partly_used.b.')) for k in state['model']))
+
+            # models built to load the checkpoint are slimmed as well
+            model = ModelWithUnusedModules()
+            trainer = build_trainer(model)
+            trainer.load_checkpoint(filename)
+            self.assertIsNone(model.unused)
+            self.assertEqual(optimizer_state_of(trainer, model.used.weight)['step'], 3)
+            trainer.train_step([self.sample])
+
+    def test_slim_with_zero_filled_grads(self):
+        # as with --ddp-backend=no_c10d, which fills missing gradients with zeros
+        model = ModelWithUnusedModules()
+        trainer = build_trainer(model, slim_after_updates=1)
+        zero_fill = mock.patch.object(
+            trainer.optimizer, 'backward',
+            side_effect=lambda loss: (loss + 0 * model.unused(self.sample['x']).sum()).backward(),
+        )
+        with zero_fill:
+            trainer.train_step([self.sample])
+        self.assertIsNone(model.unused)
+
+    def test_slim_waits_for_images(self):
+        model = ModelWithImages()
+        trainer = build_trainer(model, slim_after_updates=1)
+        trainer.train_step([self.sample])
+        trainer.train_step([self.sample])
+        # the image projection has no gradient without images
+        self.assertIsNotNone(model.encoder.img_fc)
+        trainer.train_step([{'x': self.sample['x'], 'net_input': {'src_img_features': torch.rand(5, 4)}}])
+        self.assertIsNotNone(model.encoder.img_fc)
+        self.assertIsNone(model.unused)
+
+    def test_slim_refuses_layerdrop(self):
+        with self.assertRaises(ValueError):
+            build_trainer(ModelWithUnusedModules(), slim_after_updates=1, encoder_layerdrop=0.1)
+
+    def test_load_checkpoint_with_unused_parameters(self):
+        model = ModelWithUnusedModules()
+        trainer = build_trainer(model)
+        trainer.train_step([self.sample])
+        expected = optimizer_state_of(trainer, model.partly_used['a'].weight)['exp_avg'].clone()
+
+        with tempfile.TemporaryDirectory() as save_dir, loadable_checkpoints():
+            filename = os.path.join(save_dir, 'checkpoint.pt')
+            trainer.save_checkpoint(filename, {'train_iterator': {'epoch': 1}})
+
+            # a model that drops the unused module from earlier checkpoints
+            model = ModelWithUnusedModules(build_unused=False)
+            trainer = build_trainer(model)
+            trainer.load_checkpoint(filename)
+            self.assertEqual(len(list(trainer.optimizer.params)), 6)
+            self.assertTrue(torch.equal(
+                optimizer_state_of(trainer, model.partly_used['a'].weight)['exp_avg'], expected,
+            ))
+            trainer.train_step([self.sample])
+
+
+    def test_load_checkpoint_with_tied_weights(self):
+        model = ModelWithTiedWeights()
+        trainer = build_trainer(model)
+        trainer.train_step([self.sample])
+        expected = {
+            name: optimizer_state_of(trainer, getattr(model, name).weight)['exp_avg'].clone()
+            for name in ['used', 'tied']
+        }
+
+        with tempfile.TemporaryDirectory() as save_dir, loadable_checkpoints():
+            filename = os.path.join(save_dir, 'checkpoint.pt')
+            trainer.save_checkpoint(filename, {'train_iterator': {'epoch': 1}})
+
+            # the same model, and one that drops the unused module
+            for build_unused in [True, False]:
+                model = ModelWithTiedWeights(build_unused=build_unused)
+                trainer = build_trainer(model)
+                with mock.patch.object(checkpoint_utils, 'prune_optimizer_state',
+                                       wraps=checkpoint_utils.prune_optimizer_state) as prune:
+                    trainer.load_checkpoint(filename)
+                self.assertEqual(prune.called, not build_unused)
+                self.assertEqual(len(trainer.optimizer.state_dict()['state']), 5)
+                for name in ['used', 'tied']:
+                    self.assertTrue(torch.equal(
+                        optimizer_state_of(trainer, getattr(model, name).weight)['exp_avg'], expected[name],
+                    ))
+                trainer.train_step([self.sample])
+
+
+if __name__ == '__main__':
+    unittest.main()
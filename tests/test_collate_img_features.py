@@ -0,0 +1,97 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+import timeit
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq.data import image_feature_dataset, LanguagePairDataset
+import tests.utils as test_utils
+
+
+BSZ, NUM_REGIONS, FEATURE_DIM = 64, 49, 2048
+
+
+def count_img_copies(fn, names=('aten::copy_', 'aten::cat', 'aten::index_select')):
+    """Count the torch ops in *fn* that copy image features."""
+    with torch.autograd.profiler.profile(record_shapes=True) as prof:
+        fn()
+    counts = {name: 0 for name in names}
+    for evt in prof.function_events:
+        # shapes of tensor lists (e.g. the inputs of cat) are not recorded
+        if evt.name in counts and (evt.name == 'aten::cat' or any(
+            len(shape) > 0 and shape[-1] == FEATURE_DIM for shape in evt.input_shapes
+        )):
+            counts[evt.name] += 1
+    return counts
+
+
+class TestCollateImgFeatures(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.img_path = os.path.join(self.tmpdir.name, 'train.img')
+        features = np.random.rand(2 * BSZ, NUM_REGIONS, FEATURE_DIM).astype(np.float32)
+        image_feature_dataset.binarize_image_features(features, self.img_path, FEATURE_DIM)
+        self.features = torch.from_numpy(features)
+
+        vocab = test_utils.dummy_dictionary(10)
+        src_tokens = [
+            torch.LongTensor([vocab.index('token_1')] * (1 + i % 7) + [vocab.eos()])
+            for i in range(2 * BSZ)
+        ]
+        self.dataset = LanguagePairDataset(
+            src_tokens, [len(t) for t in src_tokens], vocab,
+            src_img_features=image_feature_dataset.MMapImageFeatureDataset(self.img_path),
+        )
+        self.samples = [self.dataset[i] for i in range(1, 2 * BSZ, 2)]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def reference_collate(self):
+        # the previous implementation: stack, then reorder
+        src_lengths = torch.LongTensor([s['source'].numel() for s in self.samples])
+        _, sort_order = src_lengths.sort(descending=True)
+        src_img_features = torch.cat([s['src_img_features'].unsqueeze(0) for s in self.samples], dim=0)
+        return src_img_features.index_select(0, sort_order)
+
+    def test_collate_matches_reference(self):
+        batch = self.dataset.collater(self.samples)
+        src_img_features = batch['net_input']['src_img_features']
+        self.assertTrue(torch.equal(src_img_features, self.reference_collate()))
+        self.assertTrue(torch.equal(src_img_features, self.features[batch['id']]))
+
+        # per-sample copies, for stores without a vectorized gather
+        self.dataset.src_img_features = torch.utils.data.ConcatDataset([self.dataset.src_img_features])
+        batch = self.dataset.collater(self.samples)
+        self.assertTrue(torch.equal(batch['net_input']['src_img_features'], self.reference_collate()))
+
+    def test_copy_count(self):
+        # a single vectorized gather from the mapping into the batch, and no
+        # further copies by torch
+        counts = count_img_copies(lambda: self.dataset.collater(self.samples))
+        self.assertEqual(counts, {'aten::copy_': 0, 'aten::cat': 0, 'aten::index_select': 0})
+
+        # the reference stacks the features, then copies them again to sort
+        counts = count_img_copies(self.reference_collate)
+        self.assertEqual(counts['aten::cat'], 1)
+        self.assertEqual(counts['aten::index_select'], 1)
+
+    def test_benchmark(self):
+        n = 5
+        ref = timeit.timeit(self.reference_collate, number=n) / n
+        new = timeit.timeit(lambda: self.dataset.collater(self.samples), number=n) / n
+        print('\ncollate {}x{}x{} image features: {:.1f} ms -> {:.1f} ms'.format(
+            BSZ, NUM_REGIONS, FEATURE_DIM, 1000 * ref, 1000 * new,
+        ))
+
+
+if __name__ == '__main__':
+    unittest.main()
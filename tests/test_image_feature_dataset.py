@@ -0,0 +1,401 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import os
+import pickle
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+
+from fairseq import options
+from fairseq.data import ConcatDataset, data_utils, image_feature_dataset, LanguagePairDataset
+from fairseq.data.indexed_dataset import data_file_path, index_file_path
+from fairseq.tasks.translation import TranslationTask
+from fairseq_cli import preprocess
+from tests.test_binaries import create_dummy_data
+import tests.utils as test_utils
+
+
+class TestImageFeatureDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.prefix = os.path.join(self.tmpdir.name, 'train.en-de.en')
+        self.features = np.random.rand(5, 7, 7, 16).astype(np.float32)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write_store(self):
+        img_path = image_feature_dataset.image_feature_prefix(self.prefix)
+        builder = image_feature_dataset.MMapImageFeatureDatasetBuilder(
+            data_file_path(img_path), feature_dim=16,
+        )
+        for feats in self.features:
+            builder.add_item(torch.from_numpy(feats))
+        builder.finalize(index_file_path(img_path))
+
+    def test_mmap_store(self):
+        self._write_store()
+        ds = data_utils.load_img_features(self.prefix)
+        self.assertIsInstance(ds, image_feature_dataset.MMapImageFeatureDataset)
+        self.assertEqual(len(ds), 5)
+        self.assertEqual(ds.sizes.tolist(), [49] * 5)
+        for i in range(5):
+            self.assertEqual(ds[i].size(), (49, 16))
+            self.assertTrue(torch.equal(ds[i], torch.from_numpy(self.features[i]).view(49, 16)))
+
+        ds = pickle.loads(pickle.dumps(ds))
+        self.assertTrue(torch.equal(ds[3], torch.from_numpy(self.features[3]).view(49, 16)))
+
+    def test_items_are_views(self):
+        self._write_store()
+        ds = data_utils.load_img_features(self.prefix)
+        # consecutive items live in the same mapping, one after the other
+        self.assertEqual(
+            ds[1].data_ptr() - ds[0].data_ptr(),
+            49 * 16 * ds[0].element_size(),
+        )
+
+    def test_reduced_precision_formats(self):
+        features = self.features.reshape(5, 49, 16)
+        for feature_format, atol in [('float16', 1e-3), ('bfloat16', 1e-2), ('int8', 1e-2)]:
+            img_path = os.path.join(self.tmpdir.name, feature_format)
+            image_feature_dataset.binarize_image_features(features, img_path, 16, feature_format)
+            ds = image_feature_dataset.MMapImageFeatureDataset(img_path)
+            self.assertEqual(ds.feature_format, feature_format)
+            self.assertEqual(ds[0].size(), (49, 16))
+            batch = torch.stack([ds[i] for i in range(len(ds))])
+            dequantized = ds.dequantize(batch)
+            self.assertEqual(dequantized.dtype, torch.float32)
+            self.assertTrue(torch.allclose(dequantized, torch.from_numpy(features), atol=atol))
+
+    def test_sharded_store(self):
+        img_path = image_feature_dataset.image_feature_prefix(self.prefix)
+        features = self.features.reshape(5, 49, 16)
+        image_feature_dataset.binarize_image_features(features[:2], img_path + '.0', 16)
+        image_feature_dataset.binarize_image_features(features[2:], img_path + '.1', 16)
+        ds = data_utils.load_img_features(self.prefix)
+        self.assertEqual(len(ds), 5)
+        self.assertEqual(ds.sizes.tolist(), [49] * 5)
+        for i in range(5):
+            self.assertTrue(torch.equal(ds[i], torch.from_numpy(features[i])))
+
+        # gathered with one take per shard, without reading items one by one
+        missing = image_feature_dataset.MISSING_IMAGE
+        indices = [4, missing, 0, 2, 1]
+        with mock.patch.object(image_feature_dataset.MMapImageFeatureDataset, '__getitem__') as getitem:
+            batch = image_feature_dataset.take(ds, indices)
+        getitem.assert_not_called()
+        for i, j in enumerate(indices):
+            self.assertTrue(torch.equal(batch[i], torch.from_numpy(features[j]) if j != missing else torch.zeros(49, 16)))
+        self.assertEqual(image_feature_dataset.take(ds, [missing]).size(), (1, 0, 16))
+
+        # upsampled splits
+        ds = ConcatDataset([ds, ds.datasets[0]], sample_ratios=[1, 2])
+        batch = image_feature_dataset.take(ds, [8, 5, 3])
+        for i, j in enumerate([1, 0, 3]):
+            self.assertTrue(torch.equal(batch[i], torch.from_numpy(features[j])))
+
+    def test_deduplicated_store(self):
+        features = self.features.reshape(5, 49, 16)[[0, 1, 0, 2, 1]]
+        unique_indices, image_ids = image_feature_dataset.deduplicate_image_features(features)
+        self.assertEqual(unique_indices, [0, 1, 3])
+        self.assertEqual(image_ids.tolist(), [0, 1, 0, 2, 1])
+
+        img_path = image_feature_dataset.image_feature_prefix(self.prefix)
+        n = image_feature_dataset.binarize_image_features(features, img_path, 16, indices=unique_indices)
+        self.assertEqual(n, 3)
+        np.save(image_feature_dataset.image_index_path(img_path), image_ids)
+        ds = data_utils.load_img_features(self.prefix)
+        index = data_utils.load_img_index(self.prefix)
+        self.assertEqual(len(ds), 3)
+        for i in range(5):
+            self.assertTrue(torch.equal(ds[index[i]], torch.from_numpy(features[i])))
+
+    def test_projection_cache(self):
+        features = self.features.reshape(5, 49, 16)
+        img_path = os.path.join(self.tmpdir.name, 'int8')
+        image_feature_dataset.binarize_image_features(features, img_path, 16, 'int8')
+        ds = image_feature_dataset.MMapImageFeatureDataset(img_path)
+        projections = [torch.nn.Linear(16, 8), torch.nn.Linear(16, 4)]
+
+        key = image_feature_dataset.projection_key(projections)
+        cache_path = image_feature_dataset.image_projection_prefix(img_path, key)
+        image_feature_dataset.binarize_image_projections(ds, cache_path, projections, batch_size=2)
+        cache = image_feature_dataset.MMapImageFeatureDataset(cache_path)
+        self.assertEqual(len(cache), 5)
+        self.assertEqual(cache.feature_dim, 12)
+        with torch.no_grad():
+            for i in range(5):
+                x = ds.dequantize(ds[i])
+                expected = torch.cat([proj(x) for proj in projections], dim=-1)
+                self.assertTrue(torch.allclose(cache[i], expected, atol=1e-6))
+
+            projections[1].bias.add_(1)
+        self.assertNotEqual(image_feature_dataset.projection_key(projections), key)
+
+    def test_preprocess_img_features(self):
+        data_dir = self.tmpdir.name
+        create_dummy_data(data_dir, num_examples=10)
+        for split in ['train', 'valid', 'test']:
+            np.save(os.path.join(data_dir, split + '.feats.npy'), self.features)
+            # two sentences per image, listed in reverse
+            with open(os.path.join(data_dir, split + '.order'), 'w') as h:
+                print('\n'.join(str(4 - i // 2) for i in range(10)), file=h)
+
+        for workers in ['1', '3']:
+            destdir = os.path.join(data_dir, 'bin' + workers)
+            args = options.get_preprocessing_parser().parse_args([
+                '--source-lang', 'in', '--target-lang', 'out',
+                '--trainpref', os.path.join(data_dir, 'train'),
+                '--validpref', os.path.join(data_dir, 'valid'),
+                '--testpref', os.path.join(data_dir, 'test'),
+                '--destdir', destdir, '--workers', workers,
+                '--img-features', 'feats.npy', '--img-order', 'order',
+                '--img-dedup', '--img-format', 'float16',
+            ])
+            preprocess.main(args)
+
+            prefix = os.path.join(destdir, 'train.in-out.in')
+            ds = data_utils.load_img_features(prefix)
+            index = data_utils.load_img_index(prefix)
+            self.assertEqual(ds.feature_format, 'float16')
+            self.assertEqual(len(ds), 5)
+            self.assertEqual(len(index), 10)
+            for i in range(10):
+                self.assertTrue(torch.allclose(
+                    ds.dequantize(ds[index[i]]),
+                    torch.from_numpy(self.features[4 - i // 2]).view(49, 16),
+                    atol=1e-3,
+                ))
+
+    def test_missing_images(self):
+        missing = image_feature_dataset.MISSING_IMAGE
+        features = self.features.reshape(5, 49, 16)
+        for feature_format in ['float32', 'bfloat16', 'int8']:
+            img_path = os.path.join(self.tmpdir.name, feature_format)
+            image_feature_dataset.binarize_image_features(features, img_path, 16, feature_format)
+            ds = image_feature_dataset.MMapImageFeatureDataset(img_path)
+            batch = ds.dequantize(ds.take([3, missing, 1]))
+            self.assertTrue(torch.equal(batch[1], torch.zeros(49, 16)))
+            self.assertTrue(torch.equal(batch[0], ds.dequantize(ds[3])))
+            self.assertTrue(torch.equal(batch[2], ds.dequantize(ds[1])))
+            self.assertEqual(ds.take([missing, missing]).size(), (2, 0, 16))
+
+        np.save(self.prefix + '.npy', self.features)
+        ds = data_utils.load_img_features(self.prefix)
+        batch = ds.take([missing, 2])
+        self.assertTrue(torch.equal(batch[0], torch.zeros(49, 16)))
+        self.assertTrue(torch.equal(batch[1], torch.from_numpy(features[2])))
+
+        vocab = test_utils.dummy_dictionary(10)
+        src_tokens = [torch.LongTensor([4 + i, vocab.eos()]) for i in range(4)]
+        for src_img_features in [ds, torch.utils.data.ConcatDataset([ds])]:
+            dataset = LanguagePairDataset(
+                src_tokens, [2] * 4, vocab, src_img_features=src_img_features,
+                src_img_index=np.array([missing, 2, missing, 0]),
+            )
+            self.assertIsNone(dataset[0]['src_img_features'])
+            batch = dataset.collater([dataset[i] for i in range(4)])
+            for i, sample_id in enumerate(batch['id'].tolist()):
+                expected = np.zeros((49, 16)) if sample_id in [0, 2] else features[[None, 2, None, 0][sample_id]]
+                self.assertTrue(torch.equal(batch['net_input']['src_img_features'][i], torch.from_numpy(expected).float()))
+            self.assertEqual(
+                batch['id'][batch['net_input']['src_img_batch']].sort()[0].tolist(), [1, 3],
+            )
+            batch = dataset.collater([dataset[0], dataset[2]])
+            self.assertIsNone(batch['net_input']['src_img_features'])
+
+    def test_variable_regions(self):
+        missing = image_feature_dataset.MISSING_IMAGE
+        # detector features: a different number of regions per image
+        items = np.empty(3, dtype=object)
+        items[:] = [np.random.rand(n, 16).astype(np.float32) for n in [3, 7, 5]]
+        np.save(self.prefix + '.npy', items, allow_pickle=True)
+        npy = image_feature_dataset.NumpyImageFeatureDataset(self.prefix + '.npy')
+        self.assertEqual(npy.sizes.tolist(), [3, 7, 5])
+
+        stores = [npy]
+        for feature_format in ['float32', 'bfloat16', 'int8']:
+            img_path = os.path.join(self.tmpdir.name, feature_format)
+            image_feature_dataset.binarize_image_features(npy, img_path, 16, feature_format)
+            stores.append(image_feature_dataset.MMapImageFeatureDataset(img_path))
+        for ds in stores + [ConcatDataset([stores[-1]])]:
+            store = image_feature_dataset.unwrap_image_feature_dataset(ds)
+            self.assertEqual(ds.sizes.tolist(), [3, 7, 5])
+            # padded to the most regions among the items taken, with zeros
+            batch = store.dequantize(image_feature_dataset.take(ds, [2, missing, 0]))
+            self.assertEqual(batch.size(), (3, 5, 16))
+            self.assertTrue(torch.equal(batch[0], store.dequantize(ds[2])))
+            self.assertTrue(torch.equal(batch[2, :3], store.dequantize(ds[0])))
+            self.assertFalse(batch[1].any() or batch[2, 3:].any())
+
+        vocab = test_utils.dummy_dictionary(10)
+        src_tokens = [torch.LongTensor([4 + i, vocab.eos()]) for i in range(4)]
+        dataset = LanguagePairDataset(
+            src_tokens, [2] * 4, vocab, src_img_features=stores[1],
+            src_img_index=np.array([0, missing, 2, 0]),
+        )
+        batch = dataset.collater([dataset[i] for i in [0, 1, 2]])
+        self.assertEqual(batch['net_input']['src_img_features'].size(), (3, 5, 16))
+        lengths = dict(zip(batch['id'].tolist(), batch['net_input']['src_img_lengths'].tolist()))
+        self.assertEqual(lengths, {0: 3, 1: 0, 2: 5})
+
+        # images without regions
+        img_path = os.path.join(self.tmpdir.name, 'empty')
+        image_feature_dataset.binarize_image_features([np.zeros((0, 16)), np.random.rand(2, 16)], img_path, 16)
+        ds = image_feature_dataset.MMapImageFeatureDataset(img_path)
+        self.assertEqual(ds.take([0, missing, 0]).size(), (3, 0, 16))
+
+    def test_image_aware_batching(self):
+        missing = image_feature_dataset.MISSING_IMAGE
+        img_path = os.path.join(self.tmpdir.name, 'img')
+        image_feature_dataset.binarize_image_features(
+            [np.random.rand(n, 16) for n in [10, 40, 100]], img_path, 16,
+        )
+        store = image_feature_dataset.MMapImageFeatureDataset(img_path)
+        vocab = test_utils.dummy_dictionary(10)
+        src_tokens = [torch.LongTensor([4] * n + [vocab.eos()]) for n in [1, 1, 1, 1, 19]]
+        src_img_index = np.array([0, 1, 2, missing, 1])
+
+        def build(**kwargs):
+            return LanguagePairDataset(
+                src_tokens, [2, 2, 2, 2, 20], vocab, src_img_features=store,
+                src_img_index=src_img_index, shuffle=False, **kwargs
+            )
+
+        # text only by default
+        dataset = build()
+        self.assertEqual([dataset.num_tokens(i) for i in range(5)], [2, 2, 2, 2, 20])
+
+        # text tokens + weighted regions + quadratic mask term, rounded up
+        dataset = build(img_region_cost=0.2, img_mask_cost=0.001)
+        expected = [2 + 2 + 1, 2 + 8 + 2, 2 + 20 + 10, 2, 20 + 8 + 2]
+        self.assertEqual([dataset.num_tokens(i) for i in range(5)], expected)
+        indices = dataset.ordered_indices()
+        self.assertEqual(dataset.num_tokens_vec(indices).tolist(), [expected[i] for i in indices])
+        # examples of the same length are ordered by their number of regions
+        self.assertEqual(indices.tolist(), [3, 0, 1, 2, 4])
+
+        for num_tokens_vec in [None, dataset.num_tokens_vec(indices)]:
+            batches = data_utils.batch_by_size(
+                indices, dataset.num_tokens, max_tokens=36, num_tokens_vec=num_tokens_vec,
+            )
+            self.assertEqual([list(b) for b in batches], [[3, 0, 1], [2], [4]])
+
+        # Cython components built before batch_by_size_vec fall back to num_tokens_fn
+        from fairseq.data import data_utils_fast
+        old_build = types.SimpleNamespace(batch_by_size_fast=data_utils_fast.batch_by_size_fast)
+        with mock.patch.dict(sys.modules, {'fairseq.data.data_utils_fast': old_build}):
+            batches = data_utils.batch_by_size(
+                indices, dataset.num_tokens, max_tokens=36, num_tokens_vec=dataset.num_tokens_vec(indices),
+            )
+        self.assertEqual([list(b) for b in batches], [[3, 0, 1], [2], [4]])
+
+    def test_preprocess_missing_images(self):
+        data_dir = self.tmpdir.name
+        create_dummy_data(data_dir, num_examples=10)
+        for split in ['train', 'valid', 'test']:
+            np.save(os.path.join(data_dir, split + '.feats.npy'), self.features)
+            # every third sentence has no image
+            with open(os.path.join(data_dir, split + '.order'), 'w') as h:
+                print('\n'.join(str(-1 if i % 3 == 0 else i // 2) for i in range(10)), file=h)
+
+        destdir = os.path.join(data_dir, 'bin')
+        args = options.get_preprocessing_parser().parse_args([
+            '--source-lang', 'in', '--target-lang', 'out',
+            '--trainpref', os.path.join(data_dir, 'train'),
+            '--validpref', os.path.join(data_dir, 'valid'),
+            '--testpref', os.path.join(data_dir, 'test'),
+            '--destdir', destdir, '--img-features', 'feats.npy', '--img-order', 'order',
+        ])
+        preprocess.main(args)
+
+        prefix = os.path.join(destdir, 'train.in-out.in')
+        ds = data_utils.load_img_features(prefix)
+        index = data_utils.load_img_index(prefix)
+        self.assertEqual(len(ds), 6)
+        for i in range(10):
+            if i % 3 == 0:
+                self.assertEqual(index[i], image_feature_dataset.MISSING_IMAGE)
+            else:
+                self.assertTrue(torch.equal(ds[index[i]], torch.from_numpy(self.features[i // 2]).view(49, 16)))
+
+    def test_preprocess_dedup_object_array(self):
+        data_dir = self.tmpdir.name
+        create_dummy_data(data_dir, num_examples=6)
+        # images of different numbers of regions, each used by two sentences
+        images = [np.random.rand(n, 16).astype(np.float32) for n in [3, 5, 2]]
+        for workers in ['1', '2']:
+            destdir = os.path.join(data_dir, 'bin' + workers)
+            os.makedirs(destdir)
+            for split in ['train', 'valid', 'test']:
+                features = np.empty(6, dtype=object)
+                features[:] = [images[i % 3] for i in range(6)]
+                np.save(os.path.join(destdir, split + '.in-out.in.npy'), features, allow_pickle=True)
+            # --img-dedup alone binarizes <destdir>/<split>.<src>-<tgt>.<src>.npy
+            args = options.get_preprocessing_parser().parse_args([
+                '--source-lang', 'in', '--target-lang', 'out',
+                '--trainpref', os.path.join(data_dir, 'train'),
+                '--validpref', os.path.join(data_dir, 'valid'),
+                '--testpref', os.path.join(data_dir, 'test'),
+                '--destdir', destdir, '--workers', workers, '--img-dedup',
+            ])
+            preprocess.main(args)
+
+            prefix = os.path.join(destdir, 'train.in-out.in')
+            ds = data_utils.load_img_features(prefix)
+            index = data_utils.load_img_index(prefix)
+            self.assertIsInstance(ds, image_feature_dataset.MMapImageFeatureDataset)
+            self.assertEqual(len(ds), 3)
+            for i in range(6):
+                self.assertTrue(torch.equal(ds[index[i]], torch.from_numpy(images[i % 3])))
+
+    def test_legacy_npy(self):
+        np.save(self.prefix + '.npy', self.features)
+        ds = data_utils.load_img_features(self.prefix)
+        self.assertIsInstance(ds, image_feature_dataset.NumpyImageFeatureDataset)
+        self.assertEqual(len(ds), 5)
+        self.assertTrue(torch.equal(ds[2], torch.from_numpy(self.features[2]).view(49, 16)))
+
+    def test_image_feature_store(self):
+        self._write_store()
+        store = image_feature_dataset.ImageFeatureStore(self.prefix)
+        self.assertTrue(torch.equal(store('3'), torch.from_numpy(self.features[3]).view(49, 16)))
+        self.assertIsNone(store(''))
+        path = os.path.join(self.tmpdir.name, 'image.npy')
+        np.save(path, self.features[1, :2])
+        self.assertTrue(torch.equal(store(path), torch.from_numpy(self.features[1, :2]).view(14, 16)))
+        np.save(path, np.zeros((3, 8), dtype=np.float32))
+        with self.assertRaises(ValueError):
+            store(path)
+        for image in [os.path.join(self.tmpdir.name, 'missing.npy'), '5']:
+            with self.assertRaises(ValueError):
+                store(image)
+
+    def test_inference_dataset_with_images(self):
+        vocab = test_utils.dummy_dictionary(10)
+        task = TranslationTask(argparse.Namespace(), vocab, vocab)
+        tokens = [torch.LongTensor([4, 5, vocab.eos()]), torch.LongTensor([6, vocab.eos()])]
+        images = [None, torch.rand(3, 16)]
+        dataset = task.build_dataset_for_inference(tokens, [3, 2], src_img_features=images)
+        batch = dataset.collater([dataset[i] for i in range(2)])['net_input']
+        self.assertEqual(batch['src_img_lengths'].tolist(), [0, 3])
+        self.assertTrue(torch.equal(batch['src_img_features'][1], images[1]))
+        self.assertFalse(batch['src_img_features'][0].any())
+
+        dataset = task.build_dataset_for_inference(tokens, [3, 2])
+        self.assertIsNone(dataset.collater([dataset[i] for i in range(2)])['net_input']['src_img_features'])
+
+
+if __name__ == '__main__':
+    unittest.main()
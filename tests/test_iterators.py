@@ -5,6 +5,8 @@
 
 import unittest
 
+import torch
+
 from fairseq.data import iterators
 
 
@@ -22,6 +24,16 @@ class TestIterators(unittest.TestCase):
         self.assertEqual(next(itr), 9)
         self.assertFalse(itr.has_next())
 
+    @unittest.skipIf(not torch.cuda.is_available(), 'test requires a GPU')
+    def test_device_prefetch_iterator(self):
+        x = [{'id': torch.arange(i, i + 3).pin_memory()} for i in range(5)]
+        itr = iterators.CountingIterator(iterators.DevicePrefetchIterator(x))
+        self.assertEqual(len(itr), 5)
+        for i, sample in enumerate(itr):
+            self.assertTrue(sample['id'].is_cuda)
+            self.assertEqual(sample['id'].tolist(), [i, i + 1, i + 2])
+        self.assertEqual(itr.count, 5)
+
 
 if __name__ == '__main__':
     unittest.main()
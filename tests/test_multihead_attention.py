@@ -55,6 +55,43 @@ class TestMultiheadAttention(unittest.TestCase):
             else:
                 self.assertIsNone(c[2])
 
+    def test_cache_static_kv(self):
+        torch.manual_seed(0)
+        attn = MultiheadAttention(8, 2, kdim=6, vdim=6, encoder_decoder_attention=True).eval()
+        bsz, group_size, src_len = 3, 2, 5
+        key = torch.rand(src_len, bsz, 6)
+        key_padding_mask = torch.zeros(bsz, src_len).bool()
+        key_padding_mask[1, -2:] = True
+
+        cached, expected = {}, {}
+        attn.cache_static_kv(key, key_padding_mask, cached, group_size)
+        new_order = torch.arange(bsz).repeat_interleave(group_size)
+        key, key_padding_mask = key.index_select(1, new_order), key_padding_mask.index_select(0, new_order)
+        num_hypos = bsz * group_size
+        for new_order in [
+            None,
+            torch.LongTensor([1, 0, 3, 3, 5, 4]),  # within groups
+            torch.LongTensor([0, 1, 5, 4]),  # the second group is dropped
+            torch.LongTensor([1, 1, 2, 3]),
+        ]:
+            if new_order is not None:
+                attn.reorder_incremental_state(cached, new_order)
+                attn.reorder_incremental_state(expected, new_order)
+                num_hypos = new_order.size(0)
+            query = torch.rand(1, num_hypos, 8)
+            out, weights = attn(query, None, None, incremental_state=cached, static_kv=True)
+            expected_out, expected_weights = attn(
+                query, key, key, key_padding_mask=key_padding_mask,
+                incremental_state=expected, static_kv=True,
+            )
+            self.assertTrue(torch.allclose(out, expected_out, atol=1e-6))
+            self.assertTrue(torch.allclose(weights, expected_weights, atol=1e-6))
+            # the keys of each group are kept once
+            self.assertEqual(
+                attn._get_input_buffer(cached)['prev_key'].size(0), num_hypos // group_size
+            )
+            key = None  # cached
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,505 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import contextlib
+import math
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+import torch.nn.functional as F
+
+from fairseq import utils
+from fairseq.data import image_feature_dataset
+from fairseq.criterions.label_smoothed_cross_entropy_with_mmconsis import (
+    LabelSmoothedCrossEntropyCriterionWithMMConsis,
+)
+from fairseq.models.transformer import TransformerModel
+from fairseq.modules import MultiheadAttention_Image, TransformerEncoderLayer
+from fairseq.sequence_generator import EnsembleModel, SequenceGenerator
+from tests.test_checkpoint_utils import build_trainer, loadable_checkpoints, optimizer_state_of, SumCriterion
+import tests.utils as test_utils
+
+
+EMBED_DIM, NUM_HEADS, IMG_FEATURE_DIM, NUM_REGIONS = 16, 4, 32, 9
+
+
+def build_model(**overrides):
+    parser = argparse.ArgumentParser()
+    TransformerModel.add_args(parser)
+    # leave unset options to the architecture defaults
+    args = argparse.Namespace(**{k: v for k, v in vars(parser.parse_args([])).items() if v is not None})
+    args.encoder_layers_to_keep = args.decoder_layers_to_keep = None
+    args.encoder_embed_dim = args.decoder_embed_dim = args.gating_dim = EMBED_DIM
+    args.encoder_ffn_embed_dim = args.decoder_ffn_embed_dim = 32
+    args.encoder_attention_heads = args.decoder_attention_heads = NUM_HEADS
+    args.encoder_layers, args.decoder_layers = 5, 2
+    args.img_feature_dim = IMG_FEATURE_DIM
+    for k, v in overrides.items():
+        setattr(args, k, v)
+
+    vocab = test_utils.dummy_dictionary(10)
+    task = argparse.Namespace(source_dictionary=vocab, target_dictionary=vocab)
+    return TransformerModel.build_model(args, task), vocab
+
+
+def sample_input(vocab, bsz=3, src_len=6):
+    src_tokens = torch.randint(vocab.nspecial, len(vocab), (bsz, src_len))
+    src_tokens[1:, :2] = vocab.pad()  # left padding
+    src_lengths = src_tokens.ne(vocab.pad()).sum(-1)
+    src_img_features = torch.rand(bsz, NUM_REGIONS, IMG_FEATURE_DIM)
+    src_img_features[2, -3:] = 0  # padded regions
+    return src_tokens, src_lengths, src_img_features
+
+
+class DecoderOutputCriterion(SumCriterion):
+
+    def forward(self, model, sample, reduce=True):
+        loss = model(**sample['net_input'])[0].pow(2).sum()
+        return loss, 1, {'loss': loss.item(), 'ntokens': 1, 'nsentences': 1, 'sample_size': 1}
+
+
+def reference_image_attention(attn, x, mask, key_padding_mask=None):
+    """Per-head masked image self-attention: masked scores are set to 1e-4
+    (not -inf) before the softmax, and padded regions are excluded."""
+    tgt_len, bsz, embed_dim = x.size()
+    head_dim = embed_dim // attn.num_heads
+    q = attn.q_proj(x) * head_dim ** -0.5
+    k, v = attn.k_proj(x), attn.v_proj(x)
+    out = torch.empty_like(x)
+    for b in range(bsz):
+        heads = []
+        for h in range(attn.num_heads):
+            sl = slice(h * head_dim, (h + 1) * head_dim)
+            scores = q[:, b, sl] @ k[:, b, sl].t()
+            scores = scores.masked_fill(mask[b], 1e-4)
+            if key_padding_mask is not None:
+                scores = scores.masked_fill(key_padding_mask[b], float('-inf'))
+            heads.append(F.softmax(scores, dim=-1) @ v[:, b, sl])
+        out[:, b] = attn.out_proj(torch.cat(heads, dim=-1))
+    return out
+
+
+class TestMultimodalTransformer(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def test_encoder_forward_on_cpu(self):
+        model, vocab = build_model()
+        model.eval()
+        src_tokens, src_lengths, src_img_features = sample_input(vocab)
+        with torch.no_grad():
+            encoder_out = model.encoder(src_tokens, src_lengths, src_img_features)
+            again = model.encoder(src_tokens, src_lengths, src_img_features)
+        self.assertEqual(encoder_out.encoder_out.size(), (6, 3, EMBED_DIM))
+        self.assertEqual(encoder_out.encoder_out.device, torch.device('cpu'))
+        self.assertTrue(torch.isfinite(encoder_out.encoder_out).all())
+        self.assertTrue(torch.equal(encoder_out.encoder_out, again.encoder_out))
+
+    def test_model_backward_on_cpu(self):
+        model, vocab = build_model()
+        src_tokens, src_lengths, src_img_features = sample_input(vocab)
+        prev_output_tokens = torch.randint(vocab.nspecial, len(vocab), (3, 4))
+        out, _ = model(src_tokens, src_lengths, src_img_features, prev_output_tokens)
+        out.sum().backward()
+        self.assertIsNotNone(model.encoder.img_fc.weight.grad)
+        self.assertIsNotNone(model.encoder.layers[3].image_encoder.self_attn.q_proj.weight.grad)
+
+    def test_text2image_mask(self):
+        model, _ = build_model()
+        layer = model.encoder.layers[0]
+        x = torch.rand(6, 3, EMBED_DIM)
+        img = torch.rand(NUM_REGIONS, 3, EMBED_DIM)
+        mask = layer.mask(x, img, 0)
+
+        def reference(num_regions):
+            xb, imgb = x.transpose(0, 1), img[:num_regions].transpose(0, 1)
+            img2txt = F.softmax(imgb @ xb.transpose(1, 2) / math.sqrt(128), dim=-1)
+            txt2img = F.softmax(xb @ imgb.transpose(1, 2) / math.sqrt(128), dim=-1)
+            # 0.02 for 49 regions
+            return (img2txt @ txt2img).le(0.02 * 49 / num_regions)
+
+        expected = reference(NUM_REGIONS)
+        self.assertEqual(mask.size(), (3, NUM_REGIONS, NUM_REGIONS))
+        self.assertTrue(torch.equal(mask, expected))
+
+        out = torch.empty(3, NUM_REGIONS, NUM_REGIONS, dtype=torch.bool)
+        self.assertIs(layer.mask(x, img, 0, out=out), out)
+        self.assertTrue(torch.equal(out, expected))
+
+        # padded regions are neither attended to nor counted
+        padding_mask = torch.zeros(3, NUM_REGIONS, dtype=torch.bool)
+        padding_mask[:, -3:] = True
+        mask = layer.mask(x, img, 0, padding_mask)
+        self.assertTrue(torch.equal(mask[:, :-3, :-3], reference(NUM_REGIONS - 3)))
+        self.assertTrue(mask[:, :, -3:].all())
+
+    def test_mask_only_computed_when_consumed(self):
+        model, vocab = build_model(encoder_layers=6)
+        model.eval()
+        with contextlib.ExitStack() as stack:
+            masks = [
+                stack.enter_context(mock.patch.object(layer, 'mask', wraps=layer.mask))
+                for layer in model.encoder.layers
+            ]
+            with torch.no_grad():
+                model.encoder(*sample_input(vocab))
+        # only layers >= 3 consume the mask of the previous layer
+        self.assertEqual([m.call_count for m in masks], [0, 0, 1, 1, 1, 0])
+
+    def test_image_stream(self):
+        model, vocab = build_model(encoder_layers=6)
+        model.eval()
+        self.assertEqual(
+            [layer.image_encoder is not None for layer in model.encoder.layers],
+            [True, False, False, True, True, True],
+        )
+
+        src_tokens, src_lengths, src_img_features = sample_input(vocab)
+        src_img_features[1, :4] = 0
+        padding_masks = []
+        for layer in model.encoder.layers:
+            if layer.image_encoder is not None:
+                layer.image_encoder.register_forward_hook(
+                    lambda module, inputs, output: padding_masks.append(inputs[2])
+                )
+        with torch.no_grad():
+            model.encoder(src_tokens, src_lengths, src_img_features)
+        # the padding mask of the image regions is computed once, from the inputs
+        self.assertEqual(len(padding_masks), 4)
+        self.assertTrue(all(mask is padding_masks[0] for mask in padding_masks))
+        self.assertEqual(padding_masks[0].tolist(), src_img_features.eq(0).all(dim=-1).tolist())
+
+    def test_gate_exit(self):
+        model, vocab = build_model(encoder_layers=6)
+        model.eval()
+        src_tokens, src_lengths, src_img_features = sample_input(vocab)
+        gates = {}
+        for idx, layer in enumerate(model.encoder.layers[3:], start=3):
+            layer.gating.register_forward_hook(
+                lambda module, inputs, output, idx=idx: gates.__setitem__(idx, output[1])
+            )
+
+        def encode(threshold, per_sentence=False, batch=slice(None), tokens=slice(None)):
+            gates.clear()
+            model.encoder.set_gate_exit(threshold, per_sentence)
+            with torch.no_grad():
+                return model.encoder(
+                    src_tokens[batch, tokens], src_lengths[batch], src_img_features[batch],
+                ).encoder_out
+
+        expected = encode(None)
+        self.assertEqual(sorted(gates), [3, 4, 5])
+        self.assertTrue(torch.equal(encode(0.), expected))
+
+        # the batch exits after the first layer with gating
+        out = encode(1.)
+        self.assertEqual(sorted(gates), [3])
+        self.assertTrue(torch.allclose(out, encode(1., per_sentence=True)))
+
+        # a sentence exits independently of the others in its batch
+        encode(None)
+        not_padding = src_tokens.ne(vocab.pad()).t().unsqueeze(-1)
+        gate_mean = (gates[3] * not_padding).sum(dim=0).squeeze(-1) / not_padding.sum(dim=0).squeeze(-1)
+        threshold = gate_mean.median().item()
+        out = encode(threshold, per_sentence=True)
+        self.assertEqual(gates[4].size(1), (gate_mean >= threshold).sum().item())
+        for b in range(3):
+            # without the left padding
+            start = src_tokens.size(1) - src_lengths[b].item()
+            single = encode(threshold, per_sentence=True, batch=slice(b, b + 1), tokens=slice(start, None))
+            self.assertTrue(torch.allclose(out[start:, b], single[:, 0], atol=1e-6))
+
+    def test_sentences_without_image(self):
+        model, vocab = build_model(encoder_layers=6)
+        model.eval()
+        src_tokens, src_lengths, src_img_features = sample_input(vocab)
+        image_encoders = [
+            mock.patch.object(layer.image_encoder, 'forward', wraps=layer.image_encoder.forward)
+            for layer in model.encoder.layers if layer.image_encoder is not None
+        ]
+        with contextlib.ExitStack() as stack:
+            calls = [stack.enter_context(p) for p in image_encoders]
+            with torch.no_grad():
+                # a batch without images skips the image stream
+                text_only = model.encoder(src_tokens, src_lengths, None).encoder_out
+                self.assertEqual(sum(c.call_count for c in calls), 0)
+                blank = model.encoder(src_tokens, src_lengths, torch.zeros_like(src_img_features)).encoder_out
+                self.assertEqual(sum(c.call_count for c in calls), 0)
+                self.assertTrue(torch.equal(text_only, blank))
+                self.assertTrue(torch.isfinite(text_only).all())
+
+                # in a mixed batch, only the sentences with an image use it
+                src_img_features[1] = 0
+                mixed = model.encoder(src_tokens, src_lengths, src_img_features).encoder_out
+                self.assertEqual([c.call_args[0][1].size(1) for c in calls], [2] * 4)
+                with_image = model.encoder(src_tokens, src_lengths, src_img_features[[0, 0, 2]]).encoder_out
+
+                # as found by the collater, without looking at the features
+                collated = model.encoder(
+                    src_tokens, src_lengths, src_img_features, src_img_batch=torch.LongTensor([0, 2]),
+                ).encoder_out
+                self.assertTrue(torch.equal(collated, mixed))
+                for c in calls:
+                    c.reset_mock()
+                model.encoder(src_tokens, src_lengths, src_img_features, src_img_batch=torch.arange(3))
+                self.assertEqual([c.call_args[0][1].size(1) for c in calls], [3] * 4)
+        self.assertTrue(torch.allclose(mixed[:, 1], text_only[:, 1], atol=1e-6))
+        self.assertTrue(torch.allclose(mixed[:, [0, 2]], with_image[:, [0, 2]], atol=1e-6))
+
+    def test_variable_regions(self):
+        model, vocab = build_model(encoder_layers=6)
+        model.eval()
+        src_tokens, src_lengths, src_img_features = sample_input(vocab)
+        src_img_features[2, -3:] = torch.rand(3, IMG_FEATURE_DIM)
+        # images of 9, 4 and 6 regions, padded to the most in the batch
+        src_img_lengths = torch.LongTensor([NUM_REGIONS, 4, 6])
+        for b, n in enumerate(src_img_lengths.tolist()):
+            src_img_features[b, n:] = 0
+        img_fc_bias = model.encoder.img_fc.bias
+        with torch.no_grad():
+            img_fc_bias.uniform_()  # padded regions are not all-zero once projected
+            out = model.encoder(
+                src_tokens, src_lengths, src_img_features, src_img_lengths=src_img_lengths,
+            ).encoder_out
+            for b, n in enumerate(src_img_lengths.tolist()):
+                start = src_tokens.size(1) - src_lengths[b].item()
+                single = model.encoder(
+                    src_tokens[b:b + 1, start:], src_lengths[b:b + 1], src_img_features[b:b + 1, :n],
+                ).encoder_out
+                self.assertTrue(torch.allclose(out[start:, b], single[:, 0], atol=1e-5))
+
+    def test_projection_cache_with_blank_image(self):
+        model, vocab = build_model(encoder_layers=6)
+        model.eval()
+        src_tokens, src_lengths, src_img_features = sample_input(vocab)
+        src_img_features[1] = 0  # blanked image
+        src_img_lengths = torch.full((3,), NUM_REGIONS, dtype=torch.long)
+        encoder = model.encoder
+        with torch.no_grad(), tempfile.TemporaryDirectory() as tmpdir:
+            encoder.img_fc.bias.uniform_()  # blank images are not all-zero once projected
+            expected = encoder(
+                src_tokens, src_lengths, src_img_features, src_img_lengths=src_img_lengths,
+            ).encoder_out
+
+            prefix = os.path.join(tmpdir, 'proj')
+            image_feature_dataset.binarize_image_projections(
+                image_feature_dataset.ListImageFeatureDataset(list(src_img_features)), prefix, [encoder.img_fc],
+            )
+            cache = image_feature_dataset.MMapImageFeatureDataset(prefix)
+            self.assertFalse(cache[1].ne(0).any())
+            encoder.img_proj_offset = 0
+            cached = encoder(
+                src_tokens, src_lengths, torch.stack([cache[i] for i in range(3)]),
+                src_img_lengths=src_img_lengths,
+            ).encoder_out
+        self.assertTrue(torch.allclose(cached, expected, atol=1e-5))
+
+    def test_beam_search_reindexes_encoder_out(self):
+        model, vocab = build_model()
+        model.eval()
+        src_tokens, src_lengths, src_img_features = sample_input(vocab)
+        sample = {'net_input': {
+            'src_tokens': src_tokens, 'src_lengths': src_lengths, 'src_img_features': src_img_features,
+        }}
+        generator = SequenceGenerator(vocab, beam_size=3, max_len_b=5)
+        encoder = model.encoder
+
+        # reordering by index leaves the encoder output of each sentence in place
+        with mock.patch.object(encoder, 'reorder_encoder_out', wraps=encoder.reorder_encoder_out) as reorder:
+            with torch.no_grad():
+                hypos = generator.generate([model], sample)
+            self.assertEqual(reorder.call_count, 0)
+        with mock.patch.object(encoder, 'reindex_encoder_out', encoder.reorder_encoder_out):
+            with torch.no_grad():
+                expected = generator.generate([model], sample)
+        for hypo, expected_hypo in zip(hypos, expected):
+            for h, e in zip(hypo, expected_hypo):
+                self.assertTrue(torch.equal(h['tokens'], e['tokens']))
+                self.assertTrue(torch.allclose(h['positional_scores'], e['positional_scores'], atol=1e-6))
+
+        # successive reorders compose, and are materialized by reorder_encoder_out
+        with torch.no_grad():
+            encoder_out = encoder(src_tokens, src_lengths, src_img_features)
+        first, second = torch.LongTensor([2, 0, 0, 1]), torch.LongTensor([3, 3, 1, 0, 2])
+        indexed = encoder.reindex_encoder_out(encoder.reindex_encoder_out(encoder_out, first), second)
+        self.assertEqual(indexed.src_index.tolist(), [1, 1, 0, 2, 0])
+        self.assertIs(indexed.encoder_out, encoder_out.encoder_out)
+        copied = encoder.reorder_encoder_out(indexed, torch.LongTensor([4, 0]))
+        self.assertIsNone(copied.src_index)
+        self.assertTrue(torch.equal(copied.encoder_out, encoder_out.encoder_out[:, [0, 1]]))
+        self.assertTrue(torch.equal(
+            copied.encoder_padding_mask, encoder_out.encoder_padding_mask[[0, 1]],
+        ))
+
+    def test_beam_search_caches_encoder_attn(self):
+        model, vocab = build_model()
+        model.eval()
+        src_tokens, src_lengths, src_img_features = sample_input(vocab)
+        sample = {'net_input': {
+            'src_tokens': src_tokens, 'src_lengths': src_lengths, 'src_img_features': src_img_features,
+        }}
+        for beam_size in [1, 3]:
+            generator = SequenceGenerator(vocab, beam_size=beam_size, max_len_b=5)
+            with torch.no_grad():
+                hypos = generator.generate([model], sample)
+                with mock.patch.object(EnsembleModel, 'cache_encoder_attn'):
+                    expected = generator.generate([model], sample)
+            for hypo, expected_hypo in zip(hypos, expected):
+                for h, e in zip(hypo, expected_hypo):
+                    self.assertTrue(torch.equal(h['tokens'], e['tokens']))
+                    self.assertTrue(torch.allclose(h['positional_scores'], e['positional_scores'], atol=1e-6))
+                    self.assertTrue(torch.allclose(h['attention'], e['attention'], atol=1e-6))
+
+    def test_consistency_loss(self):
+        model, vocab = build_model()
+        src_tokens, src_lengths, src_img_features = sample_input(vocab)
+        src_img_features[1] = 0  # without an image
+        prev_output_tokens = torch.randint(vocab.nspecial, len(vocab), (3, 4))
+        target = torch.randint(vocab.nspecial, len(vocab), (3, 4))
+        sample = {
+            'net_input': {
+                'src_tokens': src_tokens, 'src_lengths': src_lengths,
+                'src_img_features': src_img_features, 'prev_output_tokens': prev_output_tokens,
+            },
+            'target': target,
+            'ntokens': target.numel(),
+        }
+        args = argparse.Namespace(label_smoothing=0.1, sentence_avg=False, log_consis_cost=True)
+        criterion = LabelSmoothedCrossEntropyCriterionWithMMConsis(
+            args, argparse.Namespace(target_dictionary=vocab),
+        )
+        model.eval()  # without dropout
+        loss, _, logging_output = criterion(model, sample)
+        loss.backward()
+        self.assertEqual(logging_output['nimages'], 2)
+        self.assertGreater(logging_output['consis_kb'], 0)
+        self.assertIn('consis_ms', logging_output)
+
+        # the mean text and image states of each sentence with an image,
+        # without padding
+        encoder_out = model.encoder(src_tokens, src_lengths, src_img_features)
+        expected = 0.
+        for b in [0, 2]:
+            start = src_tokens.size(1) - src_lengths[b].item()
+            txt = utils.meanpooling_tensor(encoder_out.encoder_out[start:, b])
+            img = encoder_out.img_summary[b]
+            expected += utils.multimodel_consis_loss(img, txt).item()
+        self.assertAlmostEqual(logging_output['consis_loss'], expected, places=5)
+        self.assertEqual(encoder_out.img_summary[1].abs().sum().item(), 0)
+
+    def test_load_checkpoint_with_unused_image_encoders(self):
+        model, vocab = build_model(encoder_layers=6)
+        model.eval()
+        state_dict = model.state_dict()
+        # earlier checkpoints have an image encoder in every layer
+        for i in [1, 2]:
+            for k, v in model.encoder.layers[0].image_encoder.state_dict().items():
+                state_dict['encoder.layers.{}.image_encoder.{}'.format(i, k)] = v.clone()
+        model.load_state_dict(state_dict, strict=True)
+        self.assertFalse(any('.1.image_encoder' in k or '.2.image_encoder' in k for k in state_dict))
+
+    def test_load_checkpoint_with_unused_parameters(self):
+        model, vocab = build_model(encoder_layers=6)
+        self.assertEqual(
+            [layer.gating is not None for layer in model.encoder.layers], [False] * 3 + [True] * 3,
+        )
+        self.assertFalse(any(
+            'self_attn2' in k or 'fc_con_layer_norm' in k or 'Gating' in k for k in model.state_dict()
+        ))
+        state_dict = model.state_dict()
+        # earlier checkpoints have parameters that were never used
+        layer = model.encoder.layers[3]
+        for i in range(6):
+            prefix = 'encoder.layers.{}.'.format(i)
+            for k, v in layer.self_attn.state_dict().items():
+                state_dict[prefix + 'self_attn2.' + k] = v.clone()
+            for k, v in layer.final_layer_norm.state_dict().items():
+                state_dict[prefix + 'fc_con_layer_norm.' + k] = v.clone()
+            for k, v in layer.gating.state_dict().items():
+                state_dict.setdefault(prefix + 'gating.' + k, v.clone())
+        for k, v in layer.gating.state_dict().items():
+            state_dict['encoder.Gating.' + k] = v.clone()
+        model.load_state_dict(state_dict, strict=True)
+        self.assertEqual(set(state_dict), set(model.state_dict()))
+
+    def test_resume_checkpoint_with_unused_parameters(self):
+        for share_all_embeddings in [False, True]:
+            # earlier checkpoints have an image encoder and gating in every
+            # layer, and their optimizer state
+            with mock.patch.object(TransformerEncoderLayer, 'encodes_image', lambda *args: True), \
+                    mock.patch.object(TransformerEncoderLayer, 'uses_gating', lambda *args: True):
+                old_model, vocab = build_model(encoder_layers=6, share_all_embeddings=share_all_embeddings)
+            self.assertIsNotNone(old_model.encoder.layers[1].image_encoder)
+            src_tokens, src_lengths, src_img_features = sample_input(vocab)
+            sample = {'net_input': {
+                'src_tokens': src_tokens, 'src_lengths': src_lengths, 'src_img_features': src_img_features,
+                'prev_output_tokens': torch.randint(vocab.nspecial, len(vocab), (3, 4)),
+            }}
+            trainer = build_trainer(old_model, criterion_cls=DecoderOutputCriterion)
+            trainer.train_step([sample])
+            expected = {
+                name: optimizer_state_of(trainer, p)['exp_avg'].clone()
+                for name, p in [('fc1', old_model.encoder.layers[3].fc1.weight),
+                                ('embed_tokens', old_model.decoder.embed_tokens.weight)]
+            }
+
+            with tempfile.TemporaryDirectory() as save_dir, loadable_checkpoints():
+                filename = os.path.join(save_dir, 'checkpoint.pt')
+                trainer.save_checkpoint(filename, {'train_iterator': {'epoch': 1}})
+
+                # resumes without --reset-optimizer
+                model, _ = build_model(encoder_layers=6, share_all_embeddings=share_all_embeddings)
+                self.assertIsNone(model.encoder.layers[1].image_encoder)
+                trainer = build_trainer(model, criterion_cls=DecoderOutputCriterion)
+                trainer.load_checkpoint(filename)
+                self.assertEqual(trainer.get_num_updates(), 1)
+                for name, p in [('fc1', model.encoder.layers[3].fc1.weight),
+                                ('embed_tokens', model.decoder.embed_tokens.weight)]:
+                    self.assertTrue(torch.equal(optimizer_state_of(trainer, p)['exp_avg'], expected[name]))
+                trainer.train_step([sample])
+
+    def test_masked_image_attention(self):
+        attn = MultiheadAttention_Image(EMBED_DIM, NUM_HEADS, self_attention=True)
+        attn.eval()
+        x = torch.rand(NUM_REGIONS, 3, EMBED_DIM)
+        x[-3:, 2] = 0
+        mask = torch.rand(3, NUM_REGIONS, NUM_REGIONS) > 0.5
+        key_padding_mask = x.sum(dim=-1).eq(0).t()
+        with torch.no_grad():
+            out, weights = attn(query=x, key=None, value=None, mask_matrix_tmp=mask)
+            self.assertTrue(torch.allclose(out, reference_image_attention(attn, x, mask), atol=1e-6))
+            self.assertEqual(weights.size(), (3, NUM_REGIONS, NUM_REGIONS))
+
+            # each sample is masked by its own mask, in every head
+            out, weights = attn(
+                query=x, key=x, value=x, mask_matrix_tmp=mask, key_padding_mask=key_padding_mask,
+                need_weights=False,
+            )
+            self.assertIsNone(weights)
+            expected = reference_image_attention(attn, x, mask, key_padding_mask)
+            self.assertTrue(torch.allclose(out, expected, atol=1e-6))
+            for b in range(3):
+                single, _ = attn(
+                    query=x[:, b:b + 1], key=None, value=None, mask_matrix_tmp=mask[b:b + 1],
+                    key_padding_mask=key_padding_mask[b:b + 1],
+                )
+                self.assertTrue(torch.allclose(single[:, 0], out[:, b], atol=1e-6))
+
+    def test_masked_image_attention_backward(self):
+        attn = MultiheadAttention_Image(EMBED_DIM, NUM_HEADS, self_attention=True)
+        x = torch.rand(NUM_REGIONS, 3, EMBED_DIM, requires_grad=True)
+        mask = torch.rand(3, NUM_REGIONS, NUM_REGIONS) > 0.5
+        out, _ = attn(query=x, key=x, value=x, mask_matrix_tmp=mask, need_weights=False)
+        out.sum().backward()
+        self.assertTrue(torch.isfinite(x.grad).all())
+        self.assertIsNotNone(attn.q_proj.weight.grad)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import asyncio
+import json
+import unittest
+
+import torch
+
+from fairseq.data import ImageFeatureStore
+from fairseq.hub_utils import BatchingHubInterface, GeneratorHubInterface
+from fairseq.sequence_generator import SequenceGenerator
+from fairseq.tasks.translation import TranslationTask
+from fairseq.translation_server import TranslationServer
+from fairseq_cli import interactive, serve
+from tests.test_multimodal_transformer import build_model, IMG_FEATURE_DIM, NUM_REGIONS
+
+
+class TestTranslationServer(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model, self.vocab = build_model()
+        self.model.eval()
+        self.task = TranslationTask(argparse.Namespace(), self.vocab, self.vocab)
+        self.generator = SequenceGenerator(self.vocab, beam_size=2, max_len_b=5)
+        self.images = {str(i): torch.rand(NUM_REGIONS - i, IMG_FEATURE_DIM) for i in range(3)}
+        self.sentences = ['4 5 6', '7 8', '9 4 5 6 7', '8']
+
+    def server(self, **kwargs):
+        return TranslationServer(
+            self.task, [self.model], self.generator, image_store=self.images.get, **kwargs
+        )
+
+    def translate(self, src_str, image=None):
+        """Translate a single sentence without the server."""
+        src_tokens = self.vocab.encode_line(src_str, add_if_not_exist=False).long().unsqueeze(0)
+        sample = {'net_input': {
+            'src_tokens': src_tokens,
+            'src_lengths': torch.LongTensor([src_tokens.numel()]),
+            'src_img_features': self.images[image].unsqueeze(0) if image is not None else None,
+        }}
+        return self.task.inference_step(self.generator, [self.model], sample)[0]
+
+    def test_batches_concurrent_requests(self):
+        images = ['0', None, '2', '1']
+        with self.server(max_sentences=3, max_wait=10.) as server:
+            requests = [server.submit(s, image) for s, image in zip(self.sentences, images)]
+        self.assertEqual(server.stats()['requests'], 4)
+        # the first three are batched, the last one waits for the next batch
+        self.assertEqual(server._batch_sizes, [3, 1])
+        for request, src_str, image in zip(requests, self.sentences, images):
+            hypos = request.future.result()
+            self.assertEqual(len(hypos), 2)
+            self.assertEqual(hypos[0]['tokens'].tolist(), self.translate(src_str, image)[0]['tokens'].tolist())
+            self.assertIsNotNone(request.latency)
+
+    def test_token_and_region_budgets(self):
+        # two sentences with their images, or four without, fit in a batch
+        with self.server(max_tokens=24, max_regions=2 * NUM_REGIONS, max_wait=10.) as server:
+            for src_str in self.sentences:
+                server.submit(src_str, '0')
+            for src_str in self.sentences:
+                server.submit(src_str)
+        self.assertEqual(server._batch_sizes, [2, 2, 4])
+
+    def test_invalid_requests(self):
+        with self.server(max_positions=4) as server:
+            with self.assertRaises(ValueError):
+                server.submit(self.sentences[2])
+        server = TranslationServer(self.task, [self.model], self.generator)
+        with self.assertRaises(ValueError):
+            server.submit(self.sentences[0], '0')
+
+    def test_serve_skips_bad_images(self):
+        server = TranslationServer(self.task, [self.model], self.generator, image_store=ImageFeatureStore())
+        lines = ['4 5 6', '7 8\tmissing.npy', '9 4 5 6 7', '8\t3']
+        printed = []
+        interactive.serve(server, lines, lambda id, src_tokens, hypos: printed.append((id, hypos)))
+        self.assertEqual([id for id, _ in printed], [0, 2])
+        for id, hypos in printed:
+            self.assertEqual(hypos[0]['tokens'].tolist(), self.translate(lines[id])[0]['tokens'].tolist())
+
+
+class TestBatchingHubInterface(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        model, vocab = build_model()
+        args = argparse.Namespace(
+            max_source_positions=8, max_target_positions=8, max_tokens=None, max_sentences=None,
+            beam=2, max_len_b=5,
+        )
+        self.hub = GeneratorHubInterface(args, TranslationTask(args, vocab, vocab), [model])
+        self.hub.eval()
+        self.image = torch.rand(NUM_REGIONS, IMG_FEATURE_DIM)
+
+    def run_requests(self, server, sentences, images=None):
+        async def requests():
+            return await asyncio.gather(*[
+                server.generate(self.hub.encode(s), image)
+                for s, image in zip(sentences, images or [None] * len(sentences))
+            ], return_exceptions=True)
+
+        return asyncio.get_event_loop().run_until_complete(requests())
+
+    def test_coalesces_concurrent_requests(self):
+        server = BatchingHubInterface(self.hub, beam=2, max_wait=0.5, max_sentences=3, bucket_width=8)
+        sentences = ['4 5 6', '7 8', '9 4 5', '8']
+        images = [self.image, None, None, self.image]
+        results = self.run_requests(server, sentences, images)
+        self.assertEqual(server.batch_sizes, [3, 1])
+        for hypos, src_str, image in zip(results, sentences, images):
+            expected = self.hub.generate(
+                [self.hub.encode(src_str)], beam=2, src_img_features=[image],
+            )[0]
+            self.assertEqual(hypos[0]['tokens'].tolist(), expected[0]['tokens'].tolist())
+
+    def test_length_buckets(self):
+        server = BatchingHubInterface(self.hub, beam=2, max_wait=0.01, bucket_width=4)
+        results = self.run_requests(server, ['4', '4 5 6 7 8 9', '5', '4 5 6 7 8', '4 5 6 7 8 9 4 5'])
+        self.assertEqual(server.batch_sizes, [2, 2])
+        self.assertIsInstance(results[4], ValueError)
+
+    def test_serve_responds(self):
+        server = BatchingHubInterface(self.hub, beam=2, max_wait=0.01)
+        lines = []
+        requests = [
+            json.dumps({'id': 1, 'src': '4 5'}),
+            json.dumps({'id': 2, 'src': '4 5', 'image': '0'}),
+            'not json',
+        ]
+        asyncio.get_event_loop().run_until_complete(asyncio.gather(*[
+            serve.respond(server, {'0': self.image}.get, line, lines.append) for line in requests
+        ]))
+        responses = [json.loads(line) for line in lines]
+        self.assertEqual(sorted(r['id'] for r in responses if 'translation' in r), [1, 2])
+        self.assertEqual(len([r for r in responses if 'error' in r]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()